@@ -0,0 +1,146 @@
+"""
+Check that the CLI starts quickly.
+
+Imports taskrabbit.cli with ``python -X importtime``, and fails if it takes
+longer than a budget, or if it imports any module which only some commands
+need, such as kombu. Those are imported by the commands which use them.
+
+Also runs ``taskr store list`` against an empty sqlite store, and fails if
+the command imports any of them, since listing tasks needs none.
+
+Run from the repository root::
+
+    python -m benchmarks.import_time --budget-ms 150
+"""
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Set
+
+import typer
+
+# Modules the CLI mustn't import until a command needs them.
+DEFERRED = ["kombu", "amqp", "aio_pika", "psycopg2", "termtables", "halo", "asyncio"]
+DEFAULT_BUDGET_MS = 150
+DEFAULT_RUNS = 5
+# Commands which mustn't import any deferred module.
+LIGHT_COMMANDS = [["store", "list"], ["store", "list", "--counts"]]
+SQLITE_CONFIG = """\
+[taskrabbit]
+store = taskrabbit.stores.sqlite.SqliteTaskStore
+log_level = INFO
+
+[rabbitmq]
+username = guest
+password = guest
+host = localhost
+
+[store]
+db = {db}
+"""
+
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def parse_import_times(output: str) -> Dict[str, int]:
+    """
+    Return the cumulative time taken to import each module, in microseconds,
+    from the output of ``python -X importtime``.
+    """
+    times = {}
+    for line in output.splitlines():
+        match = LINE.match(line)
+        if match is not None:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """
+    Import ``module`` in a new interpreter, and return the cumulative time
+    taken to import each top level module, in microseconds.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    return parse_import_times(result.stderr)
+
+
+def command_imports(command: List[str]) -> Set[str]:
+    """
+    Run a taskr command against an empty sqlite store, in a new interpreter,
+    and return the top level modules it imports.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        config = Path(tmp, "taskrabbit.ini")
+        config.write_text(SQLITE_CONFIG.format(db=Path(tmp, "tasks.db")))
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", "taskrabbit"]
+            + ["--config", str(config)]
+            + command,
+            capture_output=True,
+            check=True,
+            text=True,
+            # Keeps the user's ~/.taskrabbit.ini out of it.
+            env={**os.environ, "HOME": tmp},
+        )
+    return {name.split(".")[0] for name in parse_import_times(result.stderr)}
+
+
+def main(
+    budget_ms: int = typer.Option(
+        DEFAULT_BUDGET_MS, min=1, help="Slowest acceptable import of the CLI."
+    ),
+    runs: int = typer.Option(
+        DEFAULT_RUNS, min=1, help="Take the fastest of this many imports."
+    ),
+    module: str = typer.Option("taskrabbit.cli", help="Module to import."),
+):
+    """
+    Fail if importing the CLI is slow, or imports modules it should defer.
+    """
+    fastest = None
+    for _ in range(runs):
+        times = import_times(module)
+        if fastest is None or times[module] < fastest[module]:
+            fastest = times
+
+    imported: List[str] = sorted(
+        {name.split(".")[0] for name in fastest} & set(DEFERRED)
+    )
+    elapsed_ms = fastest[module] / 1000
+    typer.echo(f"Imported {module} in {elapsed_ms:.1f}ms (budget {budget_ms}ms)")
+    slowest = sorted(
+        (name for name in fastest if "." not in name and name != module),
+        key=fastest.get,
+        reverse=True,
+    )[:5]
+    typer.echo(
+        "Slowest imports: "
+        + ", ".join(f"{name} {fastest[name] / 1000:.1f}ms" for name in slowest)
+    )
+
+    failed = False
+    if imported:
+        typer.echo(f"Imported modules which should be deferred: {', '.join(imported)}")
+        failed = True
+    for command in LIGHT_COMMANDS:
+        imported = sorted(command_imports(command) & set(DEFERRED))
+        if imported:
+            typer.echo(f"taskr {' '.join(command)} imported: {', '.join(imported)}")
+            failed = True
+    if elapsed_ms > budget_ms:
+        typer.echo(f"Over budget by {elapsed_ms - budget_ms:.1f}ms")
+        failed = True
+    if failed:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
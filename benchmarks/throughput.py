@@ -0,0 +1,501 @@
+"""
+Measure drain and fill throughput, without RabbitMQ.
+
+Each scenario publishes a number of Celery style task messages to kombu's
+in-memory transport, drains them into a store, then fills them back from
+the store, timing each phase. Scenarios run one at a time, each in a new
+process, so peak RSS is measured per scenario.
+
+The in-memory broker lives in the benchmark's own process, so messages are
+published and drained a chunk at a time, and fill publishes to an exchange
+with no queues bound, which drops every message. The broker then never holds
+more than a chunk of messages. Peak RSS is also reported above the peak once
+the first chunk is published, which is mostly the broker's, so it reflects
+what drain and fill use.
+
+Run from the repository root::
+
+    python -m benchmarks.throughput run --sizes 10000 --payload small
+
+Results are written as JSON, by default to benchmarks/results/, named for
+the taskrabbit version. Compare two runs with::
+
+    python -m benchmarks.throughput compare old.json new.json
+"""
+import configparser
+import contextlib
+import io
+import json
+import logging
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import kombu
+import termtables
+import typer
+from kombu import Connection, Exchange, Queue
+
+from taskrabbit import __version__
+from taskrabbit.config import Config, DrainConfig, FillConfig, RabbitMQConfig
+from taskrabbit.metrics import MeteredTaskStore, Metrics
+from taskrabbit.operations import drain, fill
+
+RESULTS_DIR = Path(__file__).parent / "results"
+QUEUE_NAME = "benchmark"
+# Fill publishes here. No queues are bound, so its messages are dropped.
+SINK_EXCHANGE = "benchmark.sink"
+DEFAULT_CHUNK_SIZE = 10_000
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+DEFAULT_BATCH_SIZE = 500
+SEED = 0
+
+# Store class, and the config option giving where it keeps its tasks.
+STORES = {
+    "sqlite": ("taskrabbit.stores.sqlite.SqliteTaskStore", "db", "tasks.sqlite"),
+    "file": ("taskrabbit.stores.file.FileTaskStore", "directory", "tasks"),
+    "segmented": (
+        "taskrabbit.stores.segmented.SegmentedFileTaskStore",
+        "directory",
+        "segments",
+    ),
+}
+
+app = typer.Typer()
+
+
+class MemoryBrokerConfig(RabbitMQConfig):
+    """
+    Connect to kombu's in-memory transport instead of RabbitMQ. Its queues
+    are shared by every connection in the process.
+    """
+
+    def url(self):
+        return "memory://"
+
+
+def _line_items(rng: random.Random, count: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            "sku": f"SKU-{rng.randrange(10**6):06d}",
+            "description": " ".join(
+                rng.choice(("red", "large", "cotton", "shirt", "blue", "mug"))
+                for _ in range(4)
+            ),
+            "quantity": rng.randrange(1, 10),
+            "price": round(rng.uniform(1, 500), 2),
+        }
+        for _ in range(count)
+    ]
+
+
+def small_payload(rng: random.Random, i: int):
+    # Like the demo app's arithmetic tasks.
+    return "tasks.add", [i, rng.randrange(1000)], {}
+
+
+def medium_payload(rng: random.Random, i: int):
+    # About 1 KiB, e.g. an order to process.
+    return (
+        "orders.process",
+        [i],
+        {
+            "customer": {
+                "id": rng.randrange(10**9),
+                "email": f"customer{rng.randrange(10**6)}@example.com",
+            },
+            "items": _line_items(rng, 8),
+            "notes": None,
+        },
+    )
+
+
+def large_payload(rng: random.Random, i: int):
+    # About 13 KiB, e.g. a batch of records to import.
+    return "imports.records", [i, _line_items(rng, 140)], {"dry_run": False}
+
+
+PAYLOADS = {
+    "small": small_payload,
+    "medium": medium_payload,
+    "large": large_payload,
+}
+
+
+def peak_rss() -> int:
+    """
+    Peak resident set size of this process so far, in bytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives KiB, macOS gives bytes.
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def publish(
+    connection: Connection, rng: random.Random, start: int, count: int, payload: str
+):
+    """
+    Publish Celery protocol 2 task messages, numbered from ``start``.
+    Messages are generated with ``rng``, which is seeded the same way in
+    every run, so every run publishes the same messages.
+    """
+    make_payload = PAYLOADS[payload]
+    producer = connection.Producer(serializer="json")
+    queue = Queue(QUEUE_NAME)
+    for i in range(start, start + count):
+        task, args, kwargs = make_payload(rng, i)
+        task_id = f"{rng.getrandbits(128):032x}"
+        producer.publish(
+            [args, kwargs, {"callbacks": None, "errbacks": None, "chain": None}],
+            routing_key=QUEUE_NAME,
+            declare=[queue] if i == start else None,
+            headers={
+                "lang": "py",
+                "task": task,
+                "id": task_id,
+                "root_id": task_id,
+                "parent_id": None,
+                "group": None,
+                "retries": 0,
+                "eta": None,
+                "expires": None,
+                "argsrepr": repr(args)[:100],
+                "kwargsrepr": repr(kwargs)[:100],
+                "origin": "gen1@benchmark",
+            },
+        )
+
+
+def scenario_config(workdir: Path, store: str, batch_size: int) -> Config:
+    parser = configparser.ConfigParser()
+    parser.read_dict(
+        {
+            "taskrabbit": {"log_level": "WARNING"},
+            "rabbitmq": {"username": "guest", "password": "guest", "host": "memory"},
+        }
+    )
+    if store in STORES:
+        store_class, option, name = STORES[store]
+        parser["taskrabbit"]["store"] = store_class
+        parser["store"] = {option: str(workdir / name)}
+    else:
+        # A config file, e.g. for a Postgres store.
+        parser.read(store)
+    cfg = Config.from_config_dict(parser)
+    cfg.rabbitmq = MemoryBrokerConfig("guest", "guest", "memory")
+    cfg.drain = DrainConfig(batch_size=batch_size)
+    cfg.fill = FillConfig()
+    return cfg
+
+
+def phase(seconds: float, count: int, baseline_rss: int, **extra) -> Dict[str, Any]:
+    rss = peak_rss()
+    return {
+        "seconds": seconds,
+        "messages_per_second": count / max(seconds, 1e-9),
+        "peak_rss": rss,
+        "peak_rss_above_baseline": rss - baseline_rss,
+        **extra,
+    }
+
+
+def run_scenario(
+    store: str,
+    count: int,
+    payload: str,
+    batch_size: int,
+    chunk_size: int,
+    workdir: Optional[str],
+) -> Dict[str, Any]:
+    """
+    Publish, drain and fill ``count`` messages through ``store``.
+    Runs in a process of its own.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    result: Dict[str, Any] = {
+        "store": store,
+        "messages": count,
+        "payload": payload,
+        "batch_size": batch_size,
+        "chunk_size": chunk_size,
+        "phases": {},
+    }
+    phases = result["phases"]
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        cfg = scenario_config(Path(tmp), store, batch_size)
+        # Named by the store, rather than its config file.
+        result["store"] = cfg.store_config.name
+        task_store = cfg.init_store()
+        if task_store.count_by_task():
+            raise RuntimeError(f"The {result['store']} store must start empty")
+
+        with Connection(cfg.rabbitmq.url()) as connection:
+            rng = random.Random(SEED)
+            metrics = Metrics()
+            publishing = draining = 0.0
+            baseline_rss = None
+            for start in range(0, count, chunk_size):
+                size = min(chunk_size, count - start)
+                started = time.perf_counter()
+                publish(connection, rng, start, size, payload)
+                publishing += time.perf_counter() - started
+                if baseline_rss is None:
+                    baseline_rss = peak_rss()
+
+                # Stops as soon as the chunk is drained, rather than once idle.
+                cfg.drain = replace(cfg.drain, max_messages=size)
+                started = time.perf_counter()
+                drained = drain(
+                    cfg,
+                    [QUEUE_NAME],
+                    MeteredTaskStore(task_store, metrics),
+                    None,
+                    metrics,
+                )
+                draining += time.perf_counter() - started
+                if drained[QUEUE_NAME] != size:
+                    raise RuntimeError(f"Drained {drained[QUEUE_NAME]} of {size} tasks")
+            result["baseline_rss"] = baseline_rss
+            phases["publish"] = phase(publishing, count, baseline_rss)
+            phases["drain"] = phase(
+                draining,
+                count,
+                baseline_rss,
+                bytes=metrics.counters["consumed_bytes"],
+                store_seconds=metrics.latency["save"].sum,
+                save_latency=metrics.latency["save"].to_dict(),
+            )
+            result["payload_bytes"] = metrics.counters["consumed_bytes"] / count
+
+            sink = Exchange(SINK_EXCHANGE, "direct", channel=connection.default_channel)
+            sink.declare()
+            metrics = Metrics()
+            started = time.perf_counter()
+            # fill prints a table of the tasks published.
+            with contextlib.redirect_stdout(io.StringIO()):
+                fill(
+                    cfg,
+                    SINK_EXCHANGE,
+                    MeteredTaskStore(task_store, metrics),
+                    metrics=metrics,
+                )
+            seconds = time.perf_counter() - started
+            phases["fill"] = phase(
+                seconds,
+                count,
+                baseline_rss,
+                bytes=metrics.counters["published_bytes"],
+                store_seconds=(
+                    metrics.latency["load"].sum + metrics.latency["delete"].sum
+                ),
+                load_latency=metrics.latency["load"].to_dict(),
+                delete_latency=metrics.latency["delete"].to_dict(),
+            )
+            if metrics.counters["published"] != count:
+                raise RuntimeError(
+                    f"Filled {metrics.counters['published']} of {count} tasks"
+                )
+    result["peak_rss"] = peak_rss()
+    return result
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def mib(size: float) -> str:
+    return f"{size / 1024 / 1024:.1f}"
+
+
+def above_baseline(result: Dict[str, Any]) -> int:
+    """
+    Peak RSS of drain or fill, whichever is greater, above the peak once the
+    first chunk was published.
+    """
+    return max(
+        result["phases"][name]["peak_rss_above_baseline"] for name in ("drain", "fill")
+    )
+
+
+def display(results: List[Dict[str, Any]]):
+    rows = []
+    for result in results:
+        phases = result["phases"]
+        rows.append(
+            [
+                result["store"],
+                result["payload"],
+                result["messages"],
+                f"{phases['publish']['messages_per_second']:.0f}",
+                f"{phases['drain']['messages_per_second']:.0f}",
+                f"{phases['fill']['messages_per_second']:.0f}",
+                mib(result["peak_rss"]),
+                mib(result["baseline_rss"]),
+                mib(phases["drain"]["peak_rss_above_baseline"]),
+                mib(phases["fill"]["peak_rss_above_baseline"]),
+            ]
+        )
+    termtables.print(
+        rows,
+        header=[
+            "Store",
+            "Payload",
+            "Messages",
+            "Publish/s",
+            "Drain/s",
+            "Fill/s",
+            "Peak RSS MiB",
+            "Published MiB",
+            "+Drain MiB",
+            "+Fill MiB",
+        ],
+    )
+
+
+@app.command()
+def run(
+    store: List[str] = typer.Option(
+        ["sqlite", "file"],
+        help=f"Store to benchmark: one of {', '.join(STORES)}, or a config file "
+        "whose [taskrabbit] store option and [store] section give the store, "
+        "e.g. for Postgres. Stores from config files must start empty.",
+    ),
+    sizes: List[int] = typer.Option(
+        DEFAULT_SIZES, "--sizes", min=1, help="Numbers of messages to benchmark."
+    ),
+    payload: List[str] = typer.Option(
+        list(PAYLOADS), help=f"Payloads to benchmark: {', '.join(PAYLOADS)}."
+    ),
+    batch_size: int = typer.Option(
+        DEFAULT_BATCH_SIZE, min=1, help="Tasks saved per store transaction."
+    ),
+    chunk_size: int = typer.Option(
+        DEFAULT_CHUNK_SIZE,
+        min=1,
+        help="Messages published, then drained, at a time. Bounds the memory "
+        "the in-memory broker uses.",
+    ),
+    workdir: Optional[Path] = typer.Option(
+        None, help="Directory for temporary stores. Defaults to the system's."
+    ),
+    output: Optional[Path] = typer.Option(
+        None, help="File to write results to. Defaults to benchmarks/results/."
+    ),
+):
+    """
+    Benchmark drain and fill across stores, message counts and payloads.
+    """
+    for name in payload:
+        if name not in PAYLOADS:
+            raise typer.BadParameter(f"Unknown payload: {name}")
+    for name in store:
+        if name not in STORES and not Path(name).is_file():
+            raise typer.BadParameter(f"Unknown store, or missing config file: {name}")
+    if output is None:
+        output = RESULTS_DIR / f"taskrabbit-{__version__}.json"
+
+    results = []
+    for store_name in store:
+        for size in sizes:
+            for payload_name in payload:
+                typer.echo(f"{store_name}, {size} messages, {payload_name} payload")
+                # A new process for each scenario, so its peak RSS is its own.
+                with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                    result = pool.submit(
+                        run_scenario,
+                        store_name,
+                        size,
+                        payload_name,
+                        batch_size,
+                        chunk_size,
+                        workdir and str(workdir),
+                    ).result()
+                results.append(result)
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    report = {
+        "taskrabbit": __version__,
+        "revision": git_revision(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "kombu": kombu.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output.write_text(json.dumps(report, indent=2))
+    display(results)
+    typer.echo(f"Wrote results to {output}")
+
+
+@app.command()
+def compare(
+    baseline: Path = typer.Argument(..., exists=True, readable=True),
+    current: Path = typer.Argument(..., exists=True, readable=True),
+):
+    """
+    Compare the throughput of two benchmark runs, scenario by scenario.
+    """
+    reports = [json.loads(path.read_text()) for path in (baseline, current)]
+
+    def key(result):
+        return result["store"], result["payload"], result["messages"]
+
+    before = {key(result): result for result in reports[0]["results"]}
+    rows = []
+    for result in reports[1]["results"]:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        row = list(key(result))
+        for name in ("drain", "fill"):
+            was = old["phases"][name]["messages_per_second"]
+            now = result["phases"][name]["messages_per_second"]
+            row.append(f"{now:.0f} ({(now - was) / was:+.1%})")
+        was, now = old["peak_rss"], result["peak_rss"]
+        row.append(f"{mib(now)} ({(now - was) / was:+.1%})")
+        # Old results don't record RSS above the baseline.
+        if "peak_rss_above_baseline" in old["phases"]["drain"]:
+            was, now = above_baseline(old), above_baseline(result)
+            row.append(f"{mib(now)} ({(now - was) / 1024 / 1024:+.1f})")
+        else:
+            row.append(mib(above_baseline(result)))
+        rows.append(row)
+    if not rows:
+        typer.echo("No scenarios in common.")
+        return
+    typer.echo(f"{reports[0]['taskrabbit']} -> {reports[1]['taskrabbit']}")
+    termtables.print(
+        rows,
+        header=[
+            "Store",
+            "Payload",
+            "Messages",
+            "Drain/s",
+            "Fill/s",
+            "Peak RSS MiB",
+            "+Drain/fill MiB",
+        ],
+    )
+
+
+if __name__ == "__main__":
+    app()
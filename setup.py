@@ -9,7 +9,7 @@ assert sys.version_info >= (3, 6, 0), "taskrabbit requires Python 3.6+"
 PROJECT_DIR = Path(__file__).parent
 sys.path.insert(0, str(PROJECT_DIR))
 
-EXTENSIONS = ["postgres"]
+EXTENSIONS = ["async", "msgpack", "orjson", "postgres", "zstd"]
 
 
 def get_long_description() -> str:
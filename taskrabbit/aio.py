@@ -0,0 +1,341 @@
+"""
+asyncio implementations of drain and fill, selected with ``--engine async``.
+
+AMQP I/O runs on the event loop using aio-pika, and the task store runs in a
+worker thread through AsyncTaskStore, so consuming, publishing, and store
+writes overlap.
+
+Requires the ``async`` extra: ``pip install taskrabbit[async]``.
+"""
+import asyncio
+import json
+import logging
+import time
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Set, Union
+
+import aio_pika
+from aio_pika.exceptions import ChannelNotFoundEntity, DeliveryError
+from kombu.serialization import loads
+
+from . import config
+from .metrics import Metrics
+from .operations import AdaptivePrefetch, DrainLimit, TaskCounter, Throttle
+from .stores.aio import AsyncTaskStore
+from .stores.base import StoredTask, TaskStore
+from .stores.batch import TaskBatch
+
+
+def task_from_message(
+    message: aio_pika.abc.AbstractIncomingMessage, passthrough: bool = False
+) -> StoredTask:
+    """
+    Instantiate a StoredTask from an aio-pika message.
+    """
+    if passthrough:
+        return StoredTask(
+            body=message.body,
+            headers=message.headers,
+            routing_key=message.routing_key,
+            content_type=message.content_type,
+            content_encoding=message.content_encoding,
+        )
+    return StoredTask(
+        body=loads(message.body, message.content_type, message.content_encoding),
+        headers=message.headers,
+        routing_key=message.routing_key,
+    )
+
+
+def message_from_task(task: StoredTask) -> aio_pika.Message:
+    """
+    Build a persistent message, as kombu's Producer does. A raw body is sent
+    as it is, otherwise the body is serialized as JSON.
+    """
+    if task.is_raw:
+        return aio_pika.Message(
+            task.body,
+            headers=task.headers,
+            content_type=task.content_type,
+            content_encoding=task.content_encoding,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        )
+    return aio_pika.Message(
+        json.dumps(task.body).encode("utf-8"),
+        headers=task.headers,
+        content_type="application/json",
+        content_encoding="utf-8",
+        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+    )
+
+
+async def drain(
+    cfg: config.Config,
+    queue_names: Union[str, Iterable[str]],
+    store: TaskStore,
+    snapshot: Optional[Dict[str, int]] = None,
+    metrics: Optional[Metrics] = None,
+) -> TaskCounter:
+    """
+    Drain tasks from one or more queues into the store.
+
+    Returns the number of tasks drained from each queue. ``snapshot`` is
+    as for :func:`taskrabbit.operations.drain`.
+    """
+    if isinstance(queue_names, str):
+        queue_names = [queue_names]
+    if metrics is None:
+        metrics = Metrics()
+    queue_names = list(queue_names)
+    logging.info("Draining queues: %s", ", ".join(queue_names))
+
+    counter = TaskCounter()
+    astore = AsyncTaskStore(store)
+    # Batches are written through astore, not TaskBatch.flush,
+    # so the store argument is unused.
+    batch = TaskBatch(
+        store, size=cfg.drain.batch_size, interval=cfg.drain.flush_interval
+    )
+    received: asyncio.Queue = asyncio.Queue()
+    prefetch = None
+    if cfg.drain.adaptive_prefetch:
+        prefetch = AdaptivePrefetch(
+            batch.size,
+            cfg.rabbitmq.consumer_prefetch_count,
+            cfg.drain.max_prefetch_count,
+        )
+
+    async def on_message(queue_name: str, message):
+        received.put_nowait((queue_name, message))
+
+    async def flush():
+        if not batch:
+            return
+        last_message = batch.items[-1][1]
+        started = time.monotonic()
+        try:
+            await astore.bulk_save(batch.tasks)
+        except Exception:
+            items = batch.clear()
+            logging.exception("Could not save %d tasks, requeueing", len(items))
+            await last_message.nack(multiple=True, requeue=True)
+            metrics.count("requeued", len(items))
+            raise
+        if prefetch is not None and batch.full:
+            prefetch.wrote(len(batch), time.monotonic() - started)
+        items = batch.clear()
+        await last_message.ack(multiple=True)
+        counter.update(queue_name for queue_name, _ in items)
+
+    async def set_prefetch(channel: aio_pika.abc.AbstractChannel, count: int):
+        started = time.monotonic()
+        # Global, so it applies to the channel's existing consumers too,
+        # and the window is shared by all of them.
+        await channel.set_qos(
+            prefetch_count=limit.prefetch_count(None, count), global_=True
+        )
+        prefetch.round_tripped(time.monotonic() - started)
+
+    try:
+        connection = await aio_pika.connect(cfg.rabbitmq.url())
+        async with connection:
+            channel = await connection.channel()
+            queues = {}
+            for queue_name in queue_names:
+                # Same queue options as kombu's Queue defaults.
+                queues[queue_name] = await channel.declare_queue(
+                    queue_name, durable=True
+                )
+            if cfg.drain.snapshot and snapshot is None:
+                snapshot = {
+                    name: queue.declaration_result.message_count
+                    for name, queue in queues.items()
+                }
+                logging.info(
+                    "Draining at most: %s",
+                    ", ".join(f"{name} ({count})" for name, count in snapshot.items()),
+                )
+            limit = DrainLimit(cfg.drain, snapshot)
+            if prefetch is not None:
+                await set_prefetch(channel, prefetch.count)
+            consumer_tags = {}
+            for queue_name, queue in queues.items():
+                if limit.queue_done(queue_name):
+                    continue
+                if prefetch is None:
+                    # Applies to consumers created on the channel from now on.
+                    await channel.set_qos(
+                        prefetch_count=limit.prefetch_count(
+                            queue_name,
+                            max(cfg.rabbitmq.consumer_prefetch_count, batch.size),
+                        )
+                    )
+                consumer_tags[queue_name] = await queue.consume(
+                    partial(on_message, queue_name)
+                )
+
+            while consumer_tags and not limit.reached:
+                if batch:
+                    timeout = max(batch.started + batch.interval - time.monotonic(), 0)
+                else:
+                    timeout = cfg.drain.idle_timeout
+                try:
+                    queue_name, message = await asyncio.wait_for(
+                        received.get(), limit.timeout(timeout)
+                    )
+                except asyncio.TimeoutError:
+                    if not batch:
+                        break
+                    await flush()
+                    continue
+                metrics.count("consumed")
+                metrics.count("consumed_bytes", len(message.body))
+                if not limit.take(queue_name):
+                    await message.nack(requeue=True)
+                    metrics.count("requeued")
+                    continue
+                if limit.queue_done(queue_name) and queue_name in consumer_tags:
+                    # Stop the broker delivering more messages from the queue.
+                    await queues[queue_name].cancel(consumer_tags.pop(queue_name))
+                task = task_from_message(message, cfg.drain.passthrough)
+                logging.debug("Received task: %s", task)
+                batch.add(task, (queue_name, message))
+                if batch.due:
+                    await flush()
+                if prefetch is not None:
+                    count = prefetch.resize()
+                    if count is not None:
+                        await set_prefetch(channel, count)
+            await flush()
+    finally:
+        astore.close()
+    return counter
+
+
+async def queue_depths(
+    connection: aio_pika.abc.AbstractConnection, queue_names: Iterable[str]
+) -> Dict[str, Optional[int]]:
+    """
+    Get the number of messages in each queue, with a passive declare,
+    or None for queues which don't exist.
+    """
+    depths = {}
+    for name in queue_names:
+        # The broker closes the channel if the queue doesn't exist,
+        # so use a new one for each queue.
+        channel = await connection.channel()
+        try:
+            queue = await channel.declare_queue(name, passive=True)
+            depths[name] = queue.declaration_result.message_count
+        except ChannelNotFoundEntity:
+            depths[name] = None
+        finally:
+            if not channel.is_closed:
+                await channel.close()
+    return depths
+
+
+async def fill(
+    cfg: config.Config,
+    exchange_name: str,
+    store: TaskStore,
+    task_name: Optional[str] = None,
+    delete: bool = True,
+    queue_names: Optional[List[str]] = None,
+    metrics: Optional[Metrics] = None,
+) -> None:
+    """
+    Publish stored tasks to an exchange. See :func:`taskrabbit.operations.fill`.
+    """
+    # Don't publish to system exchanges
+    if exchange_name.startswith("amq"):
+        raise ValueError(f"Cannot publish to system exchange: {exchange_name}")
+    if metrics is None:
+        metrics = Metrics()
+
+    throttle = Throttle(cfg.fill.rate, cfg.fill.max_queue_depth)
+    routing_keys = set()
+    counter = TaskCounter()
+    astore = AsyncTaskStore(store)
+    # Published (and, in publisher confirm mode, confirmed) tasks
+    # awaiting deletion from the store.
+    published: List[StoredTask] = []
+    nacked = 0
+
+    async def delete_published():
+        nonlocal published
+        tasks, published = published, []
+        if delete and tasks:
+            await astore.delete_many(tasks)
+
+    try:
+        connection = await aio_pika.connect(cfg.rabbitmq.url())
+        async with connection:
+            channel = await connection.channel(
+                publisher_confirms=cfg.fill.publisher_confirms
+            )
+            try:
+                if exchange_name:
+                    # Fails if the exchange doesn't already exist.
+                    exchange = await channel.get_exchange(exchange_name, ensure=True)
+                else:
+                    exchange = channel.default_exchange
+            except ChannelNotFoundEntity as ex:
+                logging.error(str(ex))
+                return
+            logging.debug("Established connection")
+
+            window = asyncio.Semaphore(cfg.fill.confirm_window)
+            in_flight: Set[asyncio.Task] = set()
+
+            async def publish(task: StoredTask):
+                nonlocal nacked
+                message = message_from_task(task)
+                try:
+                    # With publisher confirms, this waits for the broker's ack.
+                    await exchange.publish(
+                        message,
+                        routing_key=task.routing_key,
+                        mandatory=False,
+                    )
+                except DeliveryError:
+                    nacked += 1
+                    logging.error("Broker rejected task ID: %s", task.id)
+                    return
+                finally:
+                    window.release()
+                metrics.count("published")
+                metrics.count("published_bytes", len(message.body))
+                published.append(task)
+                if len(published) >= cfg.fill.delete_batch_size:
+                    await delete_published()
+
+            async for task in astore.load_tasks(task_name, cfg.fill.page_size):
+                counter.update([task.task])
+                routing_keys.add(task.routing_key)
+                if throttle.depth_check_due:
+                    while throttle.too_deep(
+                        await queue_depths(
+                            connection, queue_names or sorted(routing_keys)
+                        )
+                    ):
+                        await asyncio.sleep(throttle.interval)
+                delay = throttle.rate_delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                logging.debug("Publishing task ID: %s", task.id)
+                await window.acquire()
+                publishing = asyncio.ensure_future(publish(task))
+                throttle.published()
+                in_flight.add(publishing)
+                publishing.add_done_callback(in_flight.discard)
+            await asyncio.gather(*in_flight)
+        if nacked:
+            logging.error(
+                "%d tasks were rejected by the broker, and were kept in the store.",
+                nacked,
+            )
+        counter.display()
+    finally:
+        await delete_published()
+        astore.close()
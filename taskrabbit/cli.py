@@ -1,23 +1,106 @@
+import fnmatch
 import logging
+import re
+from contextlib import contextmanager
+from dataclasses import replace
 from enum import Enum
+from itertools import islice
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, List, Optional
 
 import typer
 
 from taskrabbit import __version__
 
-from .config import Config, ConfigurationError, merge_config_files_and_options
-from .operations import drain, fill, list_
+from .config import (
+    Config,
+    ConfigurationError,
+    init_store_from_file,
+    merge_config_files_and_options,
+)
+from . import profiling
+from .metrics import MeteredTaskStore, Metrics, Reporter, TracedTaskStore, write_json
+from .serialization import get_codec, train_dictionary
+from .stores import transfer
 from .utils import green, pluralize, red
 
 HOME_CONFIG_PATH = Path.home() / ".taskrabbit.ini"
 
+# Defaults for training zstd dictionaries. 110 KiB is zstd's own default size.
+DEFAULT_DICTIONARY_SAMPLES = 10000
+DEFAULT_DICTIONARY_SIZE = 110 * 1024
+
 app = typer.Typer()
 store_app = typer.Typer(short_help="Interact with stored tasks.")
 app.add_typer(store_app, name="store")
 
 
+def override(cfg, **options):
+    """
+    Return a copy of a config dataclass, with any options
+    given on the command line replacing configured values.
+    """
+    return replace(cfg, **{k: v for k, v in options.items() if v is not None})
+
+
+class Engines(str, Enum):
+    sync = "sync"
+    async_ = "async"
+
+
+def load_async_engine():
+    """
+    Import the asyncio engine, which needs the optional aio-pika dependency.
+    """
+    try:
+        from . import aio
+    except ImportError as exc:
+        raise typer.BadParameter(
+            f"The async engine requires taskrabbit[async] to be installed ({exc})"
+        ) from exc
+    return aio
+
+
+@contextmanager
+def collect_metrics(cfg: Config, workers: bool = False) -> Iterator[Optional[Metrics]]:
+    """
+    Collect metrics while a command runs, if the [metrics] config section or
+    command line options ask for any, otherwise yield None. The JSON summary
+    is written once the command ends, even if it fails.
+
+    Drain workers report their own metrics while they run, so with
+    ``workers``, only a summary of all of them is logged at the end.
+    """
+    if not cfg.metrics.enabled:
+        yield None
+        return
+    metrics = Metrics()
+    if workers:
+        reporter = Reporter(metrics)
+    else:
+        reporter = Reporter(metrics, cfg.metrics.log_interval, cfg.metrics.textfile)
+    try:
+        with reporter:
+            yield metrics
+        if workers and cfg.metrics.log_interval is not None:
+            logging.info("Metrics: %s", metrics.summary())
+    finally:
+        if cfg.metrics.stats_json is not None:
+            write_json(metrics, cfg.metrics.stats_json)
+
+
+def instrument_store(store, metrics: Optional[Metrics] = None):
+    """
+    Wrap a store to time its calls, if metrics are being collected,
+    or phases traced.
+    """
+    if profiling.tracing():
+        store = TracedTaskStore(store)
+    if metrics is not None:
+        store = MeteredTaskStore(store, metrics)
+    return store
+
+
 class LogLevels(str, Enum):
     debug = "debug"
     info = "info"
@@ -35,31 +118,255 @@ def de_duplicate(ctx: typer.Context):
     if not confirmed:
         raise typer.Abort()
     cfg = ctx.meta["config"]
-    store = cfg.init_store()
-    try:
-        count = store.dedupe()
-    except NotImplementedError:
-        typer.echo(
-            red(f"{store.__class__.__name__} does not support task de-duplication."),
-        )
-        raise typer.Exit(code=1)
+    count = instrument_store(cfg.init_store()).dedupe()
     # count_display = typer.style(str(count), fg=typer.colors.GREEN)
     typer.echo(
         f"Removed {green(count)} duplicate task{pluralize(count)} from the store."
     )
 
 
+@store_app.command("train-dictionary")
+def train_dictionary_command(
+    ctx: typer.Context,
+    output: Path = typer.Argument(..., help="File to write the dictionary to."),
+    samples: int = typer.Option(
+        DEFAULT_DICTIONARY_SAMPLES, min=1, help="Number of stored tasks to sample."
+    ),
+    size: int = typer.Option(
+        DEFAULT_DICTIONARY_SIZE, min=256, help="Maximum dictionary size in bytes."
+    ),
+) -> None:
+    """
+    Train a zstd compression dictionary from stored tasks.
+
+    Use it by setting compression = zstd and compression_dictionary
+    in the [store] config section.
+    """
+    cfg = ctx.meta["config"]
+    store = cfg.init_store()
+    # Train on records as the codec writes them, before compression.
+    codec = get_codec(cfg.store_config.codec)
+    records = [task.encode(codec) for task in islice(store.load_tasks(), samples)]
+    try:
+        dictionary = train_dictionary(records, size)
+    except ValueError as exc:
+        raise typer.BadParameter(f"Could not train a dictionary: {exc}") from exc
+    output.write_bytes(dictionary)
+    typer.echo(
+        f"Wrote a {green(len(dictionary))} byte dictionary, "
+        f"trained from {green(len(records))} task{pluralize(len(records))}."
+    )
+
+
+@store_app.command("copy")
+def copy_command(
+    ctx: typer.Context,
+    to: Path = typer.Option(
+        ...,
+        exists=True,
+        readable=True,
+        help="Config file of the store to copy tasks to. Only its [taskrabbit] "
+        "store option and [store] section are used.",
+    ),
+    task: Optional[str] = typer.Option(None, help="Copy only tasks with this name."),
+    batch_size: int = typer.Option(
+        transfer.DEFAULT_BATCH_SIZE, min=1, help="Save this many tasks at a time."
+    ),
+) -> None:
+    """
+    Copy stored tasks to another store.
+    """
+    cfg = ctx.meta["config"]
+    try:
+        target = init_store_from_file(to)
+    except ConfigurationError as exc:
+        raise typer.BadParameter(str(exc)) from exc
+    with collect_metrics(cfg) as metrics:
+        count = transfer.copy_tasks(
+            instrument_store(cfg.init_store(), metrics),
+            instrument_store(target, metrics),
+            task,
+            batch_size,
+        )
+    typer.echo(f"Copied {green(count)} task{pluralize(count)}.")
+
+
+@store_app.command("export")
+def export_command(
+    ctx: typer.Context,
+    output: Path = typer.Argument(
+        ...,
+        help="Archive to write. Compressed if its name ends with .gz, .xz or .zst.",
+    ),
+    task: Optional[str] = typer.Option(None, help="Export only tasks with this name."),
+) -> None:
+    """
+    Export stored tasks to an archive, with one JSON task per line.
+    """
+    cfg = ctx.meta["config"]
+    try:
+        with collect_metrics(cfg) as metrics:
+            count = transfer.export_tasks(
+                instrument_store(cfg.init_store(), metrics), output, task
+            )
+    except ValueError as exc:
+        raise typer.BadParameter(str(exc)) from exc
+    typer.echo(f"Exported {green(count)} task{pluralize(count)} to {output}.")
+
+
+@store_app.command("import")
+def import_command(
+    ctx: typer.Context,
+    archive: Path = typer.Argument(
+        ..., exists=True, readable=True, help="Archive written by store export."
+    ),
+    batch_size: int = typer.Option(
+        transfer.DEFAULT_BATCH_SIZE, min=1, help="Save this many tasks at a time."
+    ),
+) -> None:
+    """
+    Import tasks from an archive written by store export.
+    """
+    cfg = ctx.meta["config"]
+    try:
+        with collect_metrics(cfg) as metrics:
+            count = transfer.import_tasks(
+                instrument_store(cfg.init_store(), metrics), archive, batch_size
+            )
+    except ValueError as exc:
+        raise typer.BadParameter(str(exc)) from exc
+    typer.echo(f"Imported {green(count)} task{pluralize(count)}.")
+
+
 @app.command("drain")
 def drain_command(
     ctx: typer.Context,
-    queue: str = typer.Argument(..., help="Queue to drain tasks from."),
+    queues: Optional[List[str]] = typer.Argument(
+        None, help="Queues to drain tasks from.", show_default=False
+    ),
+    match: Optional[str] = typer.Option(
+        None, help="Also drain every queue whose name matches this glob pattern."
+    ),
+    regex: bool = typer.Option(
+        False, "--regex", help="Treat the --match pattern as a regular expression."
+    ),
+    exchange: Optional[str] = typer.Option(
+        None, help="Also drain every queue bound to this exchange."
+    ),
+    batch_size: Optional[int] = typer.Option(
+        None, min=1, help="Save this many tasks per store transaction."
+    ),
+    flush_interval: Optional[float] = typer.Option(
+        None, help="Save a partial batch after this many seconds."
+    ),
+    passthrough: Optional[bool] = typer.Option(
+        None,
+        "--passthrough/--no-passthrough",
+        help="Store message bodies as received, without deserializing them.",
+        show_default=False,
+    ),
+    idle_timeout: Optional[float] = typer.Option(
+        None, help="Stop once no message has been received for this many seconds."
+    ),
+    max_messages: Optional[int] = typer.Option(
+        None, min=1, help="Stop after draining this many messages."
+    ),
+    max_duration: Optional[float] = typer.Option(
+        None, help="Stop after draining for this many seconds."
+    ),
+    snapshot: Optional[bool] = typer.Option(
+        None,
+        "--snapshot/--no-snapshot",
+        help="Only drain as many messages as each queue holds when draining starts.",
+        show_default=False,
+    ),
+    adaptive_prefetch: Optional[bool] = typer.Option(
+        None,
+        "--adaptive-prefetch/--no-adaptive-prefetch",
+        help="Resize the prefetch window to match how fast the store writes.",
+        show_default=False,
+    ),
+    max_prefetch_count: Optional[int] = typer.Option(
+        None, min=1, help="Largest prefetch window adaptive prefetch may use."
+    ),
+    workers: int = typer.Option(
+        1,
+        min=1,
+        help="Drain with this many processes, each writing to its own shard "
+        "of the store.",
+    ),
+    engine: Engines = typer.Option(Engines.sync, help="Drain engine to use."),
 ) -> None:
     """
-    Drain tasks from the queue.
+    Drain tasks from one or more queues.
+
+    Queues may be named, or looked up with the RabbitMQ management API
+    using --match or --exchange.
     """
+    # Imported by the commands which use them, as kombu and asyncio are slow
+    # to import, to keep every other command starting quickly.
+    import asyncio
+
+    from .listing import list_
+    from .operations import drain, drain_in_workers, list_queues
+
     cfg = ctx.meta["config"]
-    store = cfg.init_store()
-    drain(cfg, queue, store)
+    try:
+        cfg.drain = override(
+            cfg.drain,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            passthrough=passthrough,
+            idle_timeout=idle_timeout,
+            max_messages=max_messages,
+            max_duration=max_duration,
+            snapshot=snapshot,
+            adaptive_prefetch=adaptive_prefetch,
+            max_prefetch_count=max_prefetch_count,
+        )
+    except ConfigurationError as exc:
+        raise typer.BadParameter(str(exc)) from exc
+    queue_names = list(queues or [])
+    if match is not None or exchange is not None:
+        try:
+            found = list_queues(cfg, exchange)
+        except OSError as exc:
+            raise typer.BadParameter(f"Could not list queues: {exc}") from exc
+        if match is not None:
+            if regex:
+                pattern = re.compile(match)
+                found = [name for name in found if pattern.search(name)]
+            else:
+                found = fnmatch.filter(found, match)
+        queue_names.extend(name for name in found if name not in queue_names)
+    if not queue_names:
+        raise typer.BadParameter("No queues to drain.")
+    store_cfg = cfg.store_config
+    if workers > store_cfg.shards and store_cfg.shard_field is not None:
+        raise typer.BadParameter(
+            f"Each worker needs its own shard of the store. "
+            f"Set shards = {workers} in the [store] config section."
+        )
+    if engine == Engines.async_:
+        aio = load_async_engine()
+    if workers > 1:
+        with collect_metrics(cfg, workers=True) as metrics:
+            counts = drain_in_workers(cfg, queue_names, workers, engine.value, metrics)
+        # Opened once the workers are done, as some stores only read
+        # what's already written when they're opened.
+        store = cfg.init_store()
+    else:
+        with collect_metrics(cfg) as metrics:
+            store = instrument_store(cfg.init_store(), metrics)
+            if engine == Engines.async_:
+                counts = asyncio.run(
+                    aio.drain(cfg, queue_names, store, metrics=metrics)
+                )
+            else:
+                counts = drain(cfg, queue_names, store, metrics=metrics)
+    if len(queue_names) > 1:
+        print("Drained tasks:")
+        counts.display(header=["Queue", "Count"])
     print("Stored tasks:")
     list_(store, counts=True)
 
@@ -73,10 +380,43 @@ def fill_command(
     ),
     delete: bool = typer.Option(True, help="Delete tasks from store after publishing."),
     confirm: bool = typer.Option(True, help="Confirm exchange before publishing"),
+    publisher_confirms: Optional[bool] = typer.Option(
+        None,
+        "--publisher-confirms/--no-publisher-confirms",
+        help="Only delete tasks from the store once the broker confirms them.",
+        show_default=False,
+    ),
+    confirm_window: Optional[int] = typer.Option(
+        None, min=1, help="Maximum number of tasks awaiting a publisher confirm."
+    ),
+    delete_batch_size: Optional[int] = typer.Option(
+        None, min=1, help="Delete confirmed tasks from the store in batches this size."
+    ),
+    page_size: Optional[int] = typer.Option(
+        None, min=1, help="Load tasks from the store in pages this size."
+    ),
+    rate: Optional[str] = typer.Option(
+        None, help="Publish at most this many tasks per second, or e.g. 600/m."
+    ),
+    max_queue_depth: Optional[int] = typer.Option(
+        None,
+        min=0,
+        help="Pause publishing while a destination queue has more messages.",
+    ),
+    watch_queue: Optional[List[str]] = typer.Option(
+        None,
+        help="Queue to check the depth of. Defaults to the queues bound to the "
+        "exchange, or the tasks' routing keys for the default exchange.",
+        show_default=False,
+    ),
+    engine: Engines = typer.Option(Engines.sync, help="Fill engine to use."),
 ) -> None:
     """
     Publish tasks to an exchange.
     """
+    import asyncio
+
+    from .operations import fill, list_queues
 
     # Confirm exhange
     exchange_display = exchange if exchange else "default"
@@ -85,8 +425,43 @@ def fill_command(
         if not confirmed:
             raise typer.Abort()
     cfg = ctx.meta["config"]
-    store = cfg.init_store()
-    fill(cfg, exchange, store, task_name, delete)
+    try:
+        cfg.fill = override(
+            cfg.fill,
+            publisher_confirms=publisher_confirms,
+            confirm_window=confirm_window,
+            delete_batch_size=delete_batch_size,
+            page_size=page_size,
+            rate=rate,
+            max_queue_depth=max_queue_depth,
+        )
+    except ConfigurationError as exc:
+        raise typer.BadParameter(str(exc)) from exc
+    queue_names = list(watch_queue or []) or None
+    if cfg.fill.max_queue_depth is not None and exchange and queue_names is None:
+        try:
+            queue_names = list_queues(cfg, exchange)
+        except OSError as exc:
+            raise typer.BadParameter(
+                f"Could not list queues bound to {exchange}: {exc}. "
+                "Name queues to check with --watch-queue."
+            ) from exc
+        if not queue_names:
+            # Routing keys only name queues on the default exchange.
+            raise typer.BadParameter(
+                f"No queues are bound to {exchange}, so there are none to check "
+                "the depth of. Name queues to check with --watch-queue."
+            )
+    if engine == Engines.async_:
+        aio = load_async_engine()
+    with collect_metrics(cfg) as metrics:
+        store = instrument_store(cfg.init_store(), metrics)
+        if engine == Engines.async_:
+            asyncio.run(
+                aio.fill(cfg, exchange, store, task_name, delete, queue_names, metrics)
+            )
+        else:
+            fill(cfg, exchange, store, task_name, delete, queue_names, metrics)
 
 
 @store_app.command("list")
@@ -97,13 +472,21 @@ def list_command(
     ),
     task: Optional[str] = typer.Option(None, help="List only tasks with this name."),
     limit: Optional[int] = typer.Option(None, help="Limit number of tasks shown"),
+    after: Optional[str] = typer.Option(
+        None,
+        help="Only show tasks with IDs after this one, in order of ID. "
+        "Pass the last ID shown to see the next page.",
+    ),
 ) -> None:
     """
     Show retrieved tasks.
     """
+    from .listing import list_
+
     cfg = ctx.meta["config"]
-    store = cfg.init_store()
-    list_(store, counts=counts, task_name=task, limit=limit)
+    with collect_metrics(cfg) as metrics:
+        store = instrument_store(cfg.init_store(), metrics)
+        list_(store, counts=counts, task_name=task, limit=limit, after=after)
 
 
 def show_version(value: bool):
@@ -138,6 +521,26 @@ def main(
         callback=check_config,
     ),
     log_level: LogLevels = typer.Option(LogLevels.info, case_sensitive=False),
+    profile: Optional[Path] = typer.Option(
+        None, help="Profile the command with cProfile, writing stats to this file."
+    ),
+    trace_phases: bool = typer.Option(
+        False,
+        "--trace-phases",
+        help="Show the time spent in each phase of the command, and its peak "
+        "memory use, once it ends.",
+    ),
+    stats_interval: Optional[float] = typer.Option(
+        None, help="Log throughput and store latency every this many seconds."
+    ),
+    stats_json: Optional[Path] = typer.Option(
+        None, help="Write a JSON summary of metrics to this file at the end."
+    ),
+    metrics_textfile: Optional[Path] = typer.Option(
+        None,
+        help="Keep metrics in this file, in the Prometheus text format, "
+        "for the node exporter's textfile collector.",
+    ),
     version: Optional[bool] = typer.Option(
         None,
         "--version",
@@ -157,6 +560,12 @@ def main(
             *config_paths, taskrabbit={"log_level": log_level.upper()}
         )
         cfg = Config.from_config_dict(cfg_dict)
+        cfg.metrics = override(
+            cfg.metrics,
+            log_interval=stats_interval,
+            stats_json=stats_json and str(stats_json),
+            textfile=metrics_textfile and str(metrics_textfile),
+        )
         log_level = getattr(logging, cfg.log_level)
         logging.basicConfig(level=log_level)
         logging.debug("Loaded configuration: %s", cfg)
@@ -164,3 +573,9 @@ def main(
         ctx.meta["config"] = cfg
     except ConfigurationError as exc:
         raise typer.BadParameter(str(exc)) from exc
+    if profile is not None:
+        profiler = profiling.start_profile()
+        ctx.call_on_close(lambda: profiling.stop_profile(profiler, profile))
+    if trace_phases:
+        profiling.start_tracing()
+        ctx.call_on_close(lambda: typer.echo(profiling.stop_tracing(), err=True))
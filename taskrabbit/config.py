@@ -1,11 +1,14 @@
 import configparser
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields, replace
 from pathlib import Path
-from typing import Mapping
+from typing import Mapping, Optional, Tuple, Union, get_args, get_origin
+from urllib.parse import quote
 
+from taskrabbit.serialization import Codec, make_codec
 from taskrabbit.utils import import_string
 from taskrabbit.stores.base import TaskStore
+from taskrabbit.stores.sharded import ShardedTaskStore
 
 
 DEFAULT_LOG_LEVEL = "INFO"
@@ -14,6 +17,29 @@ DEFAULT_LOG_LEVEL = "INFO"
 # See https://docs.celeryproject.org/projects/kombu/en/stable/userguide/consumers.html#reference  # noqa
 DEFAULT_CONSUMER_PREFETCH_COUNT = 100
 
+# Number of drained tasks written to the store in a single transaction,
+# and the maximum number of seconds a partial batch is held before writing.
+DEFAULT_DRAIN_BATCH_SIZE = 1
+DEFAULT_DRAIN_FLUSH_INTERVAL = 1.0
+
+# Stop draining once no message has been received for this many seconds.
+DEFAULT_DRAIN_IDLE_TIMEOUT = 1.0
+
+# Largest prefetch window adaptive prefetch will grow to, which bounds
+# the number of received messages held in memory.
+DEFAULT_DRAIN_MAX_PREFETCH_COUNT = 10000
+
+# Size in bytes at which SegmentedFileTaskStore starts a new segment.
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Maximum number of published tasks awaiting a broker confirm, and the
+# number of confirmed tasks deleted from the store at a time.
+DEFAULT_FILL_CONFIRM_WINDOW = 1000
+DEFAULT_FILL_DELETE_BATCH_SIZE = 1000
+
+# Seconds in each unit a fill rate may be given in, e.g. "600/m".
+RATE_UNITS = {"s": 1, "m": 60, "h": 3600}
+
 
 DEFAULTS = {
     "taskrabbit": {"store": "sqlite", "log_level": "INFO"},
@@ -34,6 +60,68 @@ class ConfigurationError(Exception):
     pass
 
 
+def _coerce_fields(instance):
+    """
+    Cast string values read from an INI file to the annotated type of
+    each dataclass field. Works on frozen dataclasses.
+    """
+    for f in fields(instance):
+        value = getattr(instance, f.name)
+        field_type = f.type
+        if get_origin(field_type) is Union:
+            field_type = next(t for t in get_args(field_type) if t is not type(None))
+        if not isinstance(value, str) or field_type not in (int, float, bool):
+            continue
+        try:
+            if field_type is bool:
+                if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                    raise ValueError(value)
+                value = configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+            else:
+                value = field_type(value)
+        except ValueError as exc:
+            raise ConfigurationError(
+                f"{instance.__class__.__name__}.{f.name} must be "
+                f"{field_type.__name__}, got {value!r}"
+            ) from exc
+        object.__setattr__(instance, f.name, value)
+
+
+def parse_rate(rate: str) -> float:
+    """
+    Parse a rate given as a number per second, e.g. "100" or "100/s",
+    or per minute or hour, e.g. "600/m" or "3600/h".
+    """
+    number, _, unit = rate.partition("/")
+    if unit not in ("", *RATE_UNITS):
+        raise ValueError(f"Unknown rate unit {unit!r}, choose from: s, m, h")
+    return float(number) / RATE_UNITS.get(unit, 1)
+
+
+def numbered_path(path: str, index: int) -> str:
+    """
+    Add a number to a path, before its suffix if it has one.
+    """
+    p = Path(path)
+    if p.suffix:
+        return str(p.with_name(f"{p.stem}.{index}{p.suffix}"))
+    return str(p.with_name(f"{p.name}.{index}"))
+
+
+def _check_shards(instance):
+    if instance.shards < 1:
+        raise ConfigurationError(
+            f"{instance.__class__.__name__}.shards must be at least 1"
+        )
+
+
+def _check_codec(instance):
+    try:
+        instance.get_codec()
+    except (OSError, ValueError) as exc:
+        raise ConfigurationError(f"{instance.__class__.__name__}.codec: {exc}") from exc
+
+
 @dataclass(frozen=True)
 class RabbitMQConfig:
     username: str
@@ -42,6 +130,8 @@ class RabbitMQConfig:
     port: str = "5672"
     vhost: str = "/"
     consumer_prefetch_count: int = DEFAULT_CONSUMER_PREFETCH_COUNT
+    # Port of the RabbitMQ management plugin's HTTP API, used to list queues.
+    management_port: str = "15672"
 
     def url(self):
         return (
@@ -49,13 +139,191 @@ class RabbitMQConfig:
             f"{self.host}:{self.port}{self.vhost}"
         )
 
+    def management_url(self, resource: str, *path: str):
+        """
+        URL of a management API resource in this vhost,
+        e.g. ``management_url("exchanges", "tasks", "bindings", "source")``.
+        """
+        # vhost is stored as the path of the AMQP URL, so "/" is the
+        # default vhost and "/example" is the "example" vhost.
+        parts = [resource, self.vhost[1:] or "/", *path]
+        return f"http://{self.host}:{self.management_port}/api/" + "/".join(
+            quote(part, safe="") for part in parts
+        )
+
     def __post_init__(self):
+        _coerce_fields(self)
         if not self.vhost.startswith("/"):
             raise ValueError(f"{self.__class__.__name__}.vhost must have a leading /")
+        if self.consumer_prefetch_count < 1:
+            raise ConfigurationError(
+                f"{self.__class__.__name__}.consumer_prefetch_count must be at least 1"
+            )
 
 
 class StoreConfig:
     name: str
+    codec: str
+    compression: Optional[str]
+    compression_level: Optional[int]
+    compression_dictionary: Optional[str]
+    # Number of shards the store is split into. Stores which can be sharded
+    # have a field of this name, and name the field holding their path, which
+    # is different for each shard, in shard_field. Stores without one can be
+    # written by several drain workers at once, so have no need of shards.
+    shards = 1
+    shard_field: Optional[str] = None
+
+    def shard(self, index: int) -> "StoreConfig":
+        """
+        The config of one shard of the store. Shards are numbered from 0,
+        and the number is added to the path, e.g. shard 1 of "tasks.sqlite"
+        is "tasks.1.sqlite", and of "tasks" is "tasks.1".
+        """
+        path = numbered_path(getattr(self, self.shard_field), index)
+        return replace(self, **{self.shard_field: path}, shards=1)
+
+    def get_codec(self) -> Codec:
+        """
+        The codec, with any compression, that the store writes records with.
+        """
+        dictionary = None
+        if self.compression_dictionary is not None:
+            dictionary = Path(self.compression_dictionary).read_bytes()
+        return make_codec(
+            self.codec, self.compression, self.compression_level, dictionary
+        )
+
+
+@dataclass(frozen=True)
+class DrainConfig:
+    batch_size: int = DEFAULT_DRAIN_BATCH_SIZE
+    flush_interval: float = DEFAULT_DRAIN_FLUSH_INTERVAL
+    # Store message bodies as received, instead of deserializing them.
+    passthrough: bool = False
+    idle_timeout: float = DEFAULT_DRAIN_IDLE_TIMEOUT
+    # Stop after draining this many messages in all, or after this many seconds.
+    max_messages: Optional[int] = None
+    max_duration: Optional[float] = None
+    # Only drain as many messages as each queue held when draining started.
+    snapshot: bool = False
+    # Resize the prefetch window as draining goes, to keep the store busy
+    # without holding many more messages than that needs.
+    adaptive_prefetch: bool = False
+    max_prefetch_count: int = DEFAULT_DRAIN_MAX_PREFETCH_COUNT
+
+    def __post_init__(self):
+        _coerce_fields(self)
+        for name in ("batch_size", "max_messages", "max_prefetch_count"):
+            value = getattr(self, name)
+            if value is not None and value < 1:
+                raise ConfigurationError(
+                    f"{self.__class__.__name__}.{name} must be at least 1"
+                )
+        for name in ("idle_timeout", "max_duration"):
+            value = getattr(self, name)
+            if value is not None and value <= 0:
+                raise ConfigurationError(
+                    f"{self.__class__.__name__}.{name} must be positive"
+                )
+
+
+@dataclass(frozen=True)
+class FillConfig:
+    publisher_confirms: bool = False
+    confirm_window: int = DEFAULT_FILL_CONFIRM_WINDOW
+    delete_batch_size: int = DEFAULT_FILL_DELETE_BATCH_SIZE
+    # Load tasks from the store this many at a time, each page with a
+    # separate query, rather than all from one query.
+    page_size: Optional[int] = None
+    # Publish at most this many tasks per second. May be given as a string
+    # accepted by parse_rate.
+    rate: Optional[float] = None
+    # Pause publishing while a destination queue holds more messages.
+    max_queue_depth: Optional[int] = None
+
+    def __post_init__(self):
+        if isinstance(self.rate, str):
+            try:
+                object.__setattr__(self, "rate", parse_rate(self.rate))
+            except ValueError as exc:
+                raise ConfigurationError(
+                    f"{self.__class__.__name__}.rate: {exc}"
+                ) from exc
+        _coerce_fields(self)
+        for name in ("confirm_window", "delete_batch_size", "page_size"):
+            value = getattr(self, name)
+            if value is not None and value < 1:
+                raise ConfigurationError(
+                    f"{self.__class__.__name__}.{name} must be at least 1"
+                )
+        if self.rate is not None and self.rate <= 0:
+            raise ConfigurationError(f"{self.__class__.__name__}.rate must be positive")
+        if self.max_queue_depth is not None and self.max_queue_depth < 0:
+            raise ConfigurationError(
+                f"{self.__class__.__name__}.max_queue_depth must not be negative"
+            )
+
+
+@dataclass(frozen=True)
+class MetricsConfig:
+    # Log a summary of metrics every this many seconds.
+    log_interval: Optional[float] = None
+    # Keep metrics in this file, in the Prometheus text format, for the node
+    # exporter's textfile collector. Drain workers each write their own file,
+    # numbered like store shards.
+    textfile: Optional[str] = None
+    # Write a JSON summary of metrics to this file when the command ends.
+    stats_json: Optional[str] = None
+
+    def __post_init__(self):
+        _coerce_fields(self)
+        if self.log_interval is not None and self.log_interval <= 0:
+            raise ConfigurationError(
+                f"{self.__class__.__name__}.log_interval must be positive"
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return any(
+            value is not None
+            for value in (self.log_interval, self.textfile, self.stats_json)
+        )
+
+
+def _store_from_config_dict(cfg: Mapping) -> Tuple[type, StoreConfig]:
+    """
+    The store class and config from the [taskrabbit] and [store] sections.
+    """
+    store_cls = import_string(cfg["taskrabbit"]["store"])
+    store_config_cls = store_cls.config_class
+    if "store" in cfg:
+        store_cfg = store_config_cls(**cfg["store"])
+    else:
+        store_cfg = store_config_cls()
+    return store_cls, store_cfg
+
+
+def _init_store(store_cls: type, store_cfg: StoreConfig) -> TaskStore:
+    if store_cfg.shards > 1:
+        return ShardedTaskStore(
+            [store_cls(store_cfg.shard(index)) for index in range(store_cfg.shards)]
+        )
+    return store_cls(store_cfg)
+
+
+def init_store_from_file(path: Path) -> TaskStore:
+    """
+    Create the store configured by a config file, such as the store
+    to copy tasks to. Only the [taskrabbit] store option and the [store]
+    section are read.
+    """
+    cfg = configparser.ConfigParser()
+    if not cfg.read(path):
+        raise ConfigurationError(f"Could not read config file {path}")
+    if not cfg.has_option("taskrabbit", "store"):
+        raise ConfigurationError(f"{path} has no [taskrabbit] store option")
+    return _init_store(*_store_from_config_dict(cfg))
 
 
 @dataclass
@@ -64,34 +332,72 @@ class Config:
     log_level: str
     rabbitmq: RabbitMQConfig
     store_class: TaskStore
+    drain: DrainConfig = field(default_factory=DrainConfig)
+    fill: FillConfig = field(default_factory=FillConfig)
+    metrics: MetricsConfig = field(default_factory=MetricsConfig)
 
     @classmethod
     def from_config_dict(cls, cfg: Mapping):
-        store_path = cfg["taskrabbit"]["store"]
+        store_cls, store_cfg = _store_from_config_dict(cfg)
         del cfg["taskrabbit"]["store"]
-        store_cls = import_string(store_path)
-        store_config_cls = store_cls.config_class
-        if "store" in cfg:
-            store_cfg = store_config_cls(**cfg["store"])
-        else:
-            store_cfg = store_config_cls()
         rabbit_cfg = RabbitMQConfig(**cfg["rabbitmq"])
+        if "drain" in cfg:
+            drain_cfg = DrainConfig(**cfg["drain"])
+        else:
+            drain_cfg = DrainConfig()
+        if "fill" in cfg:
+            fill_cfg = FillConfig(**cfg["fill"])
+        else:
+            fill_cfg = FillConfig()
+        if "metrics" in cfg:
+            metrics_cfg = MetricsConfig(**cfg["metrics"])
+        else:
+            metrics_cfg = MetricsConfig()
         config = cls(
             rabbitmq=rabbit_cfg,
             store_config=store_cfg,
             store_class=store_cls,
+            drain=drain_cfg,
+            fill=fill_cfg,
+            metrics=metrics_cfg,
             **cfg["taskrabbit"],
         )
         return config
 
     def init_store(self):
-        return self.store_class(self.store_config)
+        return _init_store(self.store_class, self.store_config)
+
+    def init_shard(self, index: int) -> TaskStore:
+        """
+        The store drain worker ``index`` writes to. That's its own shard of a
+        sharded store, or the whole store if it can't be sharded.
+        """
+        if self.store_config.shard_field is None:
+            return self.store_class(self.store_config)
+        return self.store_class(self.store_config.shard(index))
 
 
 @dataclass(frozen=True)
 class SqliteConfig(StoreConfig):
     db: str = "tasks.sqlite"
+    codec: str = "json"
+    # Compress each record with "zlib" or "zstd". A zstd dictionary, made
+    # with `taskrabbit store train-dictionary`, greatly improves compression.
+    compression: Optional[str] = None
+    compression_level: Optional[int] = None
+    compression_dictionary: Optional[str] = None
+    # Skip saving tasks which duplicate a stored task.
+    dedupe_on_ingest: bool = False
+    # Split the store into this many databases, which drain --workers
+    # write to in parallel.
+    shards: int = 1
     name: str = "sqlite"
+    shard_field = "db"
+
+    def __post_init__(self):
+        _coerce_fields(self)
+        _check_codec(self)
+        _check_shards(self)
 
 
 @dataclass(frozen=True)
@@ -102,6 +408,18 @@ class PostgresConfig(StoreConfig):
     port: str
     db: str
     name: str = "postgres"
+    # Rows fetched per round trip when iterating over stored tasks.
+    itersize: int = 2000
+    codec: str = "json"
+    compression: Optional[str] = None
+    compression_level: Optional[int] = None
+    compression_dictionary: Optional[str] = None
+    # Skip saving tasks which duplicate a stored task.
+    dedupe_on_ingest: bool = False
+
+    def __post_init__(self):
+        _coerce_fields(self)
+        _check_codec(self)
 
     def get_dsn(self):
         return (
@@ -112,8 +430,49 @@ class PostgresConfig(StoreConfig):
 
 @dataclass(frozen=True)
 class FileConfig(StoreConfig):
-    name = "file"
-    directory = "tasks"
+    directory: str = "tasks"
+    # "flat" keeps every task file directly in `directory`. "sharded" spreads
+    # them over hashed subdirectories, and indexes task IDs by task name.
+    layout: str = "flat"
+    codec: str = "json"
+    compression: Optional[str] = None
+    compression_level: Optional[int] = None
+    compression_dictionary: Optional[str] = None
+    # Split the store into this many directories, which drain --workers
+    # write to in parallel. Unrelated to the sharded layout.
+    shards: int = 1
+    name: str = "file"
+    shard_field = "directory"
+
+    def __post_init__(self):
+        _coerce_fields(self)
+        _check_codec(self)
+        _check_shards(self)
+        if self.layout not in ("flat", "sharded"):
+            raise ConfigurationError(
+                f"{self.__class__.__name__}.layout must be 'flat' or 'sharded'"
+            )
+
+
+@dataclass(frozen=True)
+class SegmentedFileConfig(StoreConfig):
+    directory: str = "segments"
+    # Start a new segment once the current one is at least this many bytes.
+    segment_size: int = DEFAULT_SEGMENT_SIZE
+    codec: str = "json"
+    compression: Optional[str] = None
+    compression_level: Optional[int] = None
+    compression_dictionary: Optional[str] = None
+    # Split the store into this many directories, which drain --workers
+    # write to in parallel.
+    shards: int = 1
+    name: str = "segmented"
+    shard_field = "directory"
+
+    def __post_init__(self):
+        _coerce_fields(self)
+        _check_codec(self)
+        _check_shards(self)
 
 
 def _update_config(config, options):
@@ -0,0 +1,65 @@
+"""
+Show stored tasks.
+
+Kept apart from :mod:`taskrabbit.operations`, so listing tasks doesn't need
+to import kombu. termtables is imported only once there are tasks to show.
+"""
+from collections import Counter
+from typing import Iterable, Optional
+
+from .profiling import phase
+from .stores.base import StoredTask, TaskStore
+
+
+class TaskCounter(Counter):
+    def stream(self, tasks: Iterable[StoredTask]):
+        for task in tasks:
+            self.update([task.task])
+            yield task
+
+    def display(self, header=("Task", "Count")):
+        if self:
+            import termtables
+
+            termtables.print(self.most_common(), header=list(header))
+
+
+def list_(
+    store: TaskStore,
+    counts=False,
+    limit: Optional[int] = None,
+    task_name: Optional[str] = None,
+    after: Optional[str] = None,
+) -> None:
+    if counts and not limit and after is None:
+        counter = TaskCounter(store.count_by_task(task_name))
+        with phase("list.display"):
+            counter.display()
+        return
+    stream = store.load_tasks(task_name, limit=limit or None, after=after)
+    if counts:
+        counter = TaskCounter()
+        with phase("list.count"):
+            list(counter.stream(stream))
+        with phase("list.display"):
+            counter.display()
+    else:
+        items = []
+        with phase("list.collect"):
+            for task in stream:
+                items.append(
+                    (
+                        task.id,
+                        task.task,
+                        task.argsrepr,
+                        task.kwargsrepr,
+                        task.routing_key,
+                    )
+                )
+        if items:
+            import termtables
+
+            with phase("list.display"):
+                termtables.print(
+                    items, header=["ID", "Task", "Args", "Kwargs", "Routing Key"]
+                )
@@ -0,0 +1,422 @@
+"""
+Throughput and latency metrics for drain, fill and store operations.
+
+:class:`Metrics` counts messages consumed, published and requeued, and the
+bytes in their bodies, and keeps histograms of store call latencies and of
+the sizes of batches written to the store. Store calls are timed by wrapping
+the store in a :class:`MeteredTaskStore`, or, with ``--trace-phases``, in a
+:class:`TracedTaskStore`.
+
+While a command runs, a :class:`Reporter` can log a summary line, and write
+the metrics in the Prometheus text format for the node exporter's textfile
+collector, every few seconds. A JSON summary can be written once it ends.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence
+
+from .profiling import phase
+from .stores.base import StoredTask, TaskStore
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# Upper bounds of the batch size histogram buckets.
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Seconds between writes of the Prometheus textfile, without a log interval.
+DEFAULT_TEXTFILE_INTERVAL = 10.0
+
+COUNTERS = {
+    "consumed": "Messages consumed from queues.",
+    "consumed_bytes": "Bytes in the bodies of messages consumed.",
+    "requeued": "Messages put back on their queue.",
+    "published": "Messages published.",
+    "published_bytes": "Bytes in the bodies of messages published.",
+}
+STORE_OPERATIONS = ("save", "delete", "load")
+
+
+class Histogram:
+    """
+    Count observations in buckets with fixed upper bounds,
+    as a Prometheus histogram does.
+    """
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # The last count is of observations greater than every bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile, as the upper bound of the bucket it falls in.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def merge(self, data: Dict[str, Any]):
+        """
+        Add the observations of a histogram in the form of :meth:`to_dict`.
+        """
+        self.counts = [a + b for a, b in zip(self.counts, data["counts"])]
+        self.count += data["count"]
+        self.sum += data["sum"]
+        self.max = max(self.max, data["max"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "mean": self.mean,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """
+    Metrics collected by one process. ``labels`` are added to every metric
+    written in the Prometheus format, e.g. to tell drain workers apart.
+    """
+
+    def __init__(self, labels: Optional[Dict[str, str]] = None):
+        self.labels = labels or {}
+        self.started = time.monotonic()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.latency = {
+            operation: Histogram(LATENCY_BUCKETS) for operation in STORE_OPERATIONS
+        }
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    @contextmanager
+    def time(self, operation: str) -> Iterator[None]:
+        """
+        Time a store operation.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latency[operation].observe(time.perf_counter() - started)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def merge(self, data: Dict[str, Any]):
+        """
+        Add the metrics of another process, in the form of :meth:`to_dict`.
+        """
+        for name, value in data["counters"].items():
+            self.counters[name] += value
+        for operation, histogram in data["latency"].items():
+            self.latency[operation].merge(histogram)
+        self.batch_sizes.merge(data["batch_sizes"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        elapsed = self.elapsed
+        return {
+            "elapsed": elapsed,
+            "counters": dict(self.counters),
+            "rates": {
+                name: self.counters[name] / max(elapsed, 1e-9)
+                for name in ("consumed", "published")
+            },
+            "latency": {
+                operation: histogram.to_dict()
+                for operation, histogram in self.latency.items()
+            },
+            "batch_sizes": self.batch_sizes.to_dict(),
+        }
+
+    def summary(
+        self, previous: Optional[Dict[str, int]] = None, seconds: float = 0.0
+    ) -> str:
+        """
+        A one line summary of what's been counted so far. Rates are over the
+        last ``seconds``, since the ``previous`` counters were taken, if
+        they're given, otherwise since the start.
+        """
+        if previous is None:
+            previous, seconds = dict.fromkeys(COUNTERS, 0), self.elapsed
+        seconds = max(seconds, 1e-9)
+        parts = []
+        for name in ("consumed", "published"):
+            if self.counters[name]:
+                rate = (self.counters[name] - previous[name]) / seconds
+                size = self.counters[f"{name}_bytes"] / 1024 / 1024
+                parts.append(
+                    f"{name} {self.counters[name]} ({rate:.0f}/s, {size:.1f} MiB)"
+                )
+        if self.counters["requeued"]:
+            parts.append(f"requeued {self.counters['requeued']}")
+        for operation, histogram in self.latency.items():
+            if histogram.count:
+                parts.append(
+                    f"{operation} p50 {histogram.quantile(0.5) * 1000:g}ms "
+                    f"p99 {histogram.quantile(0.99) * 1000:g}ms"
+                )
+        if self.batch_sizes.count:
+            parts.append(f"batch mean {self.batch_sizes.mean:.0f}")
+        return ", ".join(parts)
+
+    def _labels(self, **extra: str) -> str:
+        labels = {**self.labels, **extra}
+        if not labels:
+            return ""
+        pairs = ",".join(f'{name}="{value}"' for name, value in labels.items())
+        return "{" + pairs + "}"
+
+    def _histogram_lines(self, name: str, histogram: Histogram, **labels: str):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            yield f"{name}_bucket{self._labels(**labels, le=f'{bound:g}')} {cumulative}"
+        yield f"{name}_bucket{self._labels(**labels, le='+Inf')} {histogram.count}"
+        yield f"{name}_sum{self._labels(**labels)} {histogram.sum}"
+        yield f"{name}_count{self._labels(**labels)} {histogram.count}"
+
+    def prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, description in COUNTERS.items():
+            metric = f"taskrabbit_{name}_total"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{self._labels()} {self.counters[name]}")
+        metric = "taskrabbit_store_latency_seconds"
+        lines.append(f"# HELP {metric} Time taken by store calls.")
+        lines.append(f"# TYPE {metric} histogram")
+        for operation, histogram in self.latency.items():
+            lines.extend(self._histogram_lines(metric, histogram, operation=operation))
+        metric = "taskrabbit_batch_size"
+        lines.append(f"# HELP {metric} Tasks written to the store per batch.")
+        lines.append(f"# TYPE {metric} histogram")
+        lines.extend(self._histogram_lines(metric, self.batch_sizes))
+        return "\n".join(lines) + "\n"
+
+
+class MeteredTaskStore(TaskStore):
+    """
+    Time the calls made to a store, and record the sizes of batches saved.
+    Anything else is passed through to the store.
+    """
+
+    def __init__(self, store: TaskStore, metrics: Metrics):
+        self.store = store
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def save(self, task: StoredTask):
+        with self.metrics.time("save"):
+            self.store.save(task)
+
+    def bulk_save(self, tasks: Iterable[StoredTask]):
+        tasks = list(tasks)
+        self.metrics.batch_sizes.observe(len(tasks))
+        with self.metrics.time("save"):
+            self.store.bulk_save(tasks)
+
+    def delete(self, task: StoredTask):
+        with self.metrics.time("delete"):
+            self.store.delete(task)
+
+    def delete_many(self, tasks: Iterable[StoredTask]):
+        with self.metrics.time("delete"):
+            self.store.delete_many(tasks)
+
+    def load_tasks(
+        self,
+        task_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> Iterator[StoredTask]:
+        # Times how long the store takes to produce each task.
+        tasks = iter(self.store.load_tasks(task_name, limit, after))
+        while True:
+            with self.metrics.time("load"):
+                task = next(tasks, None)
+            if task is None:
+                return
+            yield task
+
+    def count_by_task(self, task_name: Optional[str] = None) -> Dict[str, int]:
+        return self.store.count_by_task(task_name)
+
+    def dedupe(self) -> int:
+        return self.store.dedupe()
+
+
+class TracedTaskStore(TaskStore):
+    """
+    Time each call made to a store as a phase, see
+    :mod:`taskrabbit.profiling`. Anything else is passed through to the store.
+    """
+
+    def __init__(self, store: TaskStore):
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def save(self, task: StoredTask):
+        with phase("store.save"):
+            self.store.save(task)
+
+    def bulk_save(self, tasks: Iterable[StoredTask]):
+        with phase("store.bulk_save"):
+            self.store.bulk_save(tasks)
+
+    def delete(self, task: StoredTask):
+        with phase("store.delete"):
+            self.store.delete(task)
+
+    def delete_many(self, tasks: Iterable[StoredTask]):
+        with phase("store.delete_many"):
+            self.store.delete_many(tasks)
+
+    def load_tasks(
+        self,
+        task_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> Iterator[StoredTask]:
+        tasks = iter(self.store.load_tasks(task_name, limit, after))
+        while True:
+            with phase("store.load_tasks"):
+                task = next(tasks, None)
+            if task is None:
+                return
+            yield task
+
+    def count_by_task(self, task_name: Optional[str] = None) -> Dict[str, int]:
+        with phase("store.count_by_task"):
+            return self.store.count_by_task(task_name)
+
+    def dedupe(self) -> int:
+        with phase("store.dedupe"):
+            return self.store.dedupe()
+
+
+class Reporter:
+    """
+    Every ``interval`` seconds, log a summary of ``metrics``, and write them
+    to ``textfile`` in the Prometheus text format, from a background thread.
+    Both are done a final time when the reporter is stopped.
+    """
+
+    def __init__(
+        self,
+        metrics: Metrics,
+        interval: Optional[float] = None,
+        textfile: Optional[str] = None,
+    ):
+        self.metrics = metrics
+        self.interval = interval
+        self.textfile = textfile
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        # Counters at the last report, and when it was.
+        self.previous: Optional[Dict[str, int]] = None
+        self.reported = time.monotonic()
+
+    def report(self):
+        if self.interval is not None:
+            now = time.monotonic()
+            summary = self.metrics.summary(self.previous, now - self.reported)
+            if summary:
+                logging.info("Metrics: %s", summary)
+            self.previous, self.reported = dict(self.metrics.counters), now
+        if self.textfile is not None:
+            # Written to a temporary file and moved into place, so the
+            # collector never reads a partly written file.
+            tmp = f"{self.textfile}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(self.metrics.prometheus())
+            os.replace(tmp, self.textfile)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval or DEFAULT_TEXTFILE_INTERVAL):
+            self.report()
+
+    def start(self) -> "Reporter":
+        if self.interval is not None or self.textfile is not None:
+            self.thread = threading.Thread(
+                target=self._run, name="metrics", daemon=True
+            )
+            self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            # The final summary has rates over the whole run.
+            self.previous = None
+            self.report()
+
+    def __enter__(self) -> "Reporter":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def write_json(metrics: Metrics, path: str):
+    with open(path, "w") as f:
+        json.dump(metrics.to_dict(), f, indent=2)
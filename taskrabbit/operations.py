@@ -1,25 +1,201 @@
+import asyncio
+import base64
+import json
 import logging
+import math
+import multiprocessing
 import socket
-from collections import Counter
-from itertools import islice
-from typing import List, Optional, Iterable
-import termtables
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from dataclasses import replace
+from typing import Any, Dict, List, Optional, Iterable, Set, Tuple, Union
 from kombu import Connection, Exchange, Message, Queue
-from amqp.exceptions import NotFound as AMQPNotFound
+from kombu.serialization import dumps
+from kombu.transport.virtual import Channel as VirtualChannel
+from amqp.exceptions import ChannelError, NotFound as AMQPNotFound
 
 from . import config
+from .listing import TaskCounter, list_  # noqa: F401
+from .metrics import MeteredTaskStore, Metrics, Reporter
+from .profiling import phase
 from .stores.base import StoredTask, TaskStore
+from .stores.batch import TaskBatch
 
+# Give up waiting for publisher confirms after this many seconds.
+CONFIRM_TIMEOUT = 30
 
-class TaskCounter(Counter):
-    def stream(self, tasks: Iterable[StoredTask]):
+# Seconds between checks of destination queue depths, when filling
+# with a maximum queue depth.
+QUEUE_DEPTH_INTERVAL = 1.0
+
+
+class Throttle:
+    """
+    Limit the rate tasks are published at with a token bucket, holding up
+    to a second's worth of tokens, and pause publishing while any destination
+    queue holds more than ``max_queue_depth`` messages.
+
+    Queue depths are checked every ``interval`` seconds, and whenever as many
+    tasks have been published as there was room for at the last check.
+
+    The throttle doesn't sleep itself, so it can be used by both the sync
+    and async engines. Instead, it says how long to wait.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        max_queue_depth: Optional[int] = None,
+        interval: float = QUEUE_DEPTH_INTERVAL,
+    ):
+        self.rate = rate
+        self.max_queue_depth = max_queue_depth
+        self.interval = interval
+        self.capacity = max(rate or 0, 1)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.checked: Optional[float] = None
+        # Number of tasks which can be published before the deepest queue
+        # could hold more than max_queue_depth messages.
+        self.room = 0
+        self.missing: Set[str] = set()
+
+    def rate_delay(self) -> float:
+        """
+        Take a token for a task, and return the number of seconds
+        to wait before publishing it.
+        """
+        if self.rate is None:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, 0)
+
+    @property
+    def depth_check_due(self) -> bool:
+        return self.max_queue_depth is not None and (
+            self.room <= 0 or time.monotonic() - self.checked >= self.interval
+        )
+
+    def too_deep(self, depths: Dict[str, Optional[int]]) -> bool:
+        """
+        Record the message counts of destination queues, and return
+        True if publishing should pause.
+        """
+        self.checked = time.monotonic()
+        for name in depths.keys() - self.missing:
+            if depths[name] is None:
+                logging.warning("Can't check depth of missing queue: %s", name)
+                self.missing.add(name)
+        found = {name: depth for name, depth in depths.items() if depth is not None}
+        # A queue at the maximum can take one more task before it's over.
+        self.room = self.max_queue_depth - max(found.values(), default=0) + 1
+        if self.room <= 0:
+            logging.info(
+                "Pausing while a queue has more than %d messages: %s",
+                self.max_queue_depth,
+                ", ".join(
+                    f"{name} ({depth})"
+                    for name, depth in found.items()
+                    if depth > self.max_queue_depth
+                ),
+            )
+        return self.room <= 0
+
+    def published(self):
+        self.room -= 1
+
+
+def queue_depths(
+    conn: Connection, queue_names: Iterable[str]
+) -> Dict[str, Optional[int]]:
+    """
+    Get the number of messages in each queue, with a passive declare,
+    or None for queues which don't exist.
+    """
+    depths = {}
+    for name in queue_names:
+        # The broker closes the channel if the queue doesn't exist,
+        # so use a new one for each queue.
+        with conn.channel() as channel:
+            try:
+                depths[name] = channel.queue_declare(
+                    queue=name, passive=True
+                ).message_count
+            except ChannelError:
+                depths[name] = None
+    return depths
+
+
+class ConfirmWindow:
+    """
+    Track tasks published on a channel in publisher confirm mode, until the
+    broker confirms them. Confirmed tasks are deleted from the store in
+    batches. Tasks the broker rejects are left in the store.
+
+    See https://www.rabbitmq.com/confirms.html#publisher-confirms
+    """
+
+    def __init__(
+        self,
+        channel,
+        store: TaskStore,
+        delete: bool = True,
+        delete_batch_size: int = config.DEFAULT_FILL_DELETE_BATCH_SIZE,
+    ):
+        self.store = store
+        self.delete = delete
+        self.delete_batch_size = delete_batch_size
+        self.pending: Dict[int, StoredTask] = {}
+        self.confirmed: List[StoredTask] = []
+        self.nacked = 0
+        # The broker numbers published messages from 1, per channel.
+        self.delivery_tag = 0
+        channel.confirm_select()
+        channel.events["basic_ack"].add(self.on_ack)
+        channel.events["basic_nack"].add(self.on_nack)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def published(self, task: StoredTask):
+        self.delivery_tag += 1
+        self.pending[self.delivery_tag] = task
+
+    def _settle(self, delivery_tag: int, multiple: bool) -> List[StoredTask]:
+        if not multiple:
+            return [self.pending.pop(delivery_tag)]
+        # Pending tags are in publish order, oldest first.
+        tasks = []
+        while self.pending:
+            tag = next(iter(self.pending))
+            if tag > delivery_tag:
+                break
+            tasks.append(self.pending.pop(tag))
+        return tasks
+
+    def on_ack(self, delivery_tag: int, multiple: bool):
+        self.confirmed.extend(self._settle(delivery_tag, multiple))
+        if len(self.confirmed) >= self.delete_batch_size:
+            self.flush()
+
+    def on_nack(self, delivery_tag: int, multiple: bool):
+        tasks = self._settle(delivery_tag, multiple)
+        self.nacked += len(tasks)
         for task in tasks:
-            self.update([task.task])
-            yield task
+            logging.error("Broker rejected task ID: %s", task.id)
 
-    def display(self):
-        if self:
-            termtables.print(self.most_common(), header=["Task", "Count"])
+    def flush(self):
+        """
+        Delete confirmed tasks from the store.
+        """
+        if self.delete and self.confirmed:
+            self.store.delete_many(self.confirmed)
+        self.confirmed = []
 
 
 def fill(
@@ -28,13 +204,28 @@ def fill(
     store: TaskStore,
     task_name: Optional[str] = None,
     delete: bool = True,
+    queue_names: Optional[List[str]] = None,
+    metrics: Optional[Metrics] = None,
 ) -> None:
+    """
+    Publish stored tasks to an exchange.
+
+    With a maximum queue depth, publishing pauses while any of
+    ``queue_names`` is too deep. Without ``queue_names``, the queues
+    named by the routing keys of the tasks published so far are checked,
+    which are their destinations when publishing to the default exchange.
+    """
     # Don't publish to system exchanges
     if exchange_name.startswith("amq"):
         raise ValueError(f"Cannot publish to system exchange: {exchange_name}")
+    if metrics is None:
+        metrics = Metrics()
 
+    throttle = Throttle(cfg.fill.rate, cfg.fill.max_queue_depth)
+    routing_keys = set()
     with Connection(cfg.rabbitmq.url()) as conn:
         with conn.channel() as channel:
+            window = None
             try:
                 counter = TaskCounter()
                 # Passively declare the exchange so we can fail if it doesn't
@@ -44,78 +235,563 @@ def fill(
                 producer = conn.Producer(
                     exchange=exchange, channel=channel, serializer="json"
                 )
-                for task in counter.stream(store.load_tasks(task_name)):
-                    logging.debug("Publishing task ID: %s", task.id)
-                    producer.publish(
-                        task.body,
-                        exchange=exchange,
-                        routing_key=task.routing_key,
-                        headers=task.headers,
+                if cfg.fill.publisher_confirms:
+                    window = ConfirmWindow(
+                        channel, store, delete, cfg.fill.delete_batch_size
                     )
-                    if delete:
+                tasks = store.load_tasks_in_pages(task_name, cfg.fill.page_size)
+                for task in counter.stream(tasks):
+                    routing_keys.add(task.routing_key)
+                    if throttle.depth_check_due:
+                        while throttle.too_deep(
+                            queue_depths(conn, queue_names or sorted(routing_keys))
+                        ):
+                            time.sleep(throttle.interval)
+                    delay = throttle.rate_delay()
+                    if delay:
+                        time.sleep(delay)
+                    logging.debug("Publishing task ID: %s", task.id)
+                    if task.is_raw:
+                        body = task.body
+                        content_type = task.content_type
+                        content_encoding = task.content_encoding
+                    else:
+                        # Serialized here, as the producer would, so its size
+                        # is known.
+                        with phase("fill.serialize"):
+                            content_type, content_encoding, body = dumps(
+                                task.body, serializer="json"
+                            )
+                            body = body.encode(content_encoding)
+                    # Passing a content type publishes the body as it is,
+                    # without serializing it again.
+                    with phase("fill.publish"):
+                        producer.publish(
+                            body,
+                            exchange=exchange,
+                            routing_key=task.routing_key,
+                            headers=task.headers,
+                            content_type=content_type,
+                            content_encoding=content_encoding,
+                        )
+                    metrics.count("published")
+                    metrics.count("published_bytes", len(body))
+                    throttle.published()
+                    if window is not None:
+                        window.published(task)
+                        # Block until the broker has caught up with us.
+                        while len(window) >= cfg.fill.confirm_window:
+                            with phase("fill.confirm"):
+                                conn.drain_events(timeout=CONFIRM_TIMEOUT)
+                    elif delete:
                         store.delete(task)
+                if window is not None:
+                    while window:
+                        with phase("fill.confirm"):
+                            conn.drain_events(timeout=CONFIRM_TIMEOUT)
+                    if window.nacked:
+                        logging.error(
+                            "%d tasks were rejected by the broker, and were "
+                            "kept in the store.",
+                            window.nacked,
+                        )
                 counter.display()
             except AMQPNotFound as ex:
                 logging.error(str(ex))
+            finally:
+                if window is not None:
+                    # Don't lose track of tasks that were confirmed before
+                    # an error, or an interrupt.
+                    window.flush()
 
 
-def drain(cfg: config.Config, queue_name: str, store: TaskStore) -> None:
-    queue = Queue(queue_name)
-    logging.info(f"Draining queue: {queue}")
+class DrainLimit:
+    """
+    Decide which received messages to drain, and when to stop draining,
+    given the limits in a DrainConfig.
 
-    requeue: List[Message] = []
+    ``snapshot`` is the number of messages in each queue when draining
+    started. It's only used by snapshot mode.
+    """
 
-    def callback(_, message: Message):
-        nonlocal requeue
-        task = StoredTask.from_message(message)
-        logging.debug("Received task: %s", task)
-        try:
-            store.save(task)
+    def __init__(
+        self, cfg: config.DrainConfig, snapshot: Optional[Dict[str, int]] = None
+    ):
+        self.max_messages = cfg.max_messages
+        self.deadline = None
+        if cfg.max_duration is not None:
+            self.deadline = time.monotonic() + cfg.max_duration
+        self.remaining = dict(snapshot) if cfg.snapshot else None
+        self.taken = 0
+
+    def take(self, queue_name: str) -> bool:
+        """
+        Count a message received from a queue. Returns False if it's over a
+        limit, and should be put back on the queue rather than drained.
+        """
+        if self.max_messages is not None and self.taken >= self.max_messages:
+            return False
+        if self.remaining is not None:
+            if self.remaining[queue_name] <= 0:
+                return False
+            self.remaining[queue_name] -= 1
+        self.taken += 1
+        return True
+
+    def queue_done(self, queue_name: str) -> bool:
+        """
+        True once every message in a queue's snapshot has been drained.
+        """
+        return self.remaining is not None and self.remaining[queue_name] <= 0
+
+    def prefetch_count(self, queue_name: Optional[str], prefetch_count: int) -> int:
+        """
+        Limit a prefetch count, so the broker won't deliver many more
+        messages than will be drained. With no ``queue_name``, limit a
+        prefetch count shared by every queue.
+        """
+        limits = [prefetch_count]
+        if self.max_messages is not None:
+            limits.append(self.max_messages - self.taken)
+        if self.remaining is not None:
+            if queue_name is None:
+                limits.append(sum(max(n, 0) for n in self.remaining.values()))
+            else:
+                limits.append(self.remaining[queue_name])
+        return max(min(limits), 1)
+
+    def timeout(self, timeout: float) -> float:
+        """
+        Shorten a timeout to end at the deadline.
+        """
+        if self.deadline is None:
+            return timeout
+        return max(min(timeout, self.deadline - time.monotonic()), 0)
+
+    @property
+    def reached(self) -> bool:
+        if self.max_messages is not None and self.taken >= self.max_messages:
+            return True
+        if self.remaining is not None and all(
+            count <= 0 for count in self.remaining.values()
+        ):
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+
+class AdaptivePrefetch:
+    """
+    Size the prefetch window to keep the store writer busy, without holding
+    many more received messages in memory than that needs.
+
+    Acks for a batch only reach the broker once it has been written, so
+    the window has to hold the batch being written and the next one being
+    received, plus as many messages as the store can write during a broker
+    round trip, which are still on their way. The store's write rate and
+    the broker round trip are measured as draining goes, and the window is
+    resized when its ideal size drifts more than ``tolerance`` from its
+    current size, so it isn't resized for every batch.
+
+    Like Throttle, it neither measures nor resizes anything itself,
+    so it can be used by both the sync and async engines.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        initial: int,
+        maximum: int,
+        smoothing: float = 0.3,
+        tolerance: float = 0.25,
+    ):
+        self.batch_size = batch_size
+        self.maximum = maximum
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.count = self._clamp(initial)
+        # Tasks written per second, and broker round trip in seconds,
+        # as exponentially weighted moving averages.
+        self.write_rate: Optional[float] = None
+        self.round_trip: Optional[float] = None
+
+    def _clamp(self, count: int) -> int:
+        return max(min(count, self.maximum), min(2 * self.batch_size, self.maximum))
+
+    def _average(self, average: Optional[float], sample: float) -> float:
+        if average is None:
+            return sample
+        return average + self.smoothing * (sample - average)
+
+    def wrote(self, count: int, seconds: float):
+        """
+        Record the time taken to write ``count`` tasks to the store.
+        """
+        self.write_rate = self._average(self.write_rate, count / max(seconds, 1e-6))
+
+    def round_tripped(self, seconds: float):
+        """
+        Record the time taken by a request to the broker.
+        """
+        self.round_trip = self._average(self.round_trip, seconds)
+
+    @property
+    def target(self) -> int:
+        if self.write_rate is None or self.round_trip is None:
+            return self.count
+        in_flight = math.ceil(self.write_rate * self.round_trip)
+        return self._clamp(2 * self.batch_size + in_flight)
+
+    def resize(self) -> Optional[int]:
+        """
+        Return a new window size if the window should be resized, or None.
+        """
+        target = self.target
+        if abs(target - self.count) <= self.tolerance * self.count:
+            return None
+        logging.debug(
+            "Resizing prefetch window from %d to %d "
+            "(writing %.0f tasks/s, %.1fms broker round trip)",
+            self.count,
+            target,
+            self.write_rate,
+            self.round_trip * 1000,
+        )
+        self.count = target
+        return target
+
+
+def ack_all(messages: List[Message]) -> None:
+    """
+    Acknowledge messages received in order on a single channel.
+    """
+    last = messages[-1]
+    if isinstance(last.channel, VirtualChannel):
+        # kombu's virtual transports (memory, redis, ...) ignore `multiple`.
+        for message in messages:
             message.ack()
-        except Exception:
-            requeue.append(message)
+    else:
+        # Acknowledges every message on the channel up to and including
+        # the last one.
+        last.ack(multiple=True)
 
-    # TODO: Safer persistence for messages that need to be requeued.
-    with Connection(cfg.rabbitmq.url()) as conn:
+
+def list_queues(
+    cfg: config.Config, exchange_name: Optional[str] = None
+) -> List[str]:
+    """
+    Get the names of queues in the configured vhost from the
+    RabbitMQ management API. If ``exchange_name`` is given, only
+    queues bound to that exchange are returned.
+    """
+    if exchange_name is None:
+        url = cfg.rabbitmq.management_url("queues")
+    else:
+        url = cfg.rabbitmq.management_url(
+            "exchanges", exchange_name, "bindings", "source"
+        )
+    credentials = f"{cfg.rabbitmq.username}:{cfg.rabbitmq.password}"
+    request = urllib.request.Request(
+        url,
+        headers={
+            "Authorization": "Basic "
+            + base64.b64encode(credentials.encode()).decode("ascii")
+        },
+    )
+    logging.debug("Listing queues from %s", url)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        results = json.load(response)
+    if exchange_name is None:
+        names = [queue["name"] for queue in results]
+    else:
+        names = [
+            binding["destination"]
+            for binding in results
+            if binding["destination_type"] == "queue"
+        ]
+    # A queue may be bound to an exchange more than once.
+    return sorted(set(names))
+
+
+def drain(
+    cfg: config.Config,
+    queue_names: Union[str, Iterable[str]],
+    store: TaskStore,
+    snapshot: Optional[Dict[str, int]] = None,
+    metrics: Optional[Metrics] = None,
+) -> TaskCounter:
+    """
+    Drain tasks from one or more queues into the store.
+
+    All queues are consumed concurrently on one channel, and every task is
+    written through the same batch. Returns the number of tasks drained
+    from each queue.
+
+    In snapshot mode, ``snapshot`` gives the number of messages to drain
+    from each queue, instead of the number in each when draining starts.
+    """
+    if isinstance(queue_names, str):
+        queue_names = [queue_names]
+    if metrics is None:
+        metrics = Metrics()
+    queues = [Queue(name) for name in queue_names]
+    logging.info("Draining queues: %s", ", ".join(q.name for q in queues))
+    idle_timeout = cfg.drain.idle_timeout
+
+    counter = TaskCounter()
+    batch = TaskBatch(
+        store, size=cfg.drain.batch_size, interval=cfg.drain.flush_interval
+    )
+
+    prefetch = None
+    if cfg.drain.adaptive_prefetch:
+        prefetch = AdaptivePrefetch(
+            batch.size,
+            cfg.rabbitmq.consumer_prefetch_count,
+            cfg.drain.max_prefetch_count,
+        )
+
+    def flush():
+        started = time.monotonic()
         try:
-            with conn.Consumer(queue, callbacks=[callback]) as consumer:
-                consumer.qos(
-                    prefetch_count=config.RabbitMQConfig.consumer_prefetch_count
+            with phase("drain.flush"):
+                items = batch.flush()
+        except Exception:
+            # Nothing in the batch was saved, so put all of it back on the
+            # queue before stopping. Acking any later message with
+            # multiple=True would otherwise acknowledge these too.
+            items = batch.clear()
+            logging.exception("Could not save %d tasks, requeueing", len(items))
+            for _, message in items:
+                message.requeue()
+            metrics.count("requeued", len(items))
+            raise
+        if prefetch is not None and len(items) >= batch.size:
+            # Partial batches are written while waiting on the broker,
+            # so they say little about how fast the store can go.
+            prefetch.wrote(len(items), time.monotonic() - started)
+        if items:
+            with phase("drain.ack"):
+                ack_all([message for _, message in items])
+            counter.update(queue_name for queue_name, _ in items)
+
+    def set_prefetch(conn: Connection, count: int):
+        started = time.monotonic()
+        # Global, so it applies to the channel's existing consumers too,
+        # and the window is shared by all of them.
+        conn.default_channel.basic_qos(0, limit.prefetch_count(None, count), True)
+        prefetch.round_tripped(time.monotonic() - started)
+
+    def on_message(queue_name: str):
+        def callback(message: Message):
+            metrics.count("consumed")
+            metrics.count("consumed_bytes", len(message.body))
+            if not limit.take(queue_name):
+                message.requeue()
+                metrics.count("requeued")
+                return
+            task = StoredTask.from_message(message, cfg.drain.passthrough)
+            logging.debug("Received task: %s", task)
+            batch.add(task, (queue_name, message))
+            if batch.full:
+                flush()
+
+        return callback
+
+    poll_timeout = min(cfg.drain.flush_interval, idle_timeout)
+
+    with Connection(cfg.rabbitmq.url()) as conn, ExitStack() as stack:
+        if cfg.drain.snapshot and snapshot is None:
+            # Declaring a queue, as the consumer would, gives its message count.
+            snapshot = {
+                queue.name: queue(conn.default_channel).queue_declare().message_count
+                for queue in queues
+            }
+            logging.info(
+                "Draining at most: %s",
+                ", ".join(f"{name} ({count})" for name, count in snapshot.items()),
+            )
+        limit = DrainLimit(cfg.drain, snapshot)
+        if prefetch is not None:
+            set_prefetch(conn, prefetch.count)
+        # Consumers share the connection's default channel, so delivery tags
+        # are unique across queues, and one ack can cover a whole batch.
+        consumers = {}
+        for queue in queues:
+            if limit.queue_done(queue.name):
+                continue
+            prefetch_count = None
+            if prefetch is None:
+                # Make sure the broker will deliver enough messages to fill a batch.
+                prefetch_count = limit.prefetch_count(
+                    queue.name, max(cfg.rabbitmq.consumer_prefetch_count, batch.size)
                 )
+            consumers[queue.name] = stack.enter_context(
+                # Unlike callbacks, on_message receives messages which haven't
+                # been deserialized yet. The prefetch count is set before
+                # consuming starts, as the broker only applies it to consumers
+                # created after it.
+                conn.Consumer(
+                    queue,
+                    on_message=on_message(queue.name),
+                    prefetch_count=prefetch_count,
+                )
+            )
+        last_received = time.monotonic()
+        try:
+            while consumers and not limit.reached:
                 try:
-                    while True:
-                        conn.drain_events(timeout=1)
+                    # Includes handling the messages received, but that's
+                    # timed as the phases nested in it.
+                    with phase("drain.receive"):
+                        conn.drain_events(timeout=limit.timeout(poll_timeout))
+                    last_received = time.monotonic()
                 except socket.timeout:
-                    pass
-                except KeyboardInterrupt:
-                    consumer.recover(requeue=True)
-                    raise
-        finally:
-            if requeue:
-                for message in requeue:
-                    message.requeue()
+                    if time.monotonic() - last_received >= idle_timeout:
+                        break
+                for queue_name in [q for q in consumers if limit.queue_done(q)]:
+                    # Stop the broker delivering more messages from the queue.
+                    consumers.pop(queue_name).cancel()
+                if batch.due:
+                    flush()
+                if prefetch is not None:
+                    # Resized here rather than as batches are written, since
+                    # the broker's reply may come after more deliveries,
+                    # which would be handled while the batch is mid-flush.
+                    count = prefetch.resize()
+                    if count is not None:
+                        set_prefetch(conn, count)
+            flush()
+        except KeyboardInterrupt:
+            # Recovers every unacknowledged message on the shared channel.
+            conn.default_channel.basic_recover(requeue=True)
+            raise
+    return counter
 
 
-def list_(
+def _share(total: int, index: int, workers: int) -> int:
+    """
+    Worker ``index``'s share of ``total``, split as evenly as possible.
+    """
+    return total // workers + (index < total % workers)
+
+
+def _drain_worker(
+    cfg: config.Config,
+    queue_names: List[str],
+    index: int,
+    snapshot: Optional[Dict[str, int]],
+    engine: str,
+) -> Tuple[Dict[str, int], Optional[Dict[str, Any]]]:
+    # Spawned workers start without any logging configured.
+    logging.basicConfig(
+        level=cfg.log_level, format=f"[worker {index}] %(levelname)s: %(message)s"
+    )
+    store = cfg.init_shard(index)
+    if not cfg.metrics.enabled:
+        return dict(_drain_shard(cfg, queue_names, store, snapshot, engine)), None
+    metrics = Metrics({"worker": str(index)})
+    textfile = None
+    if cfg.metrics.textfile is not None:
+        textfile = config.numbered_path(cfg.metrics.textfile, index)
+    with Reporter(metrics, cfg.metrics.log_interval, textfile):
+        counts = _drain_shard(
+            cfg,
+            queue_names,
+            MeteredTaskStore(store, metrics),
+            snapshot,
+            engine,
+            metrics,
+        )
+    return dict(counts), metrics.to_dict()
+
+
+def _drain_shard(
+    cfg: config.Config,
+    queue_names: List[str],
     store: TaskStore,
-    counts=False,
-    limit: Optional[int] = None,
-    task_name: Optional[str] = None,
-) -> None:
-    stream = store.load_tasks(task_name)
-    if limit:
-        stream = islice(stream, limit)
-    if counts:
-        counter = TaskCounter()
-        list(counter.stream(stream))
-        counter.display()
-    else:
-        items = []
-        for task in stream:
-            items.append(
-                (task.id, task.task, task.argsrepr, task.kwargsrepr, task.routing_key)
-            )
-        if items:
-            termtables.print(
-                items, header=["ID", "Task", "Args", "Kwargs", "Routing Key"]
+    snapshot: Optional[Dict[str, int]],
+    engine: str,
+    metrics: Optional[Metrics] = None,
+) -> TaskCounter:
+    if engine == "async":
+        from . import aio
+
+        return asyncio.run(aio.drain(cfg, queue_names, store, snapshot, metrics))
+    return drain(cfg, queue_names, store, snapshot, metrics)
+
+
+def drain_in_workers(
+    cfg: config.Config,
+    queue_names: Union[str, Iterable[str]],
+    workers: int,
+    engine: str = "sync",
+    metrics: Optional[Metrics] = None,
+) -> TaskCounter:
+    """
+    Drain tasks from one or more queues with ``workers`` processes, each
+    consuming every queue with its own connection, and writing to its own
+    shard of the store. See :meth:`taskrabbit.config.Config.init_shard`.
+
+    ``max_messages``, and the messages in each queue in snapshot mode,
+    are shared out between the workers. Returns the number of tasks
+    drained from each queue.
+
+    If metrics are enabled in the config, workers report their own while
+    they run, which are added to ``metrics`` once they're done.
+    """
+    if isinstance(queue_names, str):
+        queue_names = [queue_names]
+    queue_names = list(queue_names)
+    if cfg.drain.max_messages is not None:
+        workers = min(workers, cfg.drain.max_messages)
+    snapshot = None
+    if cfg.drain.snapshot:
+        with Connection(cfg.rabbitmq.url()) as conn:
+            # Counted once, up front, so workers don't each drain all of it.
+            snapshot = {
+                name: depth or 0
+                for name, depth in queue_depths(conn, queue_names).items()
+            }
+        logging.info(
+            "Draining at most: %s",
+            ", ".join(f"{name} ({count})" for name, count in snapshot.items()),
+        )
+    logging.info("Draining with %d workers", workers)
+    counter = TaskCounter()
+    # Spawned rather than forked, so workers don't inherit the parent's
+    # connections, or the store it has open.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = []
+        for index in range(workers):
+            worker_cfg = cfg
+            if cfg.drain.max_messages is not None:
+                worker_cfg = replace(
+                    cfg,
+                    drain=replace(
+                        cfg.drain,
+                        max_messages=_share(cfg.drain.max_messages, index, workers),
+                    ),
+                )
+            worker_snapshot = None
+            if snapshot is not None:
+                worker_snapshot = {
+                    name: _share(count, index, workers)
+                    for name, count in snapshot.items()
+                }
+            futures.append(
+                pool.submit(
+                    _drain_worker,
+                    worker_cfg,
+                    queue_names,
+                    index,
+                    worker_snapshot,
+                    engine,
+                )
             )
+        for future in futures:
+            counts, worker_metrics = future.result()
+            counter.update(counts)
+            if metrics is not None and worker_metrics is not None:
+                metrics.merge(worker_metrics)
+    return counter
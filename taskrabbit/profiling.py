@@ -0,0 +1,130 @@
+"""
+Find where the time goes in a command.
+
+``--profile`` runs a command under cProfile, and writes the stats to a file
+for :mod:`pstats`, or a viewer such as snakeviz.
+
+``--trace-phases`` times the hot sections of drain, fill and list, marked
+with :func:`phase`, along with every store call, and traces memory with
+:mod:`tracemalloc`. A phase's time excludes the phases nested in it, so
+e.g. the time drain spends receiving messages doesn't include decoding them
+or saving them to the store, and the times add up to the whole. Tracing,
+and tracemalloc especially, slows the command down, so its times are best
+compared with each other, rather than with an untraced run.
+
+Phases are timed in the process they run in, so drain workers aren't
+covered.
+"""
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import TYPE_CHECKING, ContextManager, Dict, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    import cProfile
+
+_tracer: Optional["PhaseTracer"] = None
+_not_tracing = nullcontext()
+
+
+class PhaseTracer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+        # Store calls may be made from a worker thread, by the async engine,
+        # so each thread has its own stack of phases.
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        stack: Optional[List[List[float]]] = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        # Time spent in nested phases.
+        nested = [0.0]
+        stack.append(nested)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            stack.pop()
+            if stack:
+                stack[-1][0] += elapsed
+            with self.lock:
+                self.seconds[name] += elapsed - nested[0]
+                self.calls[name] += 1
+
+    def report(self, peak_memory: int) -> str:
+        import termtables
+
+        total = time.perf_counter() - self.started
+        rows = [
+            [name, self.calls[name], f"{seconds:.3f}", f"{seconds / total:.1%}"]
+            for name, seconds in sorted(
+                self.seconds.items(), key=lambda item: item[1], reverse=True
+            )
+        ]
+        other = total - sum(self.seconds.values())
+        rows.append(["(other)", "", f"{other:.3f}", f"{other / total:.1%}"])
+        table = termtables.to_string(
+            rows, header=["Phase", "Calls", "Seconds", "Share"]
+        )
+        return (
+            f"{table}\n"
+            f"Total {total:.3f}s, "
+            f"peak traced memory {peak_memory / 1024 / 1024:.1f} MiB"
+        )
+
+
+def phase(name: str) -> ContextManager[None]:
+    """
+    Time a section of code as the named phase, when tracing phases.
+    Otherwise, does nothing.
+    """
+    if _tracer is None:
+        return _not_tracing
+    return _tracer.phase(name)
+
+
+def tracing() -> bool:
+    return _tracer is not None
+
+
+def start_tracing():
+    global _tracer
+    import tracemalloc
+
+    _tracer = PhaseTracer()
+    tracemalloc.start()
+
+
+def stop_tracing() -> str:
+    """
+    Stop tracing phases, and return a report of the time spent in each,
+    and of peak memory use.
+    """
+    global _tracer
+    import tracemalloc
+
+    tracer, _tracer = _tracer, None
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return tracer.report(peak)
+
+
+def start_profile() -> "cProfile.Profile":
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler: "cProfile.Profile", path: Path):
+    profiler.disable()
+    profiler.dump_stats(path)
@@ -0,0 +1,310 @@
+"""
+Codecs used by task stores to serialize StoredTask records.
+
+Each codec has a ``name``, which stores are configured with, and a
+``format``, which is recorded alongside every record the codec writes.
+A record can be read back by any available codec of the same format,
+so a store written with ``json`` can be read with ``orjson``, and the
+other way around.
+
+``json`` is always available. ``orjson`` and ``msgpack`` are registered
+if the packages of the same names are installed.
+
+Records can also be compressed, with ``zlib``, or with ``zstd`` if the
+zstandard package is installed. A compressed record's format is the
+codec's format followed by the compressor, e.g. ``json+zlib``.
+"""
+import json
+import zlib
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
+
+# Prefix of a framed record, followed by its format and a newline.
+FRAME_MAGIC = b"TR:"
+
+
+class Codec:
+    name: str
+    format: str
+    # Whether bytes can be serialized as they are. Other codecs get
+    # raw message bodies encoded as text.
+    binary = False
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError()
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+class JSONCodec(Codec):
+    """
+    Compact JSON, using the standard library.
+    """
+
+    name = "json"
+    format = "json"
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode(
+            "utf-8"
+        )
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    """
+    Compact JSON, using orjson.
+    """
+
+    name = "orjson"
+    format = "json"
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    MessagePack, using msgpack.
+    """
+
+    name = "msgpack"
+    format = "msgpack"
+    binary = True
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+class Compressor:
+    name: str
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+class ZlibCompressor(Compressor):
+    name = "zlib"
+
+    def __init__(self, level: Optional[int] = None):
+        self.level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompressor(Compressor):
+    """
+    Zstandard, optionally with a dictionary.
+
+    Tasks are small and alike, so compressing each one on its own gains
+    little, unless the compressor has a dictionary of what tasks look like,
+    trained from a sample of them. See :func:`train_dictionary`.
+
+    Dictionaries are identified by an ID written into each record, so once
+    a dictionary is loaded, records compressed with it can be read by any
+    ZstdCompressor.
+    """
+
+    name = "zstd"
+    # Dictionary ID -> dictionary, for every dictionary loaded.
+    dictionaries: Dict[int, Any] = {}
+
+    def __init__(self, level: Optional[int] = None, dictionary: Optional[bytes] = None):
+        self.level = 3 if level is None else level
+        self.dictionary = None
+        if dictionary is not None:
+            self.dictionary = zstandard.ZstdCompressionDict(dictionary)
+            self.dictionaries[self.dictionary.dict_id()] = self.dictionary
+        self.compressor = zstandard.ZstdCompressor(
+            level=self.level, dict_data=self.dictionary
+        )
+        self.decompressors: Dict[int, Any] = {}
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def _decompressor(self, dict_id: int):
+        if dict_id not in self.decompressors:
+            if dict_id and dict_id not in self.dictionaries:
+                raise ValueError(
+                    f"Record was compressed with zstd dictionary {dict_id}, "
+                    "which is not loaded. Configure it as compression_dictionary."
+                )
+            self.decompressors[dict_id] = zstandard.ZstdDecompressor(
+                dict_data=self.dictionaries.get(dict_id)
+            )
+        return self.decompressors[dict_id]
+
+    def decompress(self, data: bytes) -> bytes:
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        return self._decompressor(dict_id).decompress(data)
+
+
+class CompressedCodec(Codec):
+    """
+    Compress the output of another codec.
+    """
+
+    def __init__(self, codec: Codec, compressor: Compressor):
+        self.codec = codec
+        self.compressor = compressor
+        self.name = f"{codec.name}+{compressor.name}"
+        self.format = f"{codec.format}+{compressor.name}"
+        self.binary = codec.binary
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.compressor.compress(self.codec.dumps(obj))
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return self.codec.loads(self.compressor.decompress(data))
+
+
+CODECS: Dict[str, Codec] = {}
+# The codec used to read each format.
+READERS: Dict[str, Codec] = {}
+COMPRESSORS: Dict[str, type] = {"zlib": ZlibCompressor}
+
+
+def register(codec: Codec):
+    """
+    Make a codec available to stores. A codec registered later
+    replaces earlier ones as the reader of its format.
+    """
+    CODECS[codec.name] = codec
+    READERS[codec.format] = codec
+    # Compressed readers wrap the reader of their base format.
+    for format in [f for f in READERS if f.startswith(codec.format + "+")]:
+        del READERS[format]
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown codec {name!r}, choose from: {', '.join(sorted(CODECS))}"
+        ) from None
+
+
+def get_compressor(
+    name: str, level: Optional[int] = None, dictionary: Optional[bytes] = None
+) -> Compressor:
+    try:
+        compressor_class = COMPRESSORS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown compression {name!r}, "
+            f"choose from: {', '.join(sorted(COMPRESSORS))}"
+        ) from None
+    if dictionary is not None:
+        if compressor_class is not ZstdCompressor:
+            raise ValueError(f"{name} compression does not use a dictionary")
+        return compressor_class(level, dictionary)
+    return compressor_class(level)
+
+
+def make_codec(
+    name: str,
+    compression: Optional[str] = None,
+    level: Optional[int] = None,
+    dictionary: Optional[bytes] = None,
+) -> Codec:
+    """
+    Get a codec by name, compressing its output if ``compression`` is given.
+    """
+    codec = get_codec(name)
+    if compression in (None, "none"):
+        return codec
+    return CompressedCodec(codec, get_compressor(compression, level, dictionary))
+
+
+def get_reader(format: str) -> Codec:
+    base_format, _, compression = format.partition("+")
+    if compression:
+        if format not in READERS:
+            READERS[format] = CompressedCodec(
+                get_reader(base_format), get_compressor(compression)
+            )
+        return READERS[format]
+    try:
+        return READERS[format]
+    except KeyError:
+        raise ValueError(f"No codec installed can read {format!r} records") from None
+
+
+def train_dictionary(samples: Iterable[bytes], size: int) -> bytes:
+    """
+    Train a zstd dictionary of at most ``size`` bytes from sample records.
+    """
+    if "zstd" not in COMPRESSORS:
+        raise ValueError("Training a dictionary requires the zstandard package")
+    try:
+        return zstandard.train_dictionary(size, list(samples)).as_bytes()
+    except zstandard.ZstdError as exc:
+        # Raised when there are too few samples to learn from.
+        raise ValueError(str(exc)) from exc
+
+
+def frame(format: str, payload: bytes) -> bytes:
+    """
+    Tag a record with its format, for storage without a separate format
+    field. JSON records are left as they are, so they stay plain JSON.
+    """
+    if format == "json":
+        return payload
+    return FRAME_MAGIC + format.encode("ascii") + b"\n" + payload
+
+
+def unframe(data: bytes) -> Tuple[str, bytes]:
+    """
+    Split a framed record into its format and payload.
+    """
+    if not data.startswith(FRAME_MAGIC):
+        return "json", data
+    header, _, payload = data.partition(b"\n")
+    return header[len(FRAME_MAGIC) :].decode("ascii"), payload
+
+
+register(JSONCodec())
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    pass
+else:
+    register(OrjsonCodec())
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    pass
+else:
+    register(MsgpackCodec())
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    pass
+else:
+    COMPRESSORS["zstd"] = ZstdCompressor
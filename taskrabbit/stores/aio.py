@@ -0,0 +1,70 @@
+"""
+Use TaskStore implementations from asyncio code.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import AsyncIterator, Iterable, List, Optional
+
+from .base import StoredTask, TaskStore
+
+# Number of tasks read from the store per call into the executor.
+DEFAULT_LOAD_CHUNK_SIZE = 500
+
+
+class AsyncTaskStore:
+    """
+    Wrap a TaskStore so that its methods can be awaited.
+
+    Store calls run in a single worker thread, one at a time, so the event loop
+    is free to consume and publish messages while the store does its I/O.
+    None of the stores are safe to use from several threads at once.
+    """
+
+    def __init__(self, store: TaskStore):
+        self.store = store
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="taskstore"
+        )
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def save(self, task: StoredTask):
+        await self._run(self.store.save, task)
+
+    async def bulk_save(self, tasks: Iterable[StoredTask]):
+        await self._run(self.store.bulk_save, list(tasks))
+
+    async def delete(self, task: StoredTask):
+        await self._run(self.store.delete, task)
+
+    async def delete_many(self, tasks: Iterable[StoredTask]):
+        await self._run(self.store.delete_many, list(tasks))
+
+    async def load_tasks(
+        self,
+        task_name: Optional[str] = None,
+        page_size: Optional[int] = None,
+        chunk_size: int = DEFAULT_LOAD_CHUNK_SIZE,
+    ) -> AsyncIterator[StoredTask]:
+        """
+        Load tasks as :meth:`TaskStore.load_tasks_in_pages` does.
+        """
+        tasks = iter(self.store.load_tasks_in_pages(task_name, page_size))
+        while True:
+            chunk: List[StoredTask] = await self._run(
+                lambda: list(islice(tasks, chunk_size))
+            )
+            if not chunk:
+                return
+            for task in chunk:
+                yield task
+
+    async def dedupe(self) -> int:
+        return await self._run(self.store.dedupe)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
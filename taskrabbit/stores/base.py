@@ -2,61 +2,192 @@
 Common classes for TaskStore implementations, including the base TaskStore class.
 
 """
+import base64
+import hashlib
 import json
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import Any, Dict, Iterable, Optional
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, Optional, Union
 
-from kombu import Message
+from taskrabbit.profiling import phase
+from taskrabbit.serialization import Codec, get_reader
+
+if TYPE_CHECKING:
+    from kombu import Message
 
 
-@dataclass
 class StoredTask:
     """
     A Celery task.
+
+    ``body`` is normally the deserialized message body. A task drained in
+    passthrough mode instead keeps the original body ``bytes``, along with
+    the ``content_type`` and ``content_encoding`` needed to publish them
+    again untouched.
+
+    Tasks loaded with :meth:`decode` or :meth:`from_string` are only
+    deserialized when one of their attributes is first used.
     """
 
-    headers: Dict[str, Any]
-    body: Any
-    routing_key: str
-    # args: List[Any]
-    # kwargs: Dict[str, Any]
+    __slots__ = (
+        "headers",
+        "body",
+        "routing_key",
+        "content_type",
+        "content_encoding",
+        "_encoded",
+        "_format",
+    )
+    _fields = __slots__[:-2]
+
+    def __init__(
+        self,
+        headers: Dict[str, Any],
+        body: Any,
+        routing_key: str,
+        content_type: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+    ):
+        self.headers = headers
+        self.body = body
+        self.routing_key = routing_key
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self._encoded = None
+
+    def __getattr__(self, name):
+        # Only called for attributes which haven't been set,
+        # i.e. on a task from decode which hasn't been deserialized yet.
+        if name in self._fields and self._encoded is not None:
+            encoded, self._encoded = self._encoded, None
+            self._set_fields(get_reader(self._format).loads(encoded))
+            return getattr(self, name)
+        raise AttributeError(
+            f"{self.__class__.__name__!r} object has no attribute {name!r}"
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, StoredTask):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in self._fields)
+
+    @property
+    def is_raw(self) -> bool:
+        """
+        True if the body holds the original, still serialized message body.
+        """
+        return isinstance(self.body, bytes)
+
+    def to_dict(self, binary: bool = False) -> Dict[str, Any]:
+        """
+        A JSON serializable representation of the task. With ``binary``,
+        a raw body is left as bytes, for codecs which can serialize them.
+        """
+        data = {
+            "headers": self.headers,
+            "body": self.body,
+            "routing_key": self.routing_key,
+        }
+        if self.is_raw:
+            data["content_type"] = self.content_type
+            data["content_encoding"] = self.content_encoding
+            if binary:
+                return data
+            # Keep text bodies readable. Decoding and re-encoding valid UTF-8
+            # gives back exactly the same bytes.
+            try:
+                data["body"] = self.body.decode("utf-8")
+                data["body_encoding"] = "utf-8"
+            except UnicodeDecodeError:
+                data["body"] = base64.b64encode(self.body).decode("ascii")
+                data["body_encoding"] = "base64"
+        return data
+
+    def _set_fields(self, data: Dict[str, Any]):
+        body = data["body"]
+        body_encoding = data.get("body_encoding")
+        if body_encoding == "utf-8":
+            body = body.encode("utf-8")
+        elif body_encoding == "base64":
+            body = base64.b64decode(body)
+        self.headers = data["headers"]
+        self.body = body
+        self.routing_key = data["routing_key"]
+        self.content_type = data.get("content_type")
+        self.content_encoding = data.get("content_encoding")
 
     def json(self, indent=2):
         """
         Serialize to JSON.
         """
-        return json.dumps(
-            {
-                "headers": self.headers,
-                "body": self.body,
-                "routing_key": self.routing_key,
-            },
-            indent=indent,
-        )
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def encode(self, codec: Codec) -> bytes:
+        """
+        Serialize with a codec from :mod:`taskrabbit.serialization`.
+        """
+        return codec.dumps(self.to_dict(binary=codec.binary))
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]):
+        """
+        Instantiate a StoredTask from the output of :meth:`to_dict`.
+        """
+        task = cls.__new__(cls)
+        task._encoded = None
+        task._set_fields(data)
+        return task
+
+    @classmethod
+    def decode(cls, encoded: Union[bytes, str], format: str = "json"):
+        """
+        Instantiate a StoredTask serialized in the given format.
+        It is deserialized when the task is first used.
+        """
+        task = cls.__new__(cls)
+        task._encoded = encoded
+        task._format = format
+        return task
 
     @classmethod
     def from_string(cls, string):
         """
         Instantiate a StoredTask from a JSON string.
         """
-        data = json.loads(string)
-        return cls(**data)
+        return cls.decode(string, "json")
 
     @classmethod
-    def from_message(cls, message: Message):
+    def from_message(cls, message: "Message", passthrough: bool = False):
         """
         Instantiate a StoredTask from a kombu Message.
+
+        With ``passthrough``, the message body is kept as it was received,
+        rather than being deserialized.
         """
-        # Kombu docs say message.body is a str, but it's really a memoryview,
-        # which is not JSON serializable
-        return cls(
-            body=message.decode(),
-            headers=message.headers,
-            routing_key=message.delivery_info["routing_key"],
-            # args=message.payload[0],
-            # kwargs=message.payload[1],
-        )
+        if passthrough:
+            # Kombu docs say message.body is a str, but it's really bytes,
+            # or a memoryview.
+            body = message.body
+            if isinstance(body, str):
+                body = body.encode(message.content_encoding or "utf-8")
+            return cls(
+                body=bytes(body),
+                headers=message.headers,
+                routing_key=message.delivery_info["routing_key"],
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+            )
+        # message.body is not JSON serializable, so store the decoded body.
+        with phase("task.decode"):
+            body = message.decode()
+        with phase("task.build"):
+            return cls(
+                body=body,
+                headers=message.headers,
+                routing_key=message.delivery_info["routing_key"],
+                # args=message.payload[0],
+                # kwargs=message.payload[1],
+            )
 
     @property
     def id(self):
@@ -88,6 +219,42 @@ class StoredTask:
         """
         return self.headers["kwargsrepr"]
 
+    @property
+    def dedupe_key(self) -> str:
+        """
+        A hash of the task name and its arguments.
+        Tasks with the same key are duplicates.
+        """
+        body = self._decode_raw_body() if self.is_raw else self.body
+        if isinstance(body, (list, tuple)) and len(body) >= 2:
+            args, kwargs = body[0], body[1]
+        else:
+            # Not a Celery protocol 2 body, or one which can't be decoded,
+            # so use the representations of the arguments instead.
+            args, kwargs = self.argsrepr, self.kwargsrepr
+        # Sorting keys makes the order keyword arguments were passed in
+        # irrelevant.
+        canonical = json.dumps(
+            [self.task, args, kwargs],
+            sort_keys=True,
+            separators=(",", ":"),
+            default=repr,
+        )
+        return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _decode_raw_body(self) -> Any:
+        """
+        Deserialize a raw body as drain does when not in passthrough mode,
+        so a task has the same dedupe key however it was drained.
+        """
+        from kombu.exceptions import KombuError
+        from kombu.serialization import loads
+
+        try:
+            return loads(self.body, self.content_type, self.content_encoding)
+        except KombuError:
+            return None
+
     def __repr__(self):
         return f"<StoredTask {self.task}: {self.id}>"
 
@@ -108,18 +275,49 @@ class TaskStore(ABC):
     def bulk_save(self, tasks: Iterable[StoredTask]):
         """
         Save multiple tasks.
+
+        Subclasses should override this to write all tasks in a single
+        transaction, so that either every task is saved or none are.
         """
         for task in tasks:
             self.save(task)
 
     @abstractmethod
-    def load_tasks(self, task_name=Optional[str]) -> Iterable[StoredTask]:
+    def load_tasks(
+        self,
+        task_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> Iterable[StoredTask]:
         """
         Load tasks from some persistence layer.
         Subclasses must implement this.
+
+        With ``limit`` or ``after``, tasks are loaded in order of ID: at most
+        ``limit`` tasks, with IDs greater than ``after``. Otherwise they may be
+        loaded in any order.
         """
         ...
 
+    def load_tasks_in_pages(
+        self, task_name: Optional[str] = None, page_size: Optional[int] = None
+    ) -> Iterator[StoredTask]:
+        """
+        Load tasks with a separate :meth:`load_tasks` call for each page of
+        ``page_size`` tasks, rather than from one long running query.
+        Without ``page_size``, all tasks are loaded at once.
+        """
+        if page_size is None:
+            yield from self.load_tasks(task_name)
+            return
+        after = None
+        while True:
+            page = list(self.load_tasks(task_name, limit=page_size, after=after))
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1].id
+
     @abstractmethod
     def delete(self, task: StoredTask):
         """
@@ -128,12 +326,36 @@ class TaskStore(ABC):
         """
         ...
 
-    # Optional functionality
+    def count_by_task(self, task_name: Optional[str] = None) -> Dict[str, int]:
+        """
+        Count stored tasks by task name, optionally
+        only those with the given name.
+
+        The default implementation loads every task. Subclasses should
+        override it with something that doesn't.
+        """
+        return dict(Counter(task.task for task in self.load_tasks(task_name)))
+
+    def delete_many(self, tasks: Iterable[StoredTask]):
+        """
+        Remove multiple tasks.
+
+        Subclasses should override this to remove all tasks in a single
+        transaction.
+        """
+        for task in tasks:
+            self.delete(task)
 
     def dedupe(self) -> int:
         """
         Remove duplicate tasks from the store.
 
         Returns the number of tasks removed.
+
+        The default implementation streams every task from the store,
+        using bounded memory. See :mod:`taskrabbit.stores.dedupe`.
+        Subclasses may override it with something faster.
         """
-        raise NotImplementedError()
+        from .dedupe import dedupe
+
+        return dedupe(self)
@@ -0,0 +1,73 @@
+"""
+Buffer tasks in memory and write them to a TaskStore in batches.
+"""
+import time
+from typing import Any, List, Optional
+
+from .base import StoredTask, TaskStore
+
+
+class TaskBatch:
+    """
+    Collect tasks until ``size`` tasks are buffered, or ``interval`` seconds
+    have passed since the first one was added, then write them all with a
+    single call to :meth:`TaskStore.bulk_save`.
+
+    Each task may be accompanied by an arbitrary ``item``, such as the kombu
+    Message it was decoded from. Items are handed back by :meth:`flush` once
+    their tasks have been saved, and by :meth:`clear` when they have not.
+    """
+
+    def __init__(
+        self, store: TaskStore, size: int = 1, interval: Optional[float] = None
+    ):
+        self.store = store
+        self.size = max(size, 1)
+        self.interval = interval
+        self.tasks: List[StoredTask] = []
+        self.items: List[Any] = []
+        self.started: Optional[float] = None
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task: StoredTask, item: Any = None):
+        if not self.tasks:
+            self.started = time.monotonic()
+        self.tasks.append(task)
+        self.items.append(item)
+
+    @property
+    def full(self) -> bool:
+        return len(self.tasks) >= self.size
+
+    @property
+    def due(self) -> bool:
+        """
+        True if the batch is full, or its oldest task has waited
+        longer than ``interval`` seconds.
+        """
+        if not self.tasks:
+            return False
+        if self.full or self.interval is None:
+            return self.full
+        return time.monotonic() - self.started >= self.interval
+
+    def clear(self) -> List[Any]:
+        """
+        Discard buffered tasks, returning their items.
+        """
+        items = self.items
+        self.tasks, self.items, self.started = [], [], None
+        return items
+
+    def flush(self) -> List[Any]:
+        """
+        Save buffered tasks, returning their items.
+
+        If the store raises, the buffer is left intact so the caller can
+        :meth:`clear` it and deal with the unsaved items.
+        """
+        if self.tasks:
+            self.store.bulk_save(self.tasks)
+        return self.clear()
@@ -0,0 +1,195 @@
+"""
+De-duplicate any TaskStore, in bounded memory.
+
+Tasks are streamed from the store, and duplicates found by their
+:attr:`~taskrabbit.stores.base.StoredTask.dedupe_key`. Keys are held in
+memory until there are more than ``max_keys`` of them. From then on, keys are
+spilled to partition files on disk by hash, and each partition is
+de-duplicated in memory on its own once every task has been read.
+
+As with the SQL stores, the task with the greatest ID is kept out of each set
+of duplicates.
+"""
+import logging
+import os
+import tempfile
+import time
+from itertools import islice
+from typing import Callable, Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+from .base import StoredTask, TaskStore
+
+# Number of dedupe keys held in memory before they are spilled to disk.
+DEFAULT_MAX_KEYS = 1_000_000
+# Number of partitions keys are spilled to. Each one is de-duplicated in
+# memory, so stores with up to about PARTITIONS * max_keys tasks can be
+# de-duplicated without exceeding max_keys keys in memory.
+PARTITIONS = 64
+DEFAULT_DELETE_BATCH_SIZE = 1000
+# Seconds between progress log messages.
+PROGRESS_INTERVAL = 5.0
+
+
+class Progress:
+    """
+    Log the number of tasks processed, and the rate they're processed at,
+    every PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, action: str):
+        self.action = action
+        self.count = 0
+        self.started = self.logged = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.count / max(time.monotonic() - self.started, 1e-9)
+
+    def update(self, count: int = 1, duplicates: Optional[int] = None):
+        self.count += count
+        now = time.monotonic()
+        if now - self.logged >= PROGRESS_INTERVAL:
+            self.logged = now
+            self.log(duplicates)
+
+    def log(self, duplicates: Optional[int] = None):
+        message = f"{self.action} {self.count} tasks ({self.rate:.0f}/s)"
+        if duplicates is not None:
+            message += f", {duplicates} duplicates found"
+        logging.info(message)
+
+
+class Duplicates:
+    """
+    Find duplicates among (key, task ID) pairs.
+
+    Loser IDs, of the tasks which are not kept, are written to a file,
+    so they don't take up memory either.
+    """
+
+    def __init__(self, losers: IO[str]):
+        self.winners: Dict[str, str] = {}
+        self.losers = losers
+        self.count = 0
+
+    def add(self, key: str, task_id: str):
+        winner = self.winners.get(key)
+        if winner is None:
+            self.winners[key] = task_id
+            return
+        if task_id == winner:
+            # The same task read twice. Deleting it as a loser would
+            # delete the winner too.
+            return
+        if task_id > winner:
+            self.winners[key], task_id = task_id, winner
+        self.losers.write(task_id + "\n")
+        self.count += 1
+
+
+def _partition(key: str) -> int:
+    return int(key[:8], 16) % PARTITIONS
+
+
+def _read_pairs(path: str) -> Iterator[List[str]]:
+    with open(path) as f:
+        for line in f:
+            yield line.rstrip("\n").split(" ", 1)
+
+
+def dedupe(
+    store: TaskStore,
+    max_keys: int = DEFAULT_MAX_KEYS,
+    delete_batch_size: int = DEFAULT_DELETE_BATCH_SIZE,
+    directory: Optional[str] = None,
+) -> int:
+    """
+    Remove duplicate tasks from ``store``, keeping spilled keys in a
+    temporary directory inside ``directory``.
+
+    Duplicates are removed with :meth:`TaskStore.delete_many`, which is
+    given tasks that only have an ID.
+
+    Returns the number of tasks removed.
+    """
+
+    def delete(task_ids: List[str]):
+        store.delete_many(
+            [
+                StoredTask(headers={"id": task_id}, body=None, routing_key=None)
+                for task_id in task_ids
+            ]
+        )
+
+    return dedupe_pairs(
+        ((task.dedupe_key, task.id) for task in store.load_tasks()),
+        delete,
+        max_keys,
+        delete_batch_size,
+        directory,
+    )
+
+
+def dedupe_pairs(
+    pairs: Iterable[Tuple[str, str]],
+    delete: Callable[[List[str]], None],
+    max_keys: int = DEFAULT_MAX_KEYS,
+    delete_batch_size: int = DEFAULT_DELETE_BATCH_SIZE,
+    directory: Optional[str] = None,
+) -> int:
+    """
+    Find duplicates among (dedupe key, task ID) pairs, and pass the IDs of
+    every task but the one with the greatest ID in each set to ``delete``,
+    in batches. IDs may be any string without a newline, e.g. one which
+    also says where the task is kept.
+
+    Returns the number of tasks removed.
+    """
+    with tempfile.TemporaryDirectory(prefix="taskrabbit-dedupe-", dir=directory) as tmp:
+        losers_path = os.path.join(tmp, "losers")
+        with open(losers_path, "w") as losers:
+            duplicates = Duplicates(losers)
+            partitions: List[IO[str]] = []
+            progress = Progress("Scanned")
+            for key, task_id in pairs:
+                if partitions:
+                    partitions[_partition(key)].write(f"{key} {task_id}\n")
+                else:
+                    duplicates.add(key, task_id)
+                    if len(duplicates.winners) > max_keys:
+                        logging.info(
+                            "More than %d distinct tasks, spilling to disk", max_keys
+                        )
+                        partitions = [
+                            open(os.path.join(tmp, f"partition{i}"), "w")
+                            for i in range(PARTITIONS)
+                        ]
+                        for spilled_key, spilled_id in duplicates.winners.items():
+                            partitions[_partition(spilled_key)].write(
+                                f"{spilled_key} {spilled_id}\n"
+                            )
+                        duplicates.winners.clear()
+                progress.update(duplicates=duplicates.count)
+            progress.log()
+
+            for number, partition in enumerate(partitions):
+                partition.close()
+                for key, task_id in _read_pairs(partition.name):
+                    duplicates.add(key, task_id)
+                duplicates.winners.clear()
+                os.remove(partition.name)
+                logging.debug("De-duplicated partition %d", number)
+        logging.info("Found %d duplicate tasks", duplicates.count)
+
+        progress = Progress("Deleted")
+        with open(losers_path) as losers:
+            ids = (line.rstrip("\n") for line in losers)
+            while True:
+                batch = list(islice(ids, delete_batch_size))
+                if not batch:
+                    break
+                delete(batch)
+                progress.update(len(batch))
+        if progress.count:
+            progress.log()
+        return progress.count
@@ -1,32 +1,203 @@
+import hashlib
 import os
 from pathlib import Path
-from typing import Iterable, Optional
+from typing import Dict, IO, Iterable, Iterator, Optional, Set
+from urllib.parse import quote, unquote
 
 from taskrabbit.config import FileConfig
+from taskrabbit.serialization import frame, unframe
 from .base import TaskStore, StoredTask
 
+# Directory of the sharded layout's task name manifests. Each manifest
+# lists the IDs of tasks saved with that name, one per line.
+MANIFEST_DIR = ".manifests"
+
 
 class FileTaskStore(TaskStore):
+    """
+    Store each task as a file named after the task ID. Files are
+    JSON, unless the store is configured with a binary codec.
+
+    With the ``flat`` layout, all files are kept in one directory. The
+    ``sharded`` layout spreads them over two levels of subdirectories named
+    from a hash of the ID (``ab/cd/<id>``), so no directory grows too big to
+    list. It also keeps a manifest of task IDs for each task name, so loading
+    tasks with a given name reads only those tasks.
+    """
+
     config_class = FileConfig
 
     def __init__(self, cfg: FileConfig):
         self.path = Path() / cfg.directory
         self.path.mkdir(parents=True, exist_ok=True)
+        self.sharded = cfg.layout == "sharded"
+        self.codec = cfg.get_codec()
+        self.manifest_path = self.path / MANIFEST_DIR
+        if self.sharded:
+            self.manifest_path.mkdir(exist_ok=True)
+        self._shards: Set[Path] = set()
+        self._manifests: Dict[str, IO[str]] = {}
+
+    def _task_path(self, task_id: str) -> Path:
+        if not self.sharded:
+            return self.path / task_id
+        digest = hashlib.md5(task_id.encode("utf-8")).hexdigest()
+        return self.path / digest[:2] / digest[2:4] / task_id
+
+    def _manifest(self, task_name: str) -> Path:
+        return self.manifest_path / quote(task_name, safe="")
+
+    def _add_to_manifest(self, task: StoredTask):
+        manifest = self._manifests.get(task.task)
+        if manifest is None:
+            manifest = open(self._manifest(task.task), "a")
+            self._manifests[task.task] = manifest
+        manifest.write(task.id + "\n")
+
+    def _flush_manifests(self):
+        for manifest in self._manifests.values():
+            manifest.flush()
+
+    def _manifest_ids(self, task_name: str) -> Iterable[str]:
+        try:
+            with open(self._manifest(task_name)) as f:
+                # Drop repeats, from tasks saved more than once.
+                return list(dict.fromkeys(line.rstrip("\n") for line in f))
+        except FileNotFoundError:
+            return []
+
+    def _compact_manifest(self, task_name: str):
+        """
+        Rewrite a manifest without the IDs of deleted tasks.
+        """
+        ids = [i for i in self._manifest_ids(task_name) if self._task_path(i).exists()]
+        manifest = self._manifests.pop(task_name, None)
+        if manifest is not None:
+            manifest.close()
+        path = self._manifest(task_name)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.writelines(i + "\n" for i in ids)
+        os.replace(tmp_path, path)
+
+    def _scan(self, path: Path, depth: int) -> Iterator[str]:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if depth:
+                    if entry.is_dir():
+                        yield from self._scan(Path(entry.path), depth - 1)
+                elif entry.is_file():
+                    yield entry.path
+
+    def _read(self, path) -> StoredTask:
+        with open(path, "rb") as f:
+            format, record = unframe(f.read())
+        return StoredTask.decode(record, format)
+
+    def _write(self, task: StoredTask):
+        path = self._task_path(task.id)
+        if self.sharded and path.parent not in self._shards:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._shards.add(path.parent)
+        with open(path, "wb") as f:
+            f.write(frame(self.codec.format, task.encode(self.codec)))
+        if self.sharded:
+            self._add_to_manifest(task)
 
     def save(self, task: StoredTask):
-        with open(self.path / task.id, "w") as f:
-            f.write(task.json())
+        self._write(task)
+        self._flush_manifests()
+
+    def bulk_save(self, tasks: Iterable[StoredTask]):
+        for task in tasks:
+            self._write(task)
+        self._flush_manifests()
+
+    def _load_ordered(
+        self, task_name: Optional[str], limit: Optional[int], after: Optional[str]
+    ) -> Iterator[StoredTask]:
+        # Task IDs are file names, so tasks can be put in order by listing
+        # them, and only the tasks on the page need be read.
+        if self.sharded and task_name is not None:
+            ids = sorted(
+                task_id
+                for task_id in self._manifest_ids(task_name)
+                if after is None or task_id > after
+            )
+            paths: Iterable[str] = map(str, map(self._task_path, ids))
+        else:
+            paths = sorted(
+                (
+                    path
+                    for path in self._scan(self.path, depth=2 if self.sharded else 0)
+                    if after is None or os.path.basename(path) > after
+                ),
+                key=os.path.basename,
+            )
+        count = 0
+        for path in paths:
+            if limit is not None and count >= limit:
+                return
+            try:
+                task = self._read(path)
+            except FileNotFoundError:
+                continue
+            if task_name is None or task.task == task_name:
+                count += 1
+                yield task
+
+    def load_tasks(
+        self,
+        task_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> Iterable[StoredTask]:
+        if limit is not None or after is not None:
+            yield from self._load_ordered(task_name, limit, after)
+            return
+        if self.sharded and task_name is not None:
+            stale = 0
+            for task_id in self._manifest_ids(task_name):
+                try:
+                    yield self._read(self._task_path(task_id))
+                except FileNotFoundError:
+                    stale += 1
+            if stale:
+                self._compact_manifest(task_name)
+            return
+        for path in self._scan(self.path, depth=2 if self.sharded else 0):
+            task = self._read(path)
+            if task_name is None or task.task == task_name:
+                yield task
 
-    def load_tasks(self, task_name: Optional[str] = None) -> Iterable[StoredTask]:
-        for path in self.path.glob("*"):
-            with open(path) as f:
-                data = f.read()
-                task = StoredTask.from_string(data)
-                if task_name is None or task.task == task_name:
-                    yield task
+    def count_by_task(self, task_name: Optional[str] = None) -> Dict[str, int]:
+        if not self.sharded:
+            return super().count_by_task(task_name)
+        # Count the IDs in the manifests, checking that each task still
+        # exists, rather than reading the tasks.
+        if task_name is None:
+            names = [
+                unquote(entry.name)
+                for entry in os.scandir(self.manifest_path)
+                if not entry.name.endswith(".tmp")
+            ]
+        else:
+            names = [task_name]
+        counts = {}
+        for name in names:
+            count = sum(
+                1
+                for task_id in self._manifest_ids(name)
+                if self._task_path(task_id).exists()
+            )
+            if count:
+                counts[name] = count
+        return counts
 
     def delete(self, task: StoredTask):
         try:
-            os.remove(self.path / task.id)
+            os.remove(self._task_path(task.id))
         except FileNotFoundError:
             pass
@@ -2,20 +2,88 @@
 Store tasks in PostgreSQL.
 """
 import logging
-from typing import Iterable, Optional
-
-import psycopg2 as pg
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, Optional, Sequence, Union
+from uuid import uuid4
 
 from taskrabbit.config import PostgresConfig
 from .base import StoredTask, TaskStore
 
+if TYPE_CHECKING:
+    import psycopg2.extensions
+
+
+# Escapes for the PostgreSQL COPY text format.
+# See https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.2
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\n": "\\n", "\r": "\\r", "\t": "\\t"})
+
+# Number of rows given a dedupe key at a time, when de-duplicating
+# a store with rows which don't have one yet.
+BACKFILL_BATCH_SIZE = 1000
+
+# Columns written for each task, in the order of PostgresTaskStore._row.
+COLUMNS = "id, task, args, kwargs, task_data, codec, task_blob, dedupe_key"
+
+
+def encode_copy_value(value: Union[None, str, bytes]) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bytes):
+        # bytea hex format, with its backslash escaped.
+        return "\\\\x" + value.hex()
+    return value.translate(COPY_ESCAPES)
+
+
+def encode_copy_row(row: Sequence[Union[None, str, bytes]]) -> str:
+    """
+    Encode a row of values as a line of COPY text format.
+    """
+    return "\t".join(map(encode_copy_value, row)) + "\n"
+
+
+class CopyReader:
+    """
+    Read-only file-like object which encodes rows for ``COPY ... FROM STDIN``
+    as psycopg2 asks for them, so only a buffer's worth of rows is ever
+    held in memory.
+    """
+
+    def __init__(self, rows: Iterable[Sequence[Union[None, str, bytes]]]):
+        self.rows: Iterator[Sequence[Union[None, str, bytes]]] = iter(rows)
+        self.buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        lines = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            line = encode_copy_row(row)
+            lines.append(line)
+            length += len(line)
+        data = "".join(lines)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
 
 class PostgresTaskStore(TaskStore):
     config_class = PostgresConfig
 
     def __init__(self, cfg: PostgresConfig):
-        self.conn = pg.connect(dsn=cfg.get_dsn())
+        # Imported here rather than with the module, which the CLI imports
+        # whenever this store is configured, to keep its startup fast.
+        import psycopg2
+
+        self.conn = psycopg2.connect(dsn=cfg.get_dsn())
+        self.itersize = cfg.itersize
+        self.codec = cfg.get_codec()
+        self.dedupe_on_ingest = cfg.dedupe_on_ingest
         self.create_table()
+        if self.dedupe_on_ingest:
+            # Rows saved without dedupe_on_ingest have no key to check against.
+            self._backfill_dedupe_keys()
 
     def create_table(self):
         with self.conn.cursor() as c:
@@ -30,8 +98,24 @@ class PostgresTaskStore(TaskStore):
             )
             """
             )
+            # Added since the table was first created. JSON records are still
+            # kept in task_data, while records in other formats are kept in
+            # task_blob, with their format in codec.
+            c.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS codec text")
+            c.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS task_blob bytea")
+            # StoredTask.dedupe_key. Only set on insert with dedupe_on_ingest,
+            # otherwise NULL until dedupe first runs.
+            c.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS dedupe_key text")
+            c.execute(
+                """
+            CREATE INDEX IF NOT EXISTS tasks_dedupe_key ON tasks (dedupe_key, id)
+            """
+            )
+            # Serves filtering and counting by task name.
+            c.execute("CREATE INDEX IF NOT EXISTS tasks_task ON tasks (task)")
+        self.conn.commit()
 
-    def execute(self, query: str, *params) -> pg.extensions.cursor:
+    def execute(self, query: str, *params) -> "psycopg2.extensions.cursor":
         c = self.conn.cursor()
         try:
             logging.debug(c.mogrify(query, params))
@@ -43,25 +127,94 @@ class PostgresTaskStore(TaskStore):
             raise
         return c
 
+    def _row(self, task: StoredTask):
+        record = task.encode(self.codec)
+        if self.codec.format == "json":
+            task_data, task_blob = record.decode("utf-8"), None
+        else:
+            task_data, task_blob = None, record
+        return (
+            task.id,
+            task.task,
+            task.argsrepr,
+            task.kwargsrepr,
+            task_data,
+            self.codec.format,
+            task_blob,
+            # Only needed to skip duplicates on insert. dedupe fills it in.
+            task.dedupe_key if self.dedupe_on_ingest else None,
+        )
+
     def save(self, task: StoredTask):
+        if self.dedupe_on_ingest:
+            row = self._row(task)
+            self.execute(
+                f"""
+            INSERT INTO tasks ({COLUMNS})
+            SELECT %s, %s, %s, %s, %s, %s, %s, %s
+            WHERE NOT EXISTS (SELECT 1 FROM tasks WHERE dedupe_key = %s)
+            ON CONFLICT (id) DO NOTHING
+            """,
+                *row,
+                row[-1],
+            )
+            return
         self.execute(
-            """
-            INSERT INTO tasks
+            f"""
+            INSERT INTO tasks ({COLUMNS})
             VALUES
-                (%s, %s, %s, %s, %s)
+                (%s, %s, %s, %s, %s, %s, %s, %s)
             ON CONFLICT (id) DO NOTHING
         """,
-            task.id,
-            task.task,
-            task.argsrepr,
-            task.kwargsrepr,
-            task.json(),
+            *self._row(task),
         )
 
     def bulk_save(self, tasks: Iterable[StoredTask]):
-        # https://stackoverflow.com/a/12207237/21245
+        # COPY can't skip conflicting rows, so stream the tasks into a
+        # temporary (and therefore unlogged) staging table, then move them
+        # into the tasks table with a single INSERT.
         # https://www.psycopg.org/docs/usage.html#using-copy-to-and-copy-from
-        pass
+        with self.conn.cursor() as c:
+            try:
+                c.execute(
+                    """
+                CREATE TEMP TABLE IF NOT EXISTS tasks_staging
+                    (LIKE tasks INCLUDING DEFAULTS)
+                    ON COMMIT DELETE ROWS
+                """
+                )
+                c.copy_expert(
+                    f"COPY tasks_staging ({COLUMNS}) FROM STDIN",
+                    CopyReader(map(self._row, tasks)),
+                )
+                if self.dedupe_on_ingest:
+                    # Only the first of any duplicates in the batch, and only
+                    # if there's no duplicate already stored.
+                    c.execute(
+                        f"""
+                    INSERT INTO tasks ({COLUMNS})
+                    SELECT DISTINCT ON (dedupe_key) {COLUMNS}
+                    FROM tasks_staging AS new
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM tasks WHERE tasks.dedupe_key = new.dedupe_key
+                    )
+                    ORDER BY dedupe_key
+                    ON CONFLICT (id) DO NOTHING
+                    """
+                    )
+                else:
+                    c.execute(
+                        f"""
+                    INSERT INTO tasks ({COLUMNS})
+                    SELECT {COLUMNS} FROM tasks_staging
+                    ON CONFLICT (id) DO NOTHING
+                    """
+                    )
+                self.conn.commit()
+            except Exception as e:
+                logging.exception(e)
+                self.conn.rollback()
+                raise
 
     def delete(self, task: StoredTask):
         self.execute(
@@ -72,26 +225,114 @@ class PostgresTaskStore(TaskStore):
             task.id,
         )
 
-    def load_tasks(self, task_name: Optional[str] = None) -> Iterable[StoredTask]:
+    def delete_many(self, tasks: Iterable[StoredTask]):
+        self.execute(
+            """
+        DELETE FROM tasks
+        WHERE id = ANY(%s)
+        """,
+            [task.id for task in tasks],
+        )
+
+    def load_tasks(
+        self,
+        task_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> Iterable[StoredTask]:
+        query = "SELECT task_data::text, codec, task_blob FROM tasks"
+        conditions, params = [], []
         if task_name is None:
             logging.debug("loading tasks")
-            cursor = self.execute("SELECT task_data FROM tasks")
         else:
             logging.debug("loading tasks with task name: %s", task_name)
+            conditions.append("task=%s")
+            params.append(task_name)
+        if after is not None:
+            conditions.append("id>%s")
+            params.append(after)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if limit is not None or after is not None:
+            # Ordered by ID, so the last ID of one page is where the next starts.
+            query += " ORDER BY id"
+            if limit is not None:
+                query += " LIMIT %s"
+                params.append(limit)
+        log_rows = logging.getLogger().isEnabledFor(logging.DEBUG)
+        # A named cursor leaves the result set on the server, and fetches
+        # `itersize` rows per round trip as we iterate. WITH HOLD keeps it
+        # open across commits made while tasks are being consumed, such as
+        # fill deleting each task once it has been published.
+        cursor = self.conn.cursor(name=f"load_tasks_{uuid4().hex}", withhold=True)
+        cursor.itersize = self.itersize
+        try:
+            cursor.execute(query, params)
+            for row in cursor:
+                if log_rows:
+                    logging.debug("row=%s", row)
+                task_data, codec, task_blob = row
+                if task_blob is None:
+                    yield StoredTask.from_string(task_data)
+                else:
+                    yield StoredTask.decode(bytes(task_blob), codec)
+        finally:
+            cursor.close()
+            self.conn.commit()
+
+    def count_by_task(self, task_name: Optional[str] = None) -> Dict[str, int]:
+        if task_name is None:
+            cursor = self.execute("SELECT task, count(*) FROM tasks GROUP BY task")
+        else:
             cursor = self.execute(
-                "SELECT task_data FROM tasks WHERE task=%s", task_name
+                "SELECT task, count(*) FROM tasks WHERE task=%s GROUP BY task",
+                task_name,
             )
-        for row in cursor.fetchall():
-            logging.debug(f"{row=}")
-            yield StoredTask(**row[0])
+        return dict(cursor.fetchall())
+
+    def _backfill_dedupe_keys(self):
+        from psycopg2.extras import execute_values
+
+        while True:
+            rows = self.execute(
+                """
+            SELECT id, task_data::text, codec, task_blob FROM tasks
+            WHERE dedupe_key IS NULL
+            LIMIT %s
+            """,
+                BACKFILL_BATCH_SIZE,
+            ).fetchall()
+            if not rows:
+                return
+            keys = []
+            for task_id, task_data, codec, task_blob in rows:
+                if task_blob is None:
+                    task = StoredTask.from_string(task_data)
+                else:
+                    task = StoredTask.decode(bytes(task_blob), codec)
+                keys.append((task_id, task.dedupe_key))
+            with self.conn.cursor() as c:
+                execute_values(
+                    c,
+                    """
+                UPDATE tasks SET dedupe_key = keys.dedupe_key
+                FROM (VALUES %s) AS keys (id, dedupe_key)
+                WHERE tasks.id = keys.id
+                """,
+                    keys,
+                )
+            self.conn.commit()
 
     def dedupe(self) -> int:
+        self._backfill_dedupe_keys()
+        # Keep the task with the greatest ID of each set of duplicates.
         cur = self.execute(
             """
         DELETE FROM tasks
-        WHERE id not in (
-            SELECT max(id) from tasks
-            GROUP BY task, args, kwargs
+        WHERE EXISTS (
+            SELECT 1 FROM tasks AS newer
+            WHERE newer.dedupe_key = tasks.dedupe_key
+            AND newer.id > tasks.id
         );
         """
         )
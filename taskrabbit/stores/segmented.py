@@ -0,0 +1,300 @@
+"""
+Store tasks in append-only, newline-delimited segment files.
+
+Each segment is a pair of files in the store directory:
+
+``<number>.seg``
+    Records, each followed by a newline. A record is either a task,
+    serialized with the store's codec, or a JSON tombstone
+    ``{"deleted": "<task id>"}`` written when a task is deleted.
+
+``<number>.idx``
+    One JSON line per record in the segment. For a task,
+    ``["P", offset, task id, task name, length, format]``, and for a
+    tombstone, ``["D", offset, task id]``. Offset is the byte position of
+    the record in the ``.seg`` file, and length its size in bytes.
+    Stores written before there was a choice of codec have neither length
+    nor format in their index, and hold only JSON records.
+
+Records are only ever appended to the newest segment, which is closed and
+replaced by a new one once it reaches ``segment_size`` bytes. Reading the
+indexes is enough to know which tasks are live, and where each one is, so
+loading tasks reads the segments sequentially and decodes only the records
+that are needed. Once every task in the oldest segments has been deleted,
+those segments are removed.
+
+The segment and index files are written through separate buffers, so a
+crash can leave a record without an index entry, which is ignored, an index
+entry cut short, or entries for records which never reached the segment.
+When the store is opened, the newest index is truncated before the first
+entry which is incomplete, or points past the end of the segment.
+"""
+import heapq
+import json
+import logging
+import os
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+from taskrabbit.config import SegmentedFileConfig
+from .base import StoredTask, TaskStore
+
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+PUT = "P"
+DELETE = "D"
+
+
+def _written(entry: list, data_size: int) -> bool:
+    """
+    True if an index entry's record is wholly within the first ``data_size``
+    bytes of its segment.
+    """
+    offset = entry[1]
+    if entry[0] == PUT and len(entry) > 4:
+        return offset + entry[4] <= data_size
+    return offset < data_size
+
+
+class SegmentedFileTaskStore(TaskStore):
+    config_class = SegmentedFileConfig
+
+    def __init__(self, cfg: SegmentedFileConfig):
+        self.path = Path() / cfg.directory
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = cfg.segment_size
+        self.codec = cfg.get_codec()
+        # Task ID -> (segment number, offset) of every live task.
+        self.locations: Dict[str, Tuple[int, int]] = {}
+        # Segment number -> number of live tasks in it.
+        self.live_counts: Counter = Counter()
+        self.segments: List[int] = sorted(
+            int(entry.name[: -len(SEGMENT_SUFFIX)])
+            for entry in os.scandir(self.path)
+            if entry.name.endswith(SEGMENT_SUFFIX)
+        )
+        if self.segments:
+            # Only the newest segment was being written to.
+            self._repair_index(self.segments[-1])
+        for segment in self.segments:
+            for entry in self._read_index(segment):
+                self._apply(segment, entry)
+        self._open_segment(self.segments[-1] if self.segments else 1)
+
+    def _segment_path(self, segment: int, suffix: str) -> Path:
+        return self.path / f"{segment:010d}{suffix}"
+
+    def _read_index(self, segment: int) -> Iterable[list]:
+        with open(self._segment_path(segment, INDEX_SUFFIX), "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # An entry cut short by a crash, which left its record
+                    # without an index entry, so it never happened.
+                    logging.warning(
+                        "Ignoring incomplete index entry in segment %d", segment
+                    )
+
+    def _repair_index(self, segment: int):
+        """
+        Truncate a segment's index before its first entry which is incomplete,
+        or whose record isn't wholly in the segment. Entries are written in
+        the same order as their records, so every entry after it is too.
+        """
+        data_size = self._segment_path(segment, SEGMENT_SUFFIX).stat().st_size
+        index_path = self._segment_path(segment, INDEX_SUFFIX)
+        with open(index_path, "rb+") as f:
+            position = 0
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    entry = None
+                if (
+                    not line.endswith(b"\n")
+                    or entry is None
+                    or not _written(entry, data_size)
+                ):
+                    logging.warning(
+                        "Dropping index entries of segment %d from byte %d, "
+                        "left incomplete by a crash",
+                        segment,
+                        position,
+                    )
+                    f.truncate(position)
+                    return
+                position += len(line)
+
+    def _apply(self, segment: int, entry: list):
+        op, offset, task_id = entry[:3]
+        previous = self.locations.pop(task_id, None)
+        if previous is not None:
+            self.live_counts[previous[0]] -= 1
+        if op == PUT:
+            self.locations[task_id] = (segment, offset)
+            self.live_counts[segment] += 1
+
+    def _open_segment(self, segment: int):
+        if segment not in self.segments:
+            self.segments.append(segment)
+        self.active = segment
+        self.data = open(self._segment_path(segment, SEGMENT_SUFFIX), "ab")
+        self.index = open(self._segment_path(segment, INDEX_SUFFIX), "ab")
+        self.active_size = self.data.tell()
+
+    def _close_segment(self):
+        self.data.close()
+        self.index.close()
+
+    def _append(self, record: bytes, op: str, task_id: str, *extra):
+        if self.active_size >= self.segment_size:
+            self._close_segment()
+            self._open_segment(self.active + 1)
+        entry = [op, self.active_size, task_id, *extra]
+        # Write the record before its index entry. Either may reach the disk
+        # first, but on opening, entries for missing records are dropped.
+        self.data.write(record + b"\n")
+        self.index.write(json.dumps(entry).encode("utf-8") + b"\n")
+        self.active_size += len(record) + 1
+        self._apply(self.active, entry)
+
+    def _flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def _remove_empty_segments(self):
+        # Only remove the oldest segments. A tombstone can only refer to a task
+        # in its own or an older segment, so a tombstone is never removed
+        # while the task it deletes could still be read back.
+        for segment in self.segments[:-1]:
+            if self.live_counts[segment] > 0:
+                break
+            logging.debug("Removing empty segment %d", segment)
+            for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+                os.remove(self._segment_path(segment, suffix))
+            self.segments.remove(segment)
+            del self.live_counts[segment]
+
+    def _put(self, task: StoredTask):
+        # Like the SQL stores, ignore tasks which are already stored.
+        if task.id not in self.locations:
+            record = task.encode(self.codec)
+            self._append(
+                record, PUT, task.id, task.task, len(record), self.codec.format
+            )
+
+    def _tombstone(self, task: StoredTask):
+        if task.id in self.locations:
+            record = json.dumps({"deleted": task.id}).encode("utf-8")
+            self._append(record, DELETE, task.id)
+
+    def save(self, task: StoredTask):
+        self._put(task)
+        self._flush()
+
+    def bulk_save(self, tasks: Iterable[StoredTask]):
+        for task in tasks:
+            self._put(task)
+        self._flush()
+
+    def delete(self, task: StoredTask):
+        self._tombstone(task)
+        self._flush()
+        self._remove_empty_segments()
+
+    def delete_many(self, tasks: Iterable[StoredTask]):
+        for task in tasks:
+            self._tombstone(task)
+        self._flush()
+        self._remove_empty_segments()
+
+    def _live_entries(self, segment: int, task_name: Optional[str]) -> List[list]:
+        """
+        Index entries of the live tasks in a segment, in the order they
+        were written, as ``[task id, offset, task name, length, format]``,
+        or ``[task id, offset, task name]`` in older stores.
+        """
+        return [
+            [task_id, offset, *extra]
+            for op, offset, task_id, *extra in self._read_index(segment)
+            if op == PUT
+            and self.locations.get(task_id) == (segment, offset)
+            and (task_name is None or extra[0] == task_name)
+        ]
+
+    def count_by_task(self, task_name: Optional[str] = None) -> Dict[str, int]:
+        # Task names are in the indexes, so no records need to be read.
+        self._flush()
+        counts: Counter = Counter()
+        for segment in self.segments:
+            counts.update(entry[2] for entry in self._live_entries(segment, task_name))
+        return dict(counts)
+
+    def _read_record(self, f: IO[bytes], offset: int, *length_and_format):
+        f.seek(offset)
+        if length_and_format:
+            length, format = length_and_format
+            return StoredTask.decode(f.read(length), format)
+        return StoredTask.from_string(f.readline())
+
+    def _load_ordered(
+        self, task_name: Optional[str], limit: Optional[int], after: Optional[str]
+    ) -> Iterator[StoredTask]:
+        # The indexes hold every task ID, so tasks can be put in order without
+        # reading any records, then only the records on the page are read.
+        entries = [
+            (task_id, segment, offset, *length_and_format)
+            for segment in self.segments
+            for task_id, offset, _, *length_and_format in self._live_entries(
+                segment, task_name
+            )
+            if after is None or task_id > after
+        ]
+        if limit is None:
+            entries.sort()
+        else:
+            entries = heapq.nsmallest(limit, entries)
+        with ExitStack() as stack:
+            files: Dict[int, IO[bytes]] = {}
+            for task_id, segment, offset, *length_and_format in entries:
+                if self.locations.get(task_id) != (segment, offset):
+                    # Deleted since the page was listed.
+                    continue
+                if segment not in files:
+                    files[segment] = stack.enter_context(
+                        open(self._segment_path(segment, SEGMENT_SUFFIX), "rb")
+                    )
+                yield self._read_record(files[segment], offset, *length_and_format)
+
+    def load_tasks(
+        self,
+        task_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> Iterable[StoredTask]:
+        self._flush()
+        if limit is not None or after is not None:
+            yield from self._load_ordered(task_name, limit, after)
+            return
+        for segment in list(self.segments):
+            # Find the live tasks in this segment and read just those records.
+            try:
+                records = [
+                    (offset, *length_and_format)
+                    for _, offset, _, *length_and_format in self._live_entries(
+                        segment, task_name
+                    )
+                ]
+                if not records:
+                    continue
+                f = open(self._segment_path(segment, SEGMENT_SUFFIX), "rb")
+            except FileNotFoundError:
+                # Every task in the segment was deleted while we were
+                # iterating over an earlier one.
+                continue
+            with f:
+                for record in records:
+                    yield self._read_record(f, *record)
@@ -0,0 +1,110 @@
+"""
+Present several stores as one.
+
+A store configured with ``shards`` greater than 1 is split into that many
+stores of the same kind, each with its own path, so ``drain --workers`` can
+write to them in parallel, a worker to each shard. Everything else uses
+them through :class:`ShardedTaskStore`.
+
+A task may be in any shard, depending on which worker drained it, so tasks
+are deleted from every shard. Tasks saved through ShardedTaskStore go to a
+shard chosen by a hash of their ID.
+
+A message redelivered to another worker leaves the same task in two shards.
+Shards are loaded in order of ID and merged, so such a task is loaded, and
+counted, only once, as it would be from a single store. De-duplication
+tells tasks apart by their shard as well as their ID, and deletes each
+duplicate only from the shard it's in.
+"""
+import hashlib
+import heapq
+from collections import defaultdict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+from .base import StoredTask, TaskStore
+from .dedupe import dedupe_pairs
+
+# Separates a task's ID from its shard's index, in the IDs given to
+# dedupe_pairs. Sorts before any character of an ID, so the task with the
+# greatest ID is still the one kept.
+SHARD_SEPARATOR = "\0"
+
+
+def _unique(tasks: Iterable[StoredTask]) -> Iterator[StoredTask]:
+    """
+    Skip tasks with the same ID as the one before.
+    """
+    previous = None
+    for task in tasks:
+        if task.id != previous:
+            previous = task.id
+            yield task
+
+
+class ShardedTaskStore(TaskStore):
+    def __init__(self, shards: Sequence[TaskStore]):
+        self.shards = list(shards)
+
+    def _shard_index(self, task: StoredTask) -> int:
+        digest = hashlib.blake2b(task.id.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % len(self.shards)
+
+    def save(self, task: StoredTask):
+        self.shards[self._shard_index(task)].save(task)
+
+    def bulk_save(self, tasks: Iterable[StoredTask]):
+        # Each shard's tasks are saved in a transaction of their own,
+        # so a batch is only all or nothing within a shard.
+        by_shard: Dict[int, List[StoredTask]] = defaultdict(list)
+        for task in tasks:
+            by_shard[self._shard_index(task)].append(task)
+        for index, shard_tasks in sorted(by_shard.items()):
+            self.shards[index].bulk_save(shard_tasks)
+
+    def delete(self, task: StoredTask):
+        for shard in self.shards:
+            shard.delete(task)
+
+    def delete_many(self, tasks: Iterable[StoredTask]):
+        tasks = list(tasks)
+        for shard in self.shards:
+            shard.delete_many(tasks)
+
+    def load_tasks(
+        self,
+        task_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> Iterable[StoredTask]:
+        # Each shard loads its tasks in order of ID, so merging them keeps
+        # that order, and a task in several shards comes up in a row. Loading
+        # after "" loads every task, in order. No shard need load more than
+        # `limit` tasks.
+        merged = heapq.merge(
+            *(
+                shard.load_tasks(task_name, limit, "" if after is None else after)
+                for shard in self.shards
+            ),
+            key=lambda task: task.id,
+        )
+        return islice(_unique(merged), limit)
+
+    def dedupe(self) -> int:
+        pairs = (
+            (task.dedupe_key, f"{task.id}{SHARD_SEPARATOR}{index}")
+            for index, shard in enumerate(self.shards)
+            for task in shard.load_tasks()
+        )
+
+        def delete(task_ids: List[str]):
+            by_shard: Dict[int, List[StoredTask]] = defaultdict(list)
+            for task_id in task_ids:
+                task_id, _, index = task_id.rpartition(SHARD_SEPARATOR)
+                by_shard[int(index)].append(
+                    StoredTask(headers={"id": task_id}, body=None, routing_key=None)
+                )
+            for index, tasks in sorted(by_shard.items()):
+                self.shards[index].delete_many(tasks)
+
+        return dedupe_pairs(pairs, delete)
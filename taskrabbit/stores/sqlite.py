@@ -1,20 +1,42 @@
 import logging
 import sqlite3
-from typing import Iterable, Optional
+from typing import Dict, Iterable, Optional
 
 from taskrabbit.config import SqliteConfig
 from .base import TaskStore, StoredTask
 
+# Columns added to the tasks table since it was first created,
+# which older stores are migrated to have.
+ADDED_COLUMNS = {
+    # Format of the record in the json column.
+    # NULL in rows written before there was a choice of codec, which are JSON.
+    "codec": "text",
+    # StoredTask.dedupe_key. Only set on insert with dedupe_on_ingest,
+    # otherwise NULL until dedupe first runs.
+    "dedupe_key": "text",
+}
+
+# Number of rows given a dedupe key at a time, when de-duplicating
+# a store with rows which don't have one yet.
+BACKFILL_BATCH_SIZE = 1000
+
 
 class SqliteTaskStore(TaskStore):
     config_class = SqliteConfig
 
     def __init__(self, cfg: SqliteConfig):
         super().__init__()
-        self.conn = sqlite3.connect(cfg.db)
+        # The async engine uses the store from a worker thread. It only ever
+        # uses one thread at a time, so the default same-thread check is lifted.
+        self.conn = sqlite3.connect(cfg.db, check_same_thread=False)
         self.conn.set_trace_callback(logging.debug)
         self.conn.row_factory = sqlite3.Row
+        self.codec = cfg.get_codec()
+        self.dedupe_on_ingest = cfg.dedupe_on_ingest
         self.create_table()
+        if self.dedupe_on_ingest:
+            # Rows saved without dedupe_on_ingest have no key to check against.
+            self._backfill_dedupe_keys()
 
         # execute many writes 1000x faster by not waiting for
         # each transaction to go to disk.
@@ -33,6 +55,24 @@ class SqliteTaskStore(TaskStore):
         )
         """
         )
+        columns = {row["name"] for row in self.execute("PRAGMA table_info(tasks)")}
+        for name, column_type in ADDED_COLUMNS.items():
+            if name not in columns:
+                self.execute(f"ALTER TABLE tasks ADD COLUMN {name} {column_type}")
+        # Serves filtering by task name, as the leftmost column.
+        self.execute(
+            """
+        CREATE INDEX IF NOT EXISTS tasks_task_args_kwargs
+            ON tasks (task, args, kwargs)
+        """
+        )
+        # Serves finding duplicates, and newer duplicates, of a task.
+        self.execute(
+            """
+        CREATE INDEX IF NOT EXISTS tasks_dedupe_key
+            ON tasks (dedupe_key, id)
+        """
+        )
 
     def execute(self, query: str, *params) -> sqlite3.Cursor:
         c = self.conn.cursor()
@@ -44,23 +84,49 @@ class SqliteTaskStore(TaskStore):
             raise
         return c
 
-    def save(self, task: StoredTask):
-        values = (
+    INSERT_QUERY = """
+        INSERT OR IGNORE INTO tasks (id, task, args, kwargs, json, codec, dedupe_key)
+        VALUES
+            (?, ?, ?, ?, ?, ?, ?)
+        """
+
+    # Insert only tasks without a stored duplicate. Within a batch each insert
+    # sees the rows before it, so duplicates within the batch are skipped too.
+    INSERT_NEW_QUERY = """
+        INSERT OR IGNORE INTO tasks (id, task, args, kwargs, json, codec, dedupe_key)
+        SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7
+        WHERE NOT EXISTS (SELECT 1 FROM tasks WHERE dedupe_key = ?7)
+        """
+
+    @property
+    def insert_query(self) -> str:
+        return self.INSERT_NEW_QUERY if self.dedupe_on_ingest else self.INSERT_QUERY
+
+    def _row(self, task: StoredTask):
+        record = task.encode(self.codec)
+        if self.codec.format == "json":
+            # Store JSON as text, so it can still be queried.
+            record = record.decode("utf-8")
+        return (
             task.id,
             task.task,
             task.argsrepr,
             task.kwargsrepr,
-            task.json(indent=0),
-        )
-        self.execute(
-            """
-        INSERT OR IGNORE INTO tasks
-        VALUES
-            (?, ?, ?, ?, ?)
-        """,
-            *values
+            record,
+            self.codec.format,
+            # Only needed to skip duplicates on insert. dedupe fills it in.
+            task.dedupe_key if self.dedupe_on_ingest else None,
         )
 
+    def save(self, task: StoredTask):
+        self.execute(self.insert_query, *self._row(task))
+
+    def bulk_save(self, tasks: Iterable[StoredTask]):
+        # One transaction for the whole batch. The connection context manager
+        # commits on success, and rolls back if any insert fails.
+        with self.conn:
+            self.conn.executemany(self.insert_query, map(self._row, tasks))
+
     def delete(self, task: StoredTask):
         self.execute(
             """
@@ -69,23 +135,80 @@ class SqliteTaskStore(TaskStore):
             task.id,
         )
 
-    def load_tasks(self, task_name: Optional[str] = None) -> Iterable[StoredTask]:
+    def delete_many(self, tasks: Iterable[StoredTask]):
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM tasks WHERE id=?", ((task.id,) for task in tasks)
+            )
+
+    def load_tasks(
+        self,
+        task_name: Optional[str] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> Iterable[StoredTask]:
+        query, conditions, params = "SELECT json, codec FROM tasks", [], []
         if task_name is None:
             logging.debug("loading tasks")
-            cursor = self.execute("SELECT * FROM tasks")
         else:
             logging.debug("loading tasks with task name: '%s'", task_name)
-            cursor = self.execute("SELECT * FROM tasks WHERE task=?", task_name)
-        for row in cursor.fetchall():
-            yield StoredTask.from_string(row["json"])
+            conditions.append("task=?")
+            params.append(task_name)
+        if after is not None:
+            conditions.append("id>?")
+            params.append(after)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if limit is not None or after is not None:
+            # Ordered by ID, so the last ID of one page is where the next starts.
+            query += " ORDER BY id"
+            if limit is not None:
+                query += " LIMIT ?"
+                params.append(limit)
+        cursor = self.execute(query, *params)
+        # Iterating the cursor steps through the result set one row at a time,
+        # rather than reading all of it into memory first.
+        for row in cursor:
+            yield StoredTask.decode(row["json"], row["codec"] or "json")
+
+    def count_by_task(self, task_name: Optional[str] = None) -> Dict[str, int]:
+        # Answered from the tasks_task_args_kwargs index alone.
+        if task_name is None:
+            cursor = self.execute("SELECT task, count(*) FROM tasks GROUP BY task")
+        else:
+            cursor = self.execute(
+                "SELECT task, count(*) FROM tasks WHERE task=? GROUP BY task",
+                task_name,
+            )
+        return dict(cursor.fetchall())
+
+    def _backfill_dedupe_keys(self):
+        while True:
+            rows = self.execute(
+                "SELECT rowid, json, codec FROM tasks WHERE dedupe_key IS NULL LIMIT ?",
+                BACKFILL_BATCH_SIZE,
+            ).fetchall()
+            if not rows:
+                return
+            keys = []
+            for row in rows:
+                task = StoredTask.decode(row["json"], row["codec"] or "json")
+                keys.append((task.dedupe_key, row["rowid"]))
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE tasks SET dedupe_key=? WHERE rowid=?", keys
+                )
 
     def dedupe(self) -> int:
+        self._backfill_dedupe_keys()
+        # Keep the task with the greatest ID of each set of duplicates.
         cur = self.execute(
             """
         DELETE FROM tasks
-        WHERE id not in (
-            SELECT max(id) from tasks
-            GROUP BY task, args, kwargs
+        WHERE EXISTS (
+            SELECT 1 FROM tasks AS newer
+            WHERE newer.dedupe_key = tasks.dedupe_key
+            AND newer.id > tasks.id
         );
         """
         )
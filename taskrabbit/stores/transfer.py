@@ -0,0 +1,125 @@
+"""
+Copy tasks from one store to another, or to and from an archive file.
+
+Tasks are streamed with :meth:`~taskrabbit.stores.base.TaskStore.load_tasks`,
+and written ``batch_size`` at a time with
+:meth:`~taskrabbit.stores.base.TaskStore.bulk_save`, so only a batch of tasks
+is held in memory at once.
+
+An archive holds one task per line, as JSON. It's compressed according to its
+file name: ``.gz`` with gzip, ``.xz`` with xz, and ``.zst`` with zstd, which
+needs the zstandard package. Any other name gives an uncompressed file.
+"""
+import gzip
+import io
+import lzma
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
+from typing import IO, Iterable, Iterator, List, Optional
+
+from taskrabbit.serialization import CODECS, get_codec
+from .base import StoredTask, TaskStore
+from .dedupe import Progress
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+@contextmanager
+def open_archive(path: Path, mode: str) -> Iterator[IO[bytes]]:
+    """
+    Open an archive for reading ("r") or writing ("w"), in binary mode,
+    compressed according to its file name.
+    """
+    suffix = path.suffix.lower()
+    if suffix == ".gz":
+        f = gzip.open(path, mode + "b")
+    elif suffix == ".xz":
+        f = lzma.open(path, mode + "b")
+    elif suffix == ".zst":
+        try:
+            import zstandard
+        except ImportError as exc:
+            raise ValueError(
+                "zstd archives need the zstandard package, "
+                "install taskrabbit[zstd]"
+            ) from exc
+        f = zstandard.open(path, mode + "b")
+        if mode == "r":
+            # Adds reading line by line.
+            f = io.BufferedReader(f)
+    else:
+        f = open(path, mode + "b")
+    with f:
+        yield f
+
+
+def _batches(tasks: Iterable[StoredTask], size: int) -> Iterator[List[StoredTask]]:
+    tasks = iter(tasks)
+    while True:
+        batch = list(islice(tasks, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _save(
+    store: TaskStore, tasks: Iterable[StoredTask], batch_size: int, action: str
+) -> int:
+    progress = Progress(action)
+    for batch in _batches(tasks, batch_size):
+        store.bulk_save(batch)
+        progress.update(len(batch))
+    progress.log()
+    return progress.count
+
+
+def copy_tasks(
+    source: TaskStore,
+    target: TaskStore,
+    task_name: Optional[str] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> int:
+    """
+    Copy tasks from ``source`` to ``target``, optionally only those with the
+    given name. Returns the number of tasks copied.
+    """
+    return _save(target, source.load_tasks(task_name), batch_size, "Copied")
+
+
+def export_tasks(
+    store: TaskStore,
+    path: Path,
+    task_name: Optional[str] = None,
+) -> int:
+    """
+    Write tasks from ``store`` to an archive, optionally only those with the
+    given name. Returns the number of tasks written.
+    """
+    # Both write compact JSON on a single line.
+    codec = get_codec("orjson" if "orjson" in CODECS else "json")
+    progress = Progress("Exported")
+    with open_archive(path, "w") as f:
+        for task in store.load_tasks(task_name):
+            f.write(task.encode(codec) + b"\n")
+            progress.update()
+    progress.log()
+    return progress.count
+
+
+def _read_archive(f: IO[bytes]) -> Iterator[StoredTask]:
+    for line in f:
+        line = line.rstrip(b"\n")
+        if line:
+            yield StoredTask.decode(line, "json")
+
+
+def import_tasks(
+    store: TaskStore, path: Path, batch_size: int = DEFAULT_BATCH_SIZE
+) -> int:
+    """
+    Save the tasks in an archive to ``store``.
+    Returns the number of tasks read from the archive.
+    """
+    with open_archive(path, "r") as f:
+        return _save(store, _read_archive(f), batch_size, "Imported")
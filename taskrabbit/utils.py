@@ -2,8 +2,6 @@ import typer
 from contextlib import contextmanager
 from importlib import import_module
 
-from halo import Halo
-
 SPINNER = "dots12"
 
 
@@ -43,5 +41,7 @@ def import_string(dotted_path):
 
 @contextmanager
 def spinner(text: str):
+    from halo import Halo
+
     with Halo(text=text, spinner=SPINNER):
         yield
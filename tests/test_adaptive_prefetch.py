@@ -0,0 +1,53 @@
+from dataclasses import replace
+
+import pytest
+
+from taskrabbit.operations import AdaptivePrefetch, drain
+
+
+def test_initial_window_holds_two_batches():
+    assert AdaptivePrefetch(100, 10, 1000).count == 200
+    assert AdaptivePrefetch(100, 500, 1000).count == 500
+    assert AdaptivePrefetch(100, 5000, 1000).count == 1000
+    # The maximum wins over two batches.
+    assert AdaptivePrefetch(100, 10, 150).count == 150
+
+
+def test_window_grows_with_tasks_in_flight():
+    prefetch = AdaptivePrefetch(100, 200, 10_000)
+    assert prefetch.resize() is None
+
+    # 2000 tasks/s and 100ms to the broker, so 200 tasks in flight.
+    prefetch.wrote(100, 0.05)
+    prefetch.round_tripped(0.1)
+
+    assert prefetch.target == 400
+    assert prefetch.resize() == 400
+    assert prefetch.count == 400
+    assert prefetch.resize() is None
+
+
+def test_small_drift_does_not_resize():
+    prefetch = AdaptivePrefetch(100, 200, 10_000, tolerance=0.25)
+    prefetch.wrote(100, 0.2)
+    prefetch.round_tripped(0.1)
+
+    assert prefetch.target == 250
+    assert prefetch.resize() is None
+
+
+def test_samples_are_smoothed():
+    prefetch = AdaptivePrefetch(10, 20, 1000, smoothing=0.5)
+    prefetch.round_tripped(0.1)
+    prefetch.round_tripped(0.3)
+
+    assert prefetch.round_trip == pytest.approx(0.2)
+
+
+def test_drain_with_adaptive_prefetch(cfg, queue_name, publish, make_task):
+    publish([make_task(f"t{i}", [i]) for i in range(5)])
+    cfg.drain = replace(cfg.drain, adaptive_prefetch=True, batch_size=2)
+    store = cfg.init_store()
+
+    assert drain(cfg, queue_name, store) == {queue_name: 5}
+    assert store.count_by_task() == {"t.add": 5}
@@ -0,0 +1,48 @@
+import asyncio
+import threading
+from unittest import mock
+
+import pytest
+
+from taskrabbit.stores.aio import AsyncTaskStore
+
+
+def test_async_store_loads_in_chunks_on_one_thread(cfg, make_task):
+    store = cfg.init_store()
+    tasks = [make_task(f"t{i}", [i]) for i in range(7)]
+    threads = set()
+
+    def bulk_save(tasks):
+        threads.add(threading.current_thread().name)
+        type(store).bulk_save(store, tasks)
+
+    async def run():
+        astore = AsyncTaskStore(store)
+        with mock.patch.object(store, "bulk_save", side_effect=bulk_save):
+            await astore.bulk_save(iter(tasks[:4]))
+            await astore.bulk_save(iter(tasks[4:]))
+        try:
+            return [task async for task in astore.load_tasks(chunk_size=3)]
+        finally:
+            astore.close()
+
+    loaded = asyncio.run(run())
+
+    assert sorted(loaded, key=lambda task: task.id) == tasks
+    assert len(threads) == 1
+    assert threads.pop().startswith("taskstore")
+
+
+def test_message_round_trip(make_task):
+    aio = pytest.importorskip("taskrabbit.aio")
+    for task in [make_task("abc", [1, 2]), make_task("def", [3], raw=True)]:
+        message = aio.message_from_task(task)
+        incoming = mock.Mock(
+            body=message.body,
+            headers=message.headers,
+            routing_key=task.routing_key,
+            content_type=message.content_type,
+            content_encoding=message.content_encoding,
+        )
+
+        assert aio.task_from_message(incoming, passthrough=task.is_raw) == task
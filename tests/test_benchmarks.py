@@ -0,0 +1,46 @@
+import json
+
+import pytest
+from typer.testing import CliRunner
+
+from benchmarks import throughput
+
+
+@pytest.mark.parametrize("store", sorted(throughput.STORES))
+def test_scenario_drains_and_fills_every_message(store, tmp_path):
+    result = throughput.run_scenario(store, 50, "small", 10, 20, str(tmp_path))
+
+    assert result["messages"] == 50
+    assert set(result["phases"]) == {"publish", "drain", "fill"}
+    assert result["phases"]["drain"]["messages_per_second"] > 0
+    assert result["payload_bytes"] > 0
+    # The store is removed with the scenario's temporary directory.
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_scenarios_publish_the_same_messages(tmp_path):
+    sizes = [
+        throughput.run_scenario("sqlite", 20, "medium", 10, 20, str(tmp_path))[
+            "payload_bytes"
+        ]
+        for _ in range(2)
+    ]
+
+    assert sizes[0] == sizes[1]
+
+
+def test_compare(tmp_path):
+    result = throughput.run_scenario("sqlite", 20, "small", 10, 20, str(tmp_path))
+    paths = []
+    for version, speedup in [("1.0", 1), ("1.1", 2)]:
+        faster = json.loads(json.dumps(result))
+        for phase in faster["phases"].values():
+            phase["messages_per_second"] *= speedup
+        path = tmp_path / f"{version}.json"
+        path.write_text(json.dumps({"taskrabbit": version, "results": [faster]}))
+        paths.append(str(path))
+
+    output = CliRunner().invoke(throughput.app, ["compare", *paths]).output
+
+    assert "1.0 -> 1.1" in output
+    assert "(+100.0%)" in output
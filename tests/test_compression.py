@@ -0,0 +1,95 @@
+import pytest
+
+from taskrabbit.config import SqliteConfig
+from taskrabbit.serialization import (
+    COMPRESSORS,
+    ZstdCompressor,
+    get_compressor,
+    get_reader,
+    make_codec,
+    train_dictionary,
+)
+from taskrabbit.stores.base import StoredTask
+from taskrabbit.stores.sqlite import SqliteTaskStore
+
+needs_zstd = pytest.mark.skipif(
+    "zstd" not in COMPRESSORS, reason="zstandard is not installed"
+)
+
+
+def sample_tasks(make_task, count=300):
+    return [
+        make_task(
+            f"{i:08d}-0000-4000-8000-000000000000",
+            [i, f"customer{i % 37}@example.com"],
+            {"items": [{"sku": f"SKU-{i % 11}", "quantity": i % 5}]},
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("compression", sorted(COMPRESSORS))
+@pytest.mark.parametrize("raw", [False, True])
+def test_compressed_records_round_trip(compression, raw, make_task):
+    codec = make_codec("json", compression)
+    task = make_task("abc", [1, 2], {"three": 3}, raw=raw)
+
+    record = task.encode(codec)
+
+    assert codec.format == f"json+{compression}"
+    assert StoredTask.decode(record, codec.format) == task
+
+
+@pytest.mark.parametrize("compression", sorted(COMPRESSORS))
+def test_store_round_trips_compressed_records(compression, tmp_path, make_task):
+    db = str(tmp_path / "tasks.sqlite")
+    tasks = sample_tasks(make_task, 10)
+    SqliteTaskStore(SqliteConfig(db=db, compression=compression)).bulk_save(tasks)
+
+    # Read back without being configured to compress.
+    store = SqliteTaskStore(SqliteConfig(db=db))
+    assert sorted(store.load_tasks(), key=lambda task: task.id) == tasks
+
+
+@needs_zstd
+def test_zstd_dictionary_round_trips_and_compresses_better(tmp_path, make_task):
+    tasks = sample_tasks(make_task)
+    plain = make_codec("json")
+    dictionary = train_dictionary((task.encode(plain) for task in tasks), 4096)
+    path = tmp_path / "tasks.dict"
+    path.write_bytes(dictionary)
+    cfg = SqliteConfig(
+        db=str(tmp_path / "tasks.sqlite"),
+        compression="zstd",
+        compression_dictionary=str(path),
+    )
+    codec = cfg.get_codec()
+
+    with_dictionary = [task.encode(codec) for task in tasks]
+    without = [task.encode(make_codec("json", "zstd")) for task in tasks]
+
+    assert sum(map(len, with_dictionary)) < sum(map(len, without))
+    # Any reader can decompress, once the dictionary is loaded.
+    reader = get_reader(codec.format)
+    assert [StoredTask.from_dict(reader.loads(r)) for r in with_dictionary] == tasks
+
+
+@needs_zstd
+def test_zstd_record_needs_its_dictionary(monkeypatch, make_task):
+    tasks = sample_tasks(make_task)
+    plain = make_codec("json")
+    dictionary = train_dictionary((task.encode(plain) for task in tasks), 4096)
+    record = ZstdCompressor(dictionary=dictionary).compress(tasks[0].encode(plain))
+
+    monkeypatch.setattr(ZstdCompressor, "dictionaries", {})
+    with pytest.raises(ValueError, match="compression_dictionary"):
+        ZstdCompressor().decompress(record)
+
+
+def test_compression_errors():
+    with pytest.raises(ValueError, match="Unknown compression"):
+        get_compressor("lz4")
+    with pytest.raises(ValueError, match="does not use a dictionary"):
+        get_compressor("zlib", dictionary=b"dictionary")
+    with pytest.raises(ValueError):
+        train_dictionary([b"too few"], 4096)
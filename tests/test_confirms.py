@@ -0,0 +1,99 @@
+from collections import defaultdict
+
+import pytest
+
+from taskrabbit.operations import ConfirmWindow
+
+
+class FakeChannel:
+    """
+    Records the confirm mode callbacks a ConfirmWindow registers.
+    """
+
+    def __init__(self):
+        self.confirming = False
+        self.events = defaultdict(set)
+
+    def confirm_select(self):
+        self.confirming = True
+
+    def ack(self, delivery_tag, multiple=False):
+        for callback in self.events["basic_ack"]:
+            callback(delivery_tag, multiple)
+
+    def nack(self, delivery_tag, multiple=False):
+        for callback in self.events["basic_nack"]:
+            callback(delivery_tag, multiple)
+
+
+@pytest.fixture
+def store(cfg, make_task):
+    store = cfg.init_store()
+    store.bulk_save(make_task(f"t{i}", [i]) for i in range(1, 6))
+    return store
+
+
+def publish_all(window, store):
+    tasks = sorted(store.load_tasks(), key=lambda task: task.id)
+    for task in tasks:
+        window.published(task)
+    return tasks
+
+
+def stored_ids(store):
+    return sorted(task.id for task in store.load_tasks())
+
+
+def test_multiple_ack_confirms_every_task_up_to_it(store):
+    channel = FakeChannel()
+    window = ConfirmWindow(channel, store, delete_batch_size=100)
+    publish_all(window, store)
+
+    channel.ack(3, multiple=True)
+
+    assert channel.confirming
+    assert len(window) == 2
+    assert [task.id for task in window.confirmed] == ["t1", "t2", "t3"]
+    # Not deleted until a batch is full, or the window is flushed.
+    assert len(stored_ids(store)) == 5
+    window.flush()
+    assert stored_ids(store) == ["t4", "t5"]
+
+
+def test_confirmed_tasks_are_deleted_in_batches(store):
+    channel = FakeChannel()
+    window = ConfirmWindow(channel, store, delete_batch_size=2)
+    publish_all(window, store)
+
+    channel.ack(1)
+    assert len(stored_ids(store)) == 5
+    channel.ack(2)
+    assert stored_ids(store) == ["t3", "t4", "t5"]
+
+
+def test_rejected_tasks_are_kept(store):
+    channel = FakeChannel()
+    window = ConfirmWindow(channel, store, delete_batch_size=100)
+    publish_all(window, store)
+
+    channel.nack(2, multiple=True)
+    channel.ack(4)
+    channel.nack(5)
+    channel.ack(3)
+    window.flush()
+
+    assert not window
+    assert window.nacked == 3
+    assert stored_ids(store) == ["t1", "t2", "t5"]
+
+
+def test_nothing_deleted_without_delete(store):
+    channel = FakeChannel()
+    window = ConfirmWindow(channel, store, delete=False, delete_batch_size=1)
+    publish_all(window, store)
+
+    channel.ack(5, multiple=True)
+    window.flush()
+
+    assert not window
+    assert len(stored_ids(store)) == 5
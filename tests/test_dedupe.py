@@ -0,0 +1,64 @@
+from unittest import mock
+
+import pytest
+
+from taskrabbit.config import FileConfig
+from taskrabbit.stores import dedupe
+from taskrabbit.stores.file import FileTaskStore
+
+
+@pytest.fixture
+def store(tmp_path, make_task):
+    store = FileTaskStore(FileConfig(directory=str(tmp_path / "tasks")))
+    # Three copies each of ten tasks.
+    store.bulk_save(
+        make_task(f"{copy}-{i:02d}", [i]) for i in range(10) for copy in "abc"
+    )
+    return store
+
+
+@pytest.mark.parametrize("max_keys", [100, 3], ids=["in memory", "spilled"])
+def test_dedupe_keeps_the_greatest_id(store, max_keys, tmp_path):
+    removed = dedupe.dedupe(store, max_keys=max_keys, directory=str(tmp_path))
+
+    assert removed == 20
+    assert sorted(task.id for task in store.load_tasks()) == [
+        f"c-{i:02d}" for i in range(10)
+    ]
+    # The spilled keys are cleaned up.
+    assert [path.name for path in tmp_path.iterdir()] == ["tasks"]
+
+
+def test_dedupe_holds_at_most_max_keys_in_memory(store, tmp_path):
+    held = []
+    add = dedupe.Duplicates.add
+
+    def spy(self, key, task_id):
+        add(self, key, task_id)
+        held.append(len(self.winners))
+
+    with mock.patch.object(dedupe.Duplicates, "add", spy):
+        dedupe.dedupe(store, max_keys=3, directory=str(tmp_path))
+
+    # One key over the maximum triggers the spill.
+    assert max(held) == 4
+
+
+def test_dedupe_deletes_in_batches(store):
+    with mock.patch.object(
+        store, "delete_many", wraps=store.delete_many
+    ) as delete_many:
+        dedupe.dedupe(store, delete_batch_size=8)
+
+    assert [len(call.args[0]) for call in delete_many.call_args_list] == [8, 8, 4]
+
+
+def test_dedupe_ignores_a_task_read_twice():
+    deleted = []
+
+    removed = dedupe.dedupe_pairs(
+        [("k1", "a"), ("k1", "a"), ("k1", "b"), ("k2", "c")], deleted.extend
+    )
+
+    assert removed == 1
+    assert deleted == ["a"]
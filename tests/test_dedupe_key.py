@@ -0,0 +1,37 @@
+from taskrabbit.config import SqliteConfig
+from taskrabbit.stores.sqlite import SqliteTaskStore
+
+
+def test_raw_and_decoded_tasks_have_the_same_key(make_task):
+    raw = make_task("abc", [1, 2], {"a": 1, "b": 2}, raw=True)
+    # Keyword arguments passed in another order are the same task.
+    decoded = make_task("def", [1, 2], {"b": 2, "a": 1})
+
+    assert raw.dedupe_key == decoded.dedupe_key
+    assert raw.dedupe_key != make_task("xyz", [1, 3], {"a": 1, "b": 2}).dedupe_key
+
+
+def test_undecodable_raw_body_falls_back_to_reprs(make_task):
+    tasks = [
+        make_task(task_id, args, {}, raw=True)
+        for task_id, args in [("abc", [1, 2]), ("def", [1, 2]), ("xyz", [3, 4])]
+    ]
+    for task in tasks:
+        task.body = b"\xff not json"
+
+    assert tasks[0].dedupe_key == tasks[1].dedupe_key
+    assert tasks[0].dedupe_key != tasks[2].dedupe_key
+
+
+def test_dedupe_matches_raw_and_decoded_tasks(tmp_path, make_task):
+    store = SqliteTaskStore(SqliteConfig(db=str(tmp_path / "tasks.sqlite")))
+    store.bulk_save(
+        [
+            make_task("abc", [1, 2], {}, raw=True),
+            make_task("def", [1, 2], {}),
+            make_task("xyz", [3, 4], {}, raw=True),
+        ]
+    )
+
+    assert store.dedupe() == 1
+    assert sorted(task.id for task in store.load_tasks()) == ["def", "xyz"]
@@ -0,0 +1,78 @@
+import sqlite3
+from dataclasses import replace
+from unittest import mock
+
+import pytest
+from kombu.transport.virtual import Channel as VirtualChannel
+
+from taskrabbit.metrics import Metrics
+from taskrabbit.operations import ack_all, drain
+
+
+def test_drain_saves_a_batch_at_a_time(cfg, queue_name, publish, queue_size, make_task):
+    publish([make_task(f"t{i}", [i]) for i in range(5)])
+    cfg.drain = replace(cfg.drain, batch_size=2)
+    store = cfg.init_store()
+
+    with mock.patch.object(store, "bulk_save", wraps=store.bulk_save) as bulk_save:
+        counts = drain(cfg, queue_name, store)
+
+    assert counts == {queue_name: 5}
+    assert [len(call.args[0]) for call in bulk_save.call_args_list] == [2, 2, 1]
+    assert sorted(task.id for task in store.load_tasks()) == [f"t{i}" for i in range(5)]
+    assert queue_size() == 0
+
+
+def test_drain_requeues_the_batch_when_saving_fails(
+    cfg, queue_name, publish, queue_size, make_task
+):
+    publish([make_task(f"t{i}", [i]) for i in range(5)])
+    cfg.drain = replace(cfg.drain, batch_size=2)
+    store = cfg.init_store()
+    metrics = Metrics()
+
+    with mock.patch.object(
+        store, "bulk_save", side_effect=sqlite3.OperationalError("disk full")
+    ):
+        with pytest.raises(sqlite3.OperationalError):
+            drain(cfg, queue_name, store, metrics=metrics)
+
+    assert metrics.counters["requeued"] == 2
+    assert store.count_by_task() == {}
+    assert queue_size() == 5
+
+
+def test_ack_all_acks_a_batch_with_one_multiple_ack():
+    messages = [mock.Mock() for _ in range(3)]
+
+    ack_all(messages)
+
+    messages[-1].ack.assert_called_once_with(multiple=True)
+    for message in messages[:-1]:
+        message.ack.assert_not_called()
+
+
+def test_ack_all_acks_each_message_on_virtual_transports():
+    channel = mock.Mock(spec=VirtualChannel)
+    messages = [mock.Mock(channel=channel) for _ in range(3)]
+
+    ack_all(messages)
+
+    for message in messages:
+        message.ack.assert_called_once_with()
+
+
+def test_drain_consumes_several_queues_at_once(cfg, queue_name, publish, make_task):
+    other = f"{queue_name}.other"
+    publish([make_task(f"a{i}", [i]) for i in range(3)])
+    publish([make_task(f"b{i}", [i]) for i in range(4)], queue=other)
+    cfg.drain = replace(cfg.drain, batch_size=100)
+    store = cfg.init_store()
+
+    with mock.patch.object(store, "bulk_save", wraps=store.bulk_save) as bulk_save:
+        counts = drain(cfg, [queue_name, other], store)
+
+    assert counts == {queue_name: 3, other: 4}
+    # Tasks from both queues share a batch.
+    assert bulk_save.call_count == 1
+    assert store.count_by_task() == {"t.add": 7}
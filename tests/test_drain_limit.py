@@ -0,0 +1,74 @@
+from dataclasses import replace
+from unittest import mock
+
+import pytest
+
+from taskrabbit.config import DrainConfig
+from taskrabbit.operations import DrainLimit, drain
+
+
+def test_max_messages():
+    limit = DrainLimit(DrainConfig(max_messages=2))
+
+    assert limit.prefetch_count("q", 10) == 2
+    assert [limit.take("q") for _ in range(3)] == [True, True, False]
+    assert limit.reached
+    # Never below 1, which would mean no limit at all.
+    assert limit.prefetch_count("q", 10) == 1
+
+
+def test_snapshot_limits_each_queue():
+    limit = DrainLimit(DrainConfig(snapshot=True), {"a": 1, "b": 2})
+
+    assert limit.prefetch_count(None, 10) == 3
+    assert limit.prefetch_count("b", 10) == 2
+    assert limit.take("a")
+    assert not limit.take("a")
+    assert limit.queue_done("a")
+    assert not limit.reached
+    assert limit.take("b") and limit.take("b")
+    assert limit.reached
+
+
+def test_snapshot_is_ignored_unless_configured():
+    limit = DrainLimit(DrainConfig(), {"a": 0})
+
+    assert limit.take("a")
+    assert not limit.queue_done("a")
+    assert not limit.reached
+
+
+def test_max_duration_shortens_timeouts():
+    with mock.patch("time.monotonic", return_value=100.0):
+        limit = DrainLimit(DrainConfig(max_duration=5))
+    with mock.patch("time.monotonic", return_value=103.0):
+        assert limit.timeout(10) == pytest.approx(2)
+        assert limit.timeout(1) == 1
+        assert not limit.reached
+    with mock.patch("time.monotonic", return_value=106.0):
+        assert limit.timeout(10) == 0
+        assert limit.reached
+
+
+def test_drain_stops_at_max_messages(cfg, queue_name, publish, queue_size, make_task):
+    publish([make_task(f"t{i}", [i]) for i in range(5)])
+    cfg.drain = replace(cfg.drain, max_messages=3, batch_size=2)
+    store = cfg.init_store()
+
+    counts = drain(cfg, queue_name, store)
+
+    assert counts == {queue_name: 3}
+    assert store.count_by_task() == {"t.add": 3}
+    # Messages received over the limit are put back.
+    assert queue_size() == 2
+
+
+def test_drain_takes_a_snapshot(cfg, queue_name, publish, queue_size, make_task):
+    publish([make_task(f"t{i}", [i]) for i in range(3)])
+    cfg.drain = replace(cfg.drain, snapshot=True)
+    store = cfg.init_store()
+
+    counts = drain(cfg, queue_name, store, snapshot={queue_name: 2})
+
+    assert counts == {queue_name: 2}
+    assert queue_size() == 1
@@ -0,0 +1,65 @@
+import os
+
+from taskrabbit.config import FileConfig
+from taskrabbit.stores.file import FileTaskStore
+
+
+def make_store(tmp_path, layout="sharded"):
+    return FileTaskStore(FileConfig(directory=str(tmp_path / "tasks"), layout=layout))
+
+
+def test_sharded_layout_nests_tasks_in_hashed_directories(tmp_path, make_task):
+    store = make_store(tmp_path)
+    store.save(make_task("abc"))
+
+    files = [
+        os.path.relpath(os.path.join(root, name), store.path)
+        for root, _, names in os.walk(store.path)
+        for name in names
+        if not root.endswith(".manifests")
+    ]
+
+    assert len(files) == 1
+    first, second, name = files[0].split(os.sep)
+    assert (len(first), len(second), name) == (2, 2, "abc")
+    assert list(store.load_tasks()) == [make_task("abc")]
+
+
+def test_sharded_layout_loads_by_name_from_manifest(tmp_path, make_task):
+    store = make_store(tmp_path)
+    adds = [make_task(f"a{i}", [i]) for i in range(3)]
+    store.bulk_save(adds + [make_task("m0", task="t.mul")])
+    # Saved again, so its ID is in the manifest twice.
+    store.save(adds[0])
+
+    assert sorted(store.load_tasks("t.add"), key=lambda task: task.id) == adds
+    assert store.count_by_task() == {"t.add": 3, "t.mul": 1}
+    assert store.count_by_task("t.mul") == {"t.mul": 1}
+
+
+def test_sharded_layout_compacts_manifest_of_deleted_tasks(tmp_path, make_task):
+    store = make_store(tmp_path)
+    tasks = [make_task(f"a{i}", [i]) for i in range(3)]
+    store.bulk_save(tasks)
+    store.delete(tasks[1])
+
+    assert [task.id for task in store.load_tasks("t.add")] == ["a0", "a2"]
+    assert store._manifest("t.add").read_text().split() == ["a0", "a2"]
+    assert store.count_by_task() == {"t.add": 2}
+
+
+def test_task_names_are_quoted_in_manifest_names(tmp_path, make_task):
+    store = make_store(tmp_path)
+    store.save(make_task("abc", task="app/tasks.add"))
+
+    assert store.count_by_task() == {"app/tasks.add": 1}
+    assert [task.id for task in store.load_tasks("app/tasks.add")] == ["abc"]
+
+
+def test_flat_layout_keeps_tasks_in_one_directory(tmp_path, make_task):
+    store = make_store(tmp_path, layout="flat")
+    store.bulk_save([make_task("abc"), make_task("def", task="t.mul")])
+
+    assert sorted(os.listdir(store.path)) == ["abc", "def"]
+    assert [task.id for task in store.load_tasks("t.mul")] == ["def"]
+    assert store.count_by_task() == {"t.add": 1, "t.mul": 1}
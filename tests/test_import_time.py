@@ -0,0 +1,33 @@
+import pytest
+
+from benchmarks import import_time
+
+
+def test_cli_defers_heavy_imports():
+    imported = {
+        name.split(".")[0] for name in import_time.import_times("taskrabbit.cli")
+    }
+
+    assert "taskrabbit" in imported
+    assert imported & set(import_time.DEFERRED) == set()
+
+
+@pytest.mark.parametrize("command", import_time.LIGHT_COMMANDS, ids=" ".join)
+def test_light_commands_defer_heavy_imports(command):
+    imported = import_time.command_imports(command)
+
+    assert "taskrabbit" in imported
+    assert imported & set(import_time.DEFERRED) == set()
+
+
+def test_parse_import_times():
+    output = (
+        "import time: self [us] | cumulative | imported package\n"
+        "import time:       120 |        120 |   taskrabbit.utils\n"
+        "import time:       300 |        420 | taskrabbit\n"
+    )
+
+    assert import_time.parse_import_times(output) == {
+        "taskrabbit.utils": 120,
+        "taskrabbit": 420,
+    }
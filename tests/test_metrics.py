@@ -0,0 +1,107 @@
+import json
+import logging
+
+import pytest
+
+from taskrabbit.metrics import (
+    Histogram,
+    MeteredTaskStore,
+    Metrics,
+    Reporter,
+    write_json,
+)
+from taskrabbit.operations import drain
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram([1, 10, 100])
+    for value in [0.5, 1, 5, 5, 50, 500]:
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 2, 1, 1]
+    assert histogram.quantile(0.5) == 10
+    assert histogram.quantile(0.8) == 100
+    # Beyond every bucket, the largest value seen.
+    assert histogram.quantile(1.0) == 500
+    assert histogram.mean == pytest.approx(561.5 / 6)
+
+
+def test_metrics_merge():
+    first, second = Metrics(), Metrics()
+    first.count("consumed", 2)
+    second.count("consumed", 3)
+    second.batch_sizes.observe(3)
+    with second.time("save"):
+        pass
+
+    first.merge(second.to_dict())
+
+    assert first.counters["consumed"] == 5
+    assert first.batch_sizes.count == 1
+    assert first.latency["save"].count == 1
+
+
+def test_metered_store_times_calls(cfg, make_task):
+    metrics = Metrics()
+    store = MeteredTaskStore(cfg.init_store(), metrics)
+    store.bulk_save([make_task("abc"), make_task("def")])
+    store.save(make_task("ghi"))
+    loaded = list(store.load_tasks())
+    store.delete_many(loaded[:1])
+
+    assert metrics.latency["save"].count == 2
+    assert metrics.batch_sizes.counts[1] == 1
+    # One more, for the end of the tasks.
+    assert metrics.latency["load"].count == 4
+    assert metrics.latency["delete"].count == 1
+    assert store.count_by_task() == {"t.add": 2}
+
+
+def test_drain_counts_messages(cfg, queue_name, publish, make_task):
+    publish([make_task(f"t{i}", [i]) for i in range(3)])
+    metrics = Metrics()
+
+    drain(cfg, queue_name, cfg.init_store(), metrics=metrics)
+
+    assert metrics.counters["consumed"] == 3
+    assert metrics.counters["consumed_bytes"] > 0
+
+
+def test_prometheus_format():
+    metrics = Metrics(labels={"worker": "1"})
+    metrics.count("published", 7)
+    metrics.batch_sizes.observe(20)
+
+    lines = metrics.prometheus().splitlines()
+
+    assert 'taskrabbit_published_total{worker="1"} 7' in lines
+    assert "# TYPE taskrabbit_store_latency_seconds histogram" in lines
+    assert 'taskrabbit_batch_size_bucket{worker="1",le="10"} 0' in lines
+    assert 'taskrabbit_batch_size_bucket{worker="1",le="50"} 1' in lines
+    assert 'taskrabbit_batch_size_bucket{worker="1",le="+Inf"} 1' in lines
+    assert 'taskrabbit_batch_size_count{worker="1"} 1' in lines
+
+
+def test_reporter_reports_when_stopped(tmp_path, caplog):
+    metrics = Metrics()
+    textfile = tmp_path / "taskrabbit.prom"
+    caplog.set_level(logging.INFO)
+
+    with Reporter(metrics, interval=60, textfile=str(textfile)):
+        metrics.count("consumed", 4)
+
+    assert "taskrabbit_consumed_total 4" in textfile.read_text().splitlines()
+    assert "Metrics: consumed 4" in caplog.text
+    assert [path.name for path in tmp_path.iterdir()] == ["taskrabbit.prom"]
+
+
+def test_write_json(tmp_path):
+    metrics = Metrics()
+    metrics.count("published", 2)
+    path = tmp_path / "metrics.json"
+
+    write_json(metrics, str(path))
+
+    data = json.loads(path.read_text())
+    assert data["counters"]["published"] == 2
+    assert set(data["latency"]) == {"save", "delete", "load"}
@@ -0,0 +1,68 @@
+import json
+from dataclasses import replace
+
+from kombu import Connection, Queue
+
+from taskrabbit.operations import drain, fill
+from taskrabbit.serialization import get_codec
+from taskrabbit.stores.base import StoredTask
+
+
+def test_passthrough_drain_and_fill_keep_bodies_as_sent(
+    cfg, queue_name, queue_size, make_task
+):
+    # Spacing json.dumps wouldn't produce, so re-serializing would show.
+    body = b"[[1,  2], {},  {}]"
+    task = make_task("abc", [1, 2])
+    with Connection("memory://") as conn:
+        conn.Producer().publish(
+            body,
+            routing_key=queue_name,
+            declare=[Queue(queue_name)],
+            headers=task.headers,
+            content_type="application/json",
+            content_encoding="utf-8",
+        )
+    cfg.drain = replace(cfg.drain, passthrough=True)
+    store = cfg.init_store()
+
+    drain(cfg, queue_name, store)
+
+    [stored] = store.load_tasks()
+    assert stored.is_raw
+    assert stored.body == body
+    assert stored.content_type == "application/json"
+
+    fill(cfg, "", store)
+
+    assert queue_size() == 1
+    with Connection("memory://") as conn:
+        message = Queue(queue_name, channel=conn.default_channel).get(no_ack=True)
+    assert message.body == body
+    assert message.content_type == "application/json"
+    assert message.headers["id"] == "abc"
+
+
+def test_fill_serializes_decoded_bodies(cfg, queue_name, make_task):
+    task = make_task("abc", [1, 2])
+    task.routing_key = queue_name
+    with Connection("memory://") as conn:
+        Queue(queue_name, channel=conn.default_channel).declare()
+    store = cfg.init_store()
+    store.save(task)
+
+    fill(cfg, "", store)
+
+    with Connection("memory://") as conn:
+        message = Queue(queue_name, channel=conn.default_channel).get(no_ack=True)
+    assert json.loads(message.body) == task.body
+
+
+def test_decoded_task_is_deserialized_when_first_used(make_task):
+    task = make_task("abc", [1, 2])
+    loaded = StoredTask.decode(task.encode(get_codec("json")))
+
+    assert loaded._encoded is not None
+    assert loaded.id == "abc"
+    assert loaded._encoded is None
+    assert loaded == task
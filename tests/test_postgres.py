@@ -0,0 +1,110 @@
+from dataclasses import replace
+
+import pytest
+
+from taskrabbit.stores.postgres import (
+    CopyReader,
+    PostgresTaskStore,
+    encode_copy_row,
+)
+
+
+def test_encode_copy_row():
+    row = ["a\tb", "c\nd\re", "back\\slash", None, b"\x00\xff"]
+
+    assert encode_copy_row(row) == ("a\\tb\tc\\nd\\re\tback\\\\slash\t\\N\t\\\\x00ff\n")
+
+
+def test_copy_reader_returns_rows_in_pieces():
+    rows = [[str(i), "x" * i] for i in range(50)]
+    whole = "".join(map(encode_copy_row, rows))
+    reader = CopyReader(rows)
+
+    pieces = []
+    while True:
+        piece = reader.read(64)
+        if not piece:
+            break
+        assert len(piece) <= 64
+        pieces.append(piece)
+
+    assert "".join(pieces) == whole
+    assert CopyReader(rows).read() == whole
+
+
+def test_bulk_save_round_trips_awkward_values(postgres_store, make_task):
+    tasks = [
+        make_task("abc", ["tab\there", "new\nline"], {"path": "C:\\temp"}),
+        make_task("def", ["ünïcödé", "\\N"], raw=True),
+    ]
+
+    postgres_store.bulk_save(tasks)
+
+    assert sorted(postgres_store.load_tasks(), key=lambda task: task.id) == tasks
+
+
+def test_bulk_save_writes_binary_records(postgres_config, postgres_store, make_task):
+    store = PostgresTaskStore(replace(postgres_config, codec="msgpack"))
+    tasks = [make_task("abc", [1, 2]), make_task("def", [3], raw=True)]
+
+    store.bulk_save(tasks)
+
+    assert sorted(postgres_store.load_tasks(), key=lambda task: task.id) == tasks
+
+
+def test_bulk_save_skips_stored_ids(postgres_store, make_task):
+    postgres_store.save(make_task("abc", [1]))
+
+    postgres_store.bulk_save([make_task("abc", [2]), make_task("def", [3])])
+
+    assert {task.id: task.body[0] for task in postgres_store.load_tasks()} == {
+        "abc": [1],
+        "def": [3],
+    }
+
+
+def test_bulk_save_is_all_or_nothing(postgres_store, make_task):
+    psycopg2 = pytest.importorskip("psycopg2")
+    # Postgres text can't hold NUL characters.
+    bad = make_task("bad\x00id")
+
+    with pytest.raises(psycopg2.Error):
+        postgres_store.bulk_save([make_task("abc", [1]), bad])
+
+    assert postgres_store.count_by_task() == {}
+    postgres_store.bulk_save([make_task("abc", [1])])
+    assert postgres_store.count_by_task() == {"t.add": 1}
+
+
+def test_load_tasks_fetches_in_round_trips(postgres_config, postgres_store, make_task):
+    store = PostgresTaskStore(replace(postgres_config, itersize=2))
+    store.bulk_save(make_task(f"t{i}", [i]) for i in range(5))
+
+    assert sorted(task.id for task in store.load_tasks()) == [f"t{i}" for i in range(5)]
+
+
+def test_load_tasks_survives_deletes_while_iterating(
+    postgres_config, postgres_store, make_task
+):
+    # As fill does, deleting and committing each task once it's published.
+    store = PostgresTaskStore(replace(postgres_config, itersize=2))
+    store.bulk_save(make_task(f"t{i}", [i]) for i in range(5))
+
+    loaded = []
+    for task in store.load_tasks():
+        store.delete(task)
+        loaded.append(task.id)
+
+    assert sorted(loaded) == [f"t{i}" for i in range(5)]
+    assert store.count_by_task() == {}
+
+
+def test_abandoned_load_leaves_no_open_cursor(postgres_store, make_task):
+    postgres_store.bulk_save(make_task(f"t{i}", [i]) for i in range(3))
+
+    tasks = postgres_store.load_tasks()
+    next(tasks)
+    tasks.close()
+
+    cursors = postgres_store.execute("SELECT count(*) FROM pg_cursors").fetchone()
+    assert cursors == (0,)
@@ -0,0 +1,104 @@
+import re
+import threading
+from dataclasses import replace
+from unittest import mock
+
+import pytest
+
+from taskrabbit import profiling
+from taskrabbit.metrics import TracedTaskStore
+from taskrabbit.operations import drain
+
+
+class Clock:
+    """
+    A perf_counter which only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with mock.patch.object(profiling.time, "perf_counter", clock):
+        yield clock
+
+
+@pytest.fixture
+def tracing():
+    profiling.start_tracing()
+    yield
+    if profiling.tracing():
+        profiling.stop_tracing()
+
+
+def test_nested_phases_are_excluded(clock):
+    tracer = profiling.PhaseTracer()
+
+    with tracer.phase("outer"):
+        clock.now += 1
+        with tracer.phase("inner"):
+            clock.now += 2
+            with tracer.phase("innermost"):
+                clock.now += 4
+        with tracer.phase("inner"):
+            clock.now += 8
+        clock.now += 16
+
+    assert tracer.seconds == {"outer": 17, "inner": 10, "innermost": 4}
+    assert tracer.calls == {"outer": 1, "inner": 2, "innermost": 1}
+
+
+def test_threads_have_their_own_phases(clock):
+    tracer = profiling.PhaseTracer()
+
+    def work():
+        with tracer.phase("worker"):
+            clock.now += 4
+
+    with tracer.phase("main"):
+        clock.now += 1
+        with tracer.phase("wait"):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+            clock.now += 2
+
+    # The worker's phase isn't nested in the phase waiting for it.
+    assert tracer.seconds == {"main": 1, "wait": 6, "worker": 4}
+
+
+def test_phase_does_nothing_unless_tracing():
+    assert not profiling.tracing()
+    with profiling.phase("anything"):
+        pass
+
+
+def test_report(tracing):
+    with profiling.phase("work"):
+        bytearray(1024 * 1024)
+
+    report = profiling.stop_tracing()
+
+    assert not profiling.tracing()
+    assert "work" in report
+    assert "(other)" in report
+    peak = re.search(r"peak traced memory ([\d.]+) MiB", report).group(1)
+    assert float(peak) >= 1.0
+
+
+def test_drain_phases(tracing, cfg, queue_name, publish, make_task):
+    publish([make_task(f"t{i}", [i]) for i in range(3)])
+
+    cfg.drain = replace(cfg.drain, batch_size=10)
+
+    drain(cfg, queue_name, TracedTaskStore(cfg.init_store()))
+
+    calls = profiling._tracer.calls
+    assert calls["task.decode"] == 3
+    assert calls["store.bulk_save"] == 1
@@ -0,0 +1,50 @@
+import json
+
+from taskrabbit.config import SegmentedFileConfig
+from taskrabbit.stores.segmented import (
+    INDEX_SUFFIX,
+    SEGMENT_SUFFIX,
+    SegmentedFileTaskStore,
+)
+
+
+def test_torn_index_entry_is_dropped_before_appending(tmp_path, make_task):
+    cfg = SegmentedFileConfig(directory=str(tmp_path))
+    store = SegmentedFileTaskStore(cfg)
+    store.bulk_save([make_task("abc")])
+    store._close_segment()
+    # A crash part way through writing the index entry for "def".
+    (index,) = tmp_path.glob(f"*{INDEX_SUFFIX}")
+    with open(index, "ab") as f:
+        f.write(b'["P", 123, "def"')
+
+    store = SegmentedFileTaskStore(cfg)
+    store.bulk_save([make_task("ghi")])
+    store._close_segment()
+
+    store = SegmentedFileTaskStore(cfg)
+    assert sorted(task.id for task in store.load_tasks()) == ["abc", "ghi"]
+
+
+def test_index_entry_past_end_of_segment_is_dropped(tmp_path, make_task):
+    cfg = SegmentedFileConfig(directory=str(tmp_path))
+    store = SegmentedFileTaskStore(cfg)
+    store.bulk_save([make_task("abc")])
+    store._close_segment()
+    # A crash after the index entry for "def" reached the disk, but before
+    # its record did.
+    (segment,) = tmp_path.glob(f"*{SEGMENT_SUFFIX}")
+    (index,) = tmp_path.glob(f"*{INDEX_SUFFIX}")
+    size = segment.stat().st_size
+    with open(index, "ab") as f:
+        f.write(json.dumps(["P", size, "def", "t.add", 50, "json"]).encode() + b"\n")
+
+    store = SegmentedFileTaskStore(cfg)
+    assert [task.id for task in store.load_tasks()] == ["abc"]
+    # The next record is written where the missing one would have been.
+    store.bulk_save([make_task("ghi")])
+    store._close_segment()
+
+    store = SegmentedFileTaskStore(cfg)
+    assert sorted(task.id for task in store.load_tasks()) == ["abc", "ghi"]
+    assert store.count_by_task() == {"t.add": 2}
@@ -0,0 +1,68 @@
+import pytest
+
+from taskrabbit.config import SqliteConfig
+from taskrabbit.serialization import (
+    CODECS,
+    JSONCodec,
+    frame,
+    get_codec,
+    get_reader,
+    unframe,
+)
+from taskrabbit.stores.base import StoredTask
+from taskrabbit.stores.sqlite import SqliteTaskStore
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+@pytest.mark.parametrize("raw", [False, True])
+def test_codecs_round_trip_tasks(name, raw, make_task):
+    codec = get_codec(name)
+    task = make_task("abc", [1, "two", None], {"three": [3.0]}, raw=raw)
+
+    loaded = StoredTask.decode(task.encode(codec), codec.format)
+
+    assert loaded == task
+    assert loaded.is_raw is raw
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_codecs_round_trip_binary_raw_bodies(name, make_task):
+    codec = get_codec(name)
+    task = make_task("abc", raw=True)
+    task.body = b"\x80\x03 not utf-8"
+    task.content_type = "application/x-python-serialize"
+    task.content_encoding = "binary"
+
+    assert StoredTask.decode(task.encode(codec), codec.format) == task
+
+
+def test_records_are_read_by_any_codec_of_their_format(make_task):
+    task = make_task("abc", [1, 2])
+    record = task.encode(JSONCodec())
+
+    assert StoredTask.from_dict(get_reader("json").loads(record)) == task
+
+
+def test_unknown_codec_is_an_error():
+    with pytest.raises(ValueError, match="Unknown codec"):
+        get_codec("yaml")
+    with pytest.raises(ValueError, match="No codec installed"):
+        get_reader("yaml")
+
+
+def test_frame_round_trips():
+    assert unframe(frame("msgpack", b"\x00\n\x01")) == ("msgpack", b"\x00\n\x01")
+    # JSON is left as it is.
+    assert frame("json", b"{}") == b"{}"
+    assert unframe(b"{}") == ("json", b"{}")
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_store_reads_records_written_with_another_codec(name, tmp_path, make_task):
+    db = str(tmp_path / "tasks.sqlite")
+    tasks = [make_task("abc", [1, 2]), make_task("def", [3], raw=True)]
+    SqliteTaskStore(SqliteConfig(db=db, codec=name)).bulk_save(tasks)
+
+    # Each record is read with the reader of the format it was written in.
+    store = SqliteTaskStore(SqliteConfig(db=db))
+    assert sorted(store.load_tasks(), key=lambda task: task.id) == tasks
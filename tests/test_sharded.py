@@ -0,0 +1,71 @@
+from kombu import Connection, Queue
+
+from taskrabbit.config import SqliteConfig
+from taskrabbit.operations import fill
+from taskrabbit.stores.sharded import ShardedTaskStore
+from taskrabbit.stores.sqlite import SqliteTaskStore
+
+
+def make_store(tmp_path, shards=2):
+    return ShardedTaskStore(
+        [
+            SqliteTaskStore(SqliteConfig(db=str(tmp_path / f"tasks.{i}.sqlite")))
+            for i in range(shards)
+        ]
+    )
+
+
+def test_same_id_in_two_shards_keeps_one_copy(tmp_path, make_task):
+    store = make_store(tmp_path)
+    for shard in store.shards:
+        shard.save(make_task("abc", [1, 2]))
+
+    assert store.dedupe() == 1
+    assert store.count_by_task() == {"t.add": 1}
+
+
+def test_duplicates_across_shards_keep_greatest_id(tmp_path, make_task):
+    store = make_store(tmp_path)
+    store.shards[0].bulk_save([make_task("abc", [1, 2]), make_task("xyz", [1, 2])])
+    store.shards[1].bulk_save([make_task("abc", [1, 2]), make_task("def", [3, 4])])
+
+    assert store.dedupe() == 2
+    assert sorted(task.id for task in store.load_tasks()) == ["def", "xyz"]
+
+
+def test_task_in_two_shards_is_loaded_once(tmp_path, make_task):
+    store = make_store(tmp_path)
+    store.shards[0].bulk_save([make_task("abc"), make_task("def")])
+    store.shards[1].bulk_save([make_task("abc"), make_task("xyz")])
+
+    assert [task.id for task in store.load_tasks()] == ["abc", "def", "xyz"]
+    assert [task.id for task in store.load_tasks(limit=2)] == ["abc", "def"]
+    assert [task.id for task in store.load_tasks(after="abc")] == ["def", "xyz"]
+    assert store.count_by_task() == {"t.add": 3}
+
+
+def test_saved_tasks_are_loaded_in_order(tmp_path, make_task):
+    store = make_store(tmp_path, shards=3)
+    ids = [f"t{i:02d}" for i in range(20)]
+    store.bulk_save(make_task(task_id) for task_id in reversed(ids))
+
+    assert [task.id for task in store.load_tasks()] == ids
+    pages = store.load_tasks_in_pages(page_size=7)
+    assert [task.id for task in pages] == ids
+
+
+def test_fill_publishes_a_task_in_two_shards_once(
+    cfg, tmp_path, queue_name, queue_size, make_task
+):
+    with Connection("memory://") as conn:
+        Queue(queue_name, channel=conn.default_channel).declare()
+    task = make_task("abc")
+    task.routing_key = queue_name
+    store = make_store(tmp_path)
+    for shard in store.shards:
+        shard.save(task)
+
+    fill(cfg, "", store)
+
+    assert queue_size() == 1
+    assert store.count_by_task() == {}
@@ -0,0 +1,75 @@
+from dataclasses import replace
+
+import pytest
+
+from taskrabbit.config import SqliteConfig
+from taskrabbit.stores.sqlite import SqliteTaskStore
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def make_store(request, tmp_path):
+    """
+    Open the same SQL store with any config options.
+    """
+    if request.param == "sqlite":
+        cfg = SqliteConfig(db=str(tmp_path / "tasks.sqlite"))
+        yield lambda **options: SqliteTaskStore(replace(cfg, **options))
+        return
+
+    from taskrabbit.stores.postgres import PostgresTaskStore
+
+    cfg = request.getfixturevalue("postgres_config")
+    store = PostgresTaskStore(cfg)
+    store.execute("DELETE FROM tasks")
+    yield lambda **options: PostgresTaskStore(replace(cfg, **options))
+    store.execute("DELETE FROM tasks")
+
+
+def stored_ids(store):
+    return sorted(task.id for task in store.load_tasks())
+
+
+def test_save_skips_a_duplicate_of_a_stored_task(make_store, make_task):
+    store = make_store(dedupe_on_ingest=True)
+    store.save(make_task("abc", [1, 2]))
+    store.save(make_task("def", [1, 2], raw=True))
+    store.save(make_task("ghi", [3, 4]))
+
+    assert stored_ids(store) == ["abc", "ghi"]
+
+
+def test_bulk_save_skips_duplicates_in_the_batch_and_stored(make_store, make_task):
+    store = make_store(dedupe_on_ingest=True)
+    store.bulk_save([make_task("abc", [1, 2])])
+    store.bulk_save(
+        [
+            make_task("def", [1, 2]),
+            make_task("ghi", [3, 4]),
+            make_task("jkl", [3, 4], raw=True),
+            make_task("mno", [5, 6]),
+        ]
+    )
+
+    ids = stored_ids(store)
+    assert len(ids) == 3
+    assert ids[0] == "abc" and ids[-1] == "mno"
+    assert ids[1] in ("ghi", "jkl")
+
+
+def test_duplicates_are_saved_without_dedupe_on_ingest(make_store, make_task):
+    store = make_store()
+    store.bulk_save([make_task("abc", [1, 2]), make_task("def", [1, 2])])
+    store.save(make_task("ghi", [1, 2], raw=True))
+
+    assert stored_ids(store) == ["abc", "def", "ghi"]
+    assert store.dedupe() == 2
+    assert stored_ids(store) == ["ghi"]
+
+
+def test_dedupe_on_ingest_checks_tasks_saved_without_it(make_store, make_task):
+    make_store().bulk_save([make_task("abc", [1, 2])])
+    store = make_store(dedupe_on_ingest=True)
+    store.save(make_task("def", [1, 2], raw=True))
+    store.bulk_save([make_task("ghi", [1, 2])])
+
+    assert stored_ids(store) == ["abc"]
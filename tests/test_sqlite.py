@@ -0,0 +1,32 @@
+from taskrabbit.config import SqliteConfig
+from taskrabbit.stores.sqlite import SqliteTaskStore
+
+
+def make_store(tmp_path):
+    return SqliteTaskStore(SqliteConfig(db=str(tmp_path / "tasks.sqlite")))
+
+
+def test_load_tasks_by_name_uses_the_index(tmp_path, make_task):
+    store = make_store(tmp_path)
+    store.bulk_save([make_task("abc", task="t.add"), make_task("def", task="t.mul")])
+
+    plan = store.execute(
+        "EXPLAIN QUERY PLAN SELECT json, codec FROM tasks WHERE task=?", "t.mul"
+    ).fetchall()
+
+    assert [task.id for task in store.load_tasks("t.mul")] == ["def"]
+    assert any("tasks_task_args_kwargs" in row["detail"] for row in plan)
+
+
+def test_tasks_can_be_deleted_while_loading(tmp_path, make_task):
+    # As fill does, deleting each task once it's published.
+    store = make_store(tmp_path)
+    store.bulk_save(make_task(f"t{i}", [i]) for i in range(5))
+
+    loaded = []
+    for task in store.load_tasks():
+        store.delete(task)
+        loaded.append(task.id)
+
+    assert sorted(loaded) == [f"t{i}" for i in range(5)]
+    assert store.count_by_task() == {}
@@ -0,0 +1,105 @@
+import contextlib
+from unittest import mock
+
+import pytest
+
+from taskrabbit.config import FileConfig, SegmentedFileConfig, SqliteConfig
+from taskrabbit.stores.file import FileTaskStore
+from taskrabbit.stores.segmented import SegmentedFileTaskStore
+from taskrabbit.stores.sharded import ShardedTaskStore
+from taskrabbit.stores.sqlite import SqliteTaskStore
+
+# Stores which count tasks without loading them.
+COUNTS_WITHOUT_LOADING = {"sqlite", "postgres", "file-sharded", "segmented"}
+
+
+@pytest.fixture(
+    params=["sqlite", "postgres", "file", "file-sharded", "segmented", "sharded"]
+)
+def store(request, tmp_path):
+    """
+    An empty store of each kind.
+    """
+    name = request.param
+    if name == "postgres":
+        return request.getfixturevalue("postgres_store")
+    if name == "sqlite":
+        return SqliteTaskStore(SqliteConfig(db=str(tmp_path / "tasks.sqlite")))
+    if name.startswith("file"):
+        layout = "sharded" if name == "file-sharded" else "flat"
+        return FileTaskStore(FileConfig(directory=str(tmp_path), layout=layout))
+    if name == "segmented":
+        return SegmentedFileTaskStore(SegmentedFileConfig(directory=str(tmp_path)))
+    return ShardedTaskStore(
+        [
+            SqliteTaskStore(SqliteConfig(db=str(tmp_path / f"tasks.{i}.sqlite")))
+            for i in range(2)
+        ]
+    )
+
+
+@pytest.fixture
+def saved(store, make_task):
+    """
+    Tasks saved in the store, in ID order.
+    """
+    tasks = [
+        make_task(f"t{i:02d}", [i], task="t.mul" if i % 3 == 0 else "t.add")
+        for i in range(10)
+    ]
+    # Not saved in ID order.
+    store.bulk_save(tasks[5:])
+    store.bulk_save(tasks[:5])
+    return tasks
+
+
+def test_count_by_task(request, store, saved, make_task):
+    store.delete(saved[1])
+
+    loading = contextlib.nullcontext()
+    if request.node.callspec.params["store"] in COUNTS_WITHOUT_LOADING:
+        loading = mock.patch.object(store, "load_tasks", side_effect=AssertionError)
+    with loading:
+        counts = store.count_by_task()
+        by_name = store.count_by_task("t.mul")
+        missing = store.count_by_task("t.missing")
+
+    assert counts == {"t.add": 5, "t.mul": 4}
+    assert by_name == {"t.mul": 4}
+    assert missing == {}
+
+
+def ids(tasks):
+    return [task.id for task in tasks]
+
+
+def test_load_tasks_pages_in_id_order(store, saved):
+    assert ids(store.load_tasks(limit=3)) == ["t00", "t01", "t02"]
+    assert ids(store.load_tasks(limit=3, after="t02")) == ["t03", "t04", "t05"]
+    assert ids(store.load_tasks(after="t07")) == ["t08", "t09"]
+    assert ids(store.load_tasks(limit=3, after="t09")) == []
+
+
+def test_load_tasks_pages_by_name(store, saved):
+    assert ids(store.load_tasks("t.mul", limit=2)) == ["t00", "t03"]
+    assert ids(store.load_tasks("t.mul", limit=2, after="t03")) == ["t06", "t09"]
+
+
+@pytest.mark.parametrize("page_size", [None, 1, 3, 10])
+def test_load_tasks_in_pages(store, saved, page_size):
+    with mock.patch.object(store, "load_tasks", wraps=store.load_tasks) as load:
+        loaded = list(store.load_tasks_in_pages(page_size=page_size))
+
+    if page_size is None:
+        assert sorted(loaded, key=lambda task: task.id) == saved
+        assert load.call_count == 1
+    else:
+        assert loaded == saved
+        # The last page is empty, or short.
+        assert load.call_count == len(saved) // page_size + 1
+
+
+def test_load_tasks_in_pages_by_name(store, saved):
+    loaded = store.load_tasks_in_pages("t.add", page_size=2)
+
+    assert ids(loaded) == [task.id for task in saved if task.task == "t.add"]
@@ -0,0 +1,76 @@
+from dataclasses import replace
+
+import pytest
+from kombu import Connection, Queue
+
+from taskrabbit.operations import Throttle, fill
+
+
+@pytest.mark.parametrize(
+    "max_queue_depth, depth, paused, room",
+    [
+        (0, 0, False, 1),
+        (0, 1, True, 0),
+        (5, 4, False, 2),
+        (5, 5, False, 1),
+        (5, 6, True, 0),
+    ],
+)
+def test_pauses_only_above_max_queue_depth(max_queue_depth, depth, paused, room):
+    throttle = Throttle(max_queue_depth=max_queue_depth)
+
+    assert throttle.too_deep({"q": depth}) is paused
+    assert max(throttle.room, 0) == room
+
+
+def test_deepest_queue_decides():
+    throttle = Throttle(max_queue_depth=5)
+
+    assert throttle.too_deep({"a": 0, "b": 6})
+    assert not throttle.too_deep({"a": 0, "b": 3})
+    assert throttle.room == 3
+
+
+def test_missing_queues_are_ignored():
+    throttle = Throttle(max_queue_depth=0)
+
+    assert not throttle.too_deep({"a": None, "b": 0})
+
+
+def test_depth_checked_again_once_room_is_used():
+    throttle = Throttle(max_queue_depth=5, interval=60)
+    assert throttle.depth_check_due
+
+    throttle.too_deep({"q": 4})
+    throttle.published()
+    assert not throttle.depth_check_due
+    throttle.published()
+    assert throttle.depth_check_due
+
+
+def test_no_depth_checks_without_max_queue_depth():
+    assert not Throttle(rate=10).depth_check_due
+
+
+def test_rate_delay_spaces_out_tasks():
+    throttle = Throttle(rate=10)
+
+    assert throttle.rate_delay() == 0
+    assert throttle.rate_delay() == pytest.approx(0.1, abs=0.01)
+    assert Throttle().rate_delay() == 0
+
+
+def test_fill_publishes_up_to_max_queue_depth(cfg, queue_name, queue_size, make_task):
+    with Connection("memory://") as conn:
+        Queue(queue_name, channel=conn.default_channel).declare()
+    tasks = [make_task(f"t{i}", [i]) for i in range(3)]
+    for task in tasks:
+        task.routing_key = queue_name
+    store = cfg.init_store()
+    store.bulk_save(tasks)
+    cfg.fill = replace(cfg.fill, max_queue_depth=2)
+
+    fill(cfg, "", store)
+
+    assert queue_size() == 3
+    assert store.count_by_task() == {}
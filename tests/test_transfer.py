@@ -0,0 +1,74 @@
+from unittest import mock
+
+import pytest
+
+from taskrabbit.config import FileConfig, SqliteConfig
+from taskrabbit.stores import transfer
+from taskrabbit.stores.file import FileTaskStore
+from taskrabbit.stores.sqlite import SqliteTaskStore
+
+
+@pytest.fixture
+def tasks(make_task):
+    return [make_task("abc", [1]), make_task("def", [2], raw=True)] + [
+        make_task(f"m{i}", [i], task="t.mul") for i in range(3)
+    ]
+
+
+@pytest.fixture
+def source(tmp_path, tasks):
+    store = SqliteTaskStore(SqliteConfig(db=str(tmp_path / "source.sqlite")))
+    store.bulk_save(tasks)
+    return store
+
+
+def stored(store):
+    return sorted(store.load_tasks(), key=lambda task: task.id)
+
+
+def test_copy_tasks_in_batches(source, tasks, tmp_path):
+    target = FileTaskStore(FileConfig(directory=str(tmp_path / "target")))
+
+    with mock.patch.object(target, "bulk_save", wraps=target.bulk_save) as bulk_save:
+        count = transfer.copy_tasks(source, target, batch_size=2)
+
+    assert count == 5
+    assert [len(call.args[0]) for call in bulk_save.call_args_list] == [2, 2, 1]
+    assert stored(target) == tasks
+
+
+def test_copy_tasks_by_name(source, tasks, tmp_path):
+    target = FileTaskStore(FileConfig(directory=str(tmp_path / "target")))
+
+    assert transfer.copy_tasks(source, target, task_name="t.mul") == 3
+    assert stored(target) == tasks[2:]
+
+
+@pytest.mark.parametrize("name", ["tasks.jsonl", "tasks.jsonl.gz", "tasks.xz", "t.zst"])
+def test_export_and_import_round_trip(source, tasks, tmp_path, name):
+    if name.endswith(".zst"):
+        pytest.importorskip("zstandard")
+    path = tmp_path / name
+    target = SqliteTaskStore(SqliteConfig(db=str(tmp_path / "target.sqlite")))
+
+    assert transfer.export_tasks(source, path) == 5
+    assert transfer.import_tasks(target, path, batch_size=2) == 5
+    assert stored(target) == tasks
+
+
+def test_archive_is_compressed_by_file_name(source, tmp_path):
+    transfer.export_tasks(source, tmp_path / "tasks.gz")
+    transfer.export_tasks(source, tmp_path / "tasks.jsonl", task_name="t.mul")
+
+    assert (tmp_path / "tasks.gz").read_bytes()[:2] == b"\x1f\x8b"
+    lines = (tmp_path / "tasks.jsonl").read_bytes().splitlines()
+    assert len(lines) == 3
+
+
+def test_import_skips_blank_lines(tmp_path, tasks):
+    path = tmp_path / "tasks.jsonl"
+    path.write_bytes(tasks[0].json(indent=None).encode() + b"\n\n")
+    target = SqliteTaskStore(SqliteConfig(db=str(tmp_path / "target.sqlite")))
+
+    assert transfer.import_tasks(target, path) == 1
+    assert stored(target) == tasks[:1]